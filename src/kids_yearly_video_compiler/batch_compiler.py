@@ -0,0 +1,233 @@
+from dataclasses import dataclass, field
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from tqdm import tqdm
+
+from kids_yearly_video_compiler.configuration import Configuration
+from kids_yearly_video_compiler.job_queue import DistributedJobScheduler
+from kids_yearly_video_compiler.job_scheduler import FfmpegJob, JobScheduler, JobSchedulerError
+from kids_yearly_video_compiler.render_planner import CostModel
+from kids_yearly_video_compiler.scratch_cache import ScratchCache
+from kids_yearly_video_compiler.video_collection import VideoCollection
+from kids_yearly_video_compiler.video_collection_compiler import VideoCollectionCompiler
+from kids_yearly_video_compiler.video_index import VideoIndex, get_video_index_file_path
+from kids_yearly_video_compiler.video_inspector import VideoInfo, get_all_video_info
+
+
+@dataclass
+class _Submission:
+    compiler: VideoCollectionCompiler
+    jobs: List[FfmpegJob]
+    done: threading.Event = field(default_factory=threading.Event)
+    failures: List[Tuple[FfmpegJob, BaseException]] = field(default_factory=list)
+    interrupted: bool = False
+
+
+class BatchCompiler:
+    """
+    Compiles several configurations, e.g. several kids and years, as one job set
+
+    Each input folder is probed once, however many configurations read it. Every
+    configuration's compile() runs on its own thread; when a stage has jobs to run it
+    submits them here and waits. Once every configuration is waiting or done, the main
+    thread runs the union of the submitted jobs, with jobs writing the same scratch file
+    run once. Configurations sharing a scratch directory therefore share every transform
+    whose command is identical, like the stabilization analysis of the same source clip.
+    """
+
+    def __init__(self, configs: Sequence[Configuration]):
+        self.configs = list(configs)
+        self.compilers: List[VideoCollectionCompiler] = []
+        self.errors: Dict[int, BaseException] = {}
+        self._condition = threading.Condition()
+        self._submissions: List[_Submission] = []
+        self._active_compilers = 0
+        self._interrupted = False
+
+    def probe(self) -> List[VideoCollection]:
+        videos_by_directory: Dict[str, List[VideoInfo]] = {}
+        video_collections = []
+        for config in self.configs:
+            input_directory = os.path.abspath(config.directories.input_videos)
+            if input_directory not in videos_by_directory:
+                print(f"loading videos from {config.directories.input_videos}")
+                os.makedirs(config.directories.scratch, exist_ok=True)
+                videos_by_directory[input_directory] = get_all_video_info(
+                    config.directories.input_videos,
+                    config.compiler_options.probe_workers,
+                    config.compiler_options.probe_timeout,
+                    VideoIndex(get_video_index_file_path(config.directories.scratch)),
+                )
+            video_collections.append(VideoCollection(videos_by_directory[input_directory]))
+        return video_collections
+
+    def compile(self) -> None:
+        """
+        Compile every configuration; a configuration that fails doesn't stop the others
+
+        Raises:
+            KeyboardInterrupt: on SIGINT, once every configuration stopped
+        """
+        scratch_caches: Dict[str, ScratchCache] = {}
+        cost_models: Dict[str, CostModel] = {}
+        self.compilers = []
+        for config, video_collection in zip(self.configs, self.probe()):
+            compiler = VideoCollectionCompiler(config, video_collection)
+            # compilers writing to the same scratch directory share its pins and timings
+            scratch_directory = os.path.abspath(config.directories.scratch)
+            compiler.scratch_cache = scratch_caches.setdefault(scratch_directory, compiler.scratch_cache)
+            compiler.cost_model = cost_models.setdefault(scratch_directory, compiler.cost_model)
+            compiler.batch = self
+            self.compilers.append(compiler)
+
+        threads = [
+            threading.Thread(target=self._compile, args=(index, compiler), daemon=True)
+            for index, compiler in enumerate(self.compilers)
+        ]
+        self._active_compilers = len(threads)
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                with self._condition:
+                    self._condition.wait_for(lambda: len(self._submissions) == self._active_compilers)
+                    submissions, self._submissions = self._submissions, []
+                if not submissions:
+                    break
+                try:
+                    self._run_submissions(submissions)
+                except BaseException:
+                    for submission in submissions:
+                        submission.interrupted = True
+                    raise
+                finally:
+                    for submission in submissions:
+                        submission.done.set()
+        except BaseException:
+            with self._condition:
+                self._interrupted = True
+                for submission in self._submissions:
+                    submission.interrupted = True
+                    submission.done.set()
+            for thread in threads:
+                thread.join()
+            raise
+
+        for thread in threads:
+            thread.join()
+        for index, error in sorted(self.errors.items()):
+            print(f"compiling {self.configs[index].kid_info.name} failed: {error}")
+
+    def save(self) -> None:
+        for index, compiler in enumerate(self.compilers):
+            if index not in self.errors:
+                # the batch loop has ended, so jobs of the save step run on the compiler's own scheduler
+                for attached_compiler in [compiler, *compiler.variant_compilers]:
+                    attached_compiler.batch = None
+                compiler.save()
+
+    def run_jobs(self, compiler: VideoCollectionCompiler, jobs: List[FfmpegJob]) -> None:
+        """Called from a compiler's thread, returns once its jobs ran as part of the batch"""
+        submission = _Submission(compiler, jobs)
+        with self._condition:
+            if self._interrupted:
+                raise KeyboardInterrupt
+            self._submissions.append(submission)
+            self._condition.notify_all()
+        submission.done.wait()
+        if submission.interrupted:
+            raise KeyboardInterrupt
+        if submission.failures:
+            raise JobSchedulerError(submission.failures)
+
+    def _compile(self, index: int, compiler: VideoCollectionCompiler) -> None:
+        try:
+            compiler.compile()
+        except BaseException as e:
+            self.errors[index] = e
+        finally:
+            with self._condition:
+                self._active_compilers -= 1
+                self._condition.notify_all()
+
+    def _run_submissions(self, submissions: List[_Submission]) -> None:
+        unique_jobs: Dict[str, FfmpegJob] = {}
+        owners: Dict[str, List[_Submission]] = {}
+        for submission in submissions:
+            for job in submission.jobs:
+                unique_jobs.setdefault(job.cache_entry.file_path, job)
+                owners.setdefault(job.cache_entry.file_path, []).append(submission)
+        if not unique_jobs:
+            return
+
+        submitted_jobs = sum(len(submission.jobs) for submission in submissions)
+        print(
+            f"running {len(unique_jobs)} jobs for {len(submissions)} configurations "
+            f"({submitted_jobs - len(unique_jobs)} shared)"
+        )
+        async def run_job(job: FfmpegJob, position: int) -> None:
+            await owners[job.cache_entry.file_path][0].compiler._run_job(job, position)
+
+        def on_job_done(job: FfmpegJob, pbar: tqdm) -> None:
+            for submission in owners[job.cache_entry.file_path]:
+                submission.compiler.scratch_cache.pin(job.cache_entry)
+            pbar.update(1)
+
+        failures: List[Tuple[FfmpegJob, BaseException]] = []
+        with tqdm(total=len(unique_jobs), desc="running batch jobs", unit="video", colour="green") as pbar:
+            for job_scheduler, jobs in self._plan_job_groups(submissions, list(unique_jobs.values())):
+                try:
+                    job_scheduler.run(jobs, run_job, lambda job: on_job_done(job, pbar))
+                except JobSchedulerError as e:
+                    failures.extend(e.failures)
+        for job, error in failures:
+            for submission in owners[job.cache_entry.file_path]:
+                submission.failures.append((job, error))
+
+    def _plan_job_groups(
+        self, submissions: Sequence[_Submission], jobs: List[FfmpegJob]
+    ) -> List[Tuple[JobScheduler, List[FfmpegJob]]]:
+        """
+        Split the union of the submitted jobs into groups, each with the scheduler to run it on
+
+        Every configuration built its jobs with the thread count it planned for its own
+        pending jobs, so a configuration with a single job left hands it the whole cpu
+        budget. Jobs of the same width run together, as many at once as fit the budget and
+        the lowest parallel_jobs of the configurations, widest first. When any configuration
+        compiles distributed, the whole union goes to its workers.
+        """
+        job_schedulers = [submission.compiler.job_scheduler for submission in submissions]
+        distributed_job_scheduler = next(
+            (job_scheduler for job_scheduler in job_schedulers if isinstance(job_scheduler, DistributedJobScheduler)),
+            None,
+        )
+        if distributed_job_scheduler is not None:
+            return [(distributed_job_scheduler, jobs)]
+
+        cpu_budget = max(job_scheduler.cpu_budget for job_scheduler in job_schedulers)
+        max_jobs = min((job_scheduler.max_jobs for job_scheduler in job_schedulers if job_scheduler.max_jobs), default=0)
+        jobs_by_threads: Dict[int, List[FfmpegJob]] = {}
+        for job in jobs:
+            jobs_by_threads.setdefault(max(1, job.threads), []).append(job)
+        job_groups = []
+        for threads, jobs_of_width in sorted(jobs_by_threads.items(), reverse=True):
+            concurrent_jobs = max(1, cpu_budget // threads)
+            if max_jobs:
+                concurrent_jobs = min(concurrent_jobs, max_jobs)
+            job_groups.append((JobScheduler(cpu_budget, concurrent_jobs), jobs_of_width))
+        return job_groups
+
+
+def compile_batch(configs: Sequence[Configuration], verify_only: bool = False) -> Optional[BatchCompiler]:
+    batch_compiler = BatchCompiler(configs)
+    if verify_only:
+        for config, video_collection in zip(configs, batch_compiler.probe()):
+            print(f"{config.kid_info.name}:")
+            video_collection.print_info()
+        return None
+    batch_compiler.compile()
+    batch_compiler.save()
+    return batch_compiler
@@ -0,0 +1,320 @@
+"""
+Benchmarks for the Kids Yearly Video Compiler pipeline stages.
+
+Synthetic clips are generated with ffmpeg's lavfi testsrc2 source, so runs are
+reproducible on any machine with ffmpeg installed. Results are written as JSON and can
+be compared against an earlier run to flag regressions.
+"""
+
+import argparse
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from kids_yearly_video_compiler.configuration import Configuration
+from kids_yearly_video_compiler.video_collection import VideoCollection
+from kids_yearly_video_compiler.video_collection_compiler import VideoCollectionCompiler
+from kids_yearly_video_compiler.video_inspector import VideoInfo, get_video_info
+from kids_yearly_video_compiler.video_quality import measure_quality
+
+# the LUT tonemap is flagged when its output drifts further than this from the exact chain
+DEFAULT_MIN_HDR_TONEMAP_SSIM = 0.98
+
+
+@dataclass
+class Scenario:
+    name: str
+    width: int
+    height: int
+    hdr: bool = False
+
+
+SCENARIOS = [
+    Scenario("sdr-720p-landscape", 1280, 720),
+    Scenario("sdr-1080p-landscape", 1920, 1080),
+    Scenario("sdr-1080p-portrait", 1080, 1920),
+    Scenario("hdr-1080p-landscape", 1920, 1080, hdr=True),
+    Scenario("hdr-1080p-portrait", 1080, 1920, hdr=True),
+    Scenario("hdr-2160p-landscape", 3840, 2160, hdr=True),
+]
+DEFAULT_SCENARIOS = [scenario.name for scenario in SCENARIOS if scenario.height <= 1920 and scenario.width <= 1920]
+
+
+def generate_synthetic_clip(
+    output_file_path: str, scenario: Scenario, duration: float, frame_rate: str = "30"
+) -> None:
+    """Write a testsrc2 clip, tagged as bt2020 HLG like our phone's HDR clips when scenario.hdr is set"""
+    if os.path.isfile(output_file_path):
+        return
+    if scenario.hdr:
+        color_options = [
+            "-pix_fmt", "yuv420p10le",
+            "-color_primaries", "bt2020", "-color_trc", "arib-std-b67", "-colorspace", "bt2020nc",
+        ]
+    else:
+        color_options = [
+            "-pix_fmt", "yuv420p",
+            "-color_primaries", "bt709", "-color_trc", "bt709", "-colorspace", "bt709",
+        ]
+    partial_file_path = f"{output_file_path}.partial.mp4"
+    subprocess.run(
+        [
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+            "-f", "lavfi",
+            "-i", f"testsrc2=size={scenario.width}x{scenario.height}:rate={frame_rate}:duration={duration}",
+            "-vcodec", "libx264", "-preset", "veryfast",
+            *color_options,
+            partial_file_path,
+        ],
+        check=True,
+    )
+    os.replace(partial_file_path, output_file_path)
+
+
+def generate_scenario_clips(clips_directory: str, scenario: Scenario, clips: int, duration: float) -> List[VideoInfo]:
+    os.makedirs(clips_directory, exist_ok=True)
+    videos = []
+    for index in range(clips):
+        # PXL_ names give the clips weekly dates like the phone's own file names
+        clip_date = date(2023, 1, 1) + timedelta(weeks=index + 1)
+        video_file_name = f"PXL_{clip_date.strftime('%Y%m%d')}_{scenario.name}-{duration:g}s.mp4"
+        generate_synthetic_clip(os.path.join(clips_directory, video_file_name), scenario, duration)
+        videos.append(get_video_info(clips_directory, video_file_name))
+    return videos
+
+
+def get_benchmark_configuration(
+    work_directory: str, clips: int, render_mode: str = "staged", hdr_tonemap: str = "exact"
+) -> Configuration:
+    config = Configuration()
+    config.kid_info.birthday = date(2023, 1, 1)
+    config.directories.scratch = os.path.join(work_directory, "scratch")
+    config.directories.output_video = os.path.join(work_directory, "output")
+    # two seconds per clip keeps every clip on the head-tail branch of the algorithm
+    config.timelapse_video.length = f"{clips * 2}s"
+    config.timelapse_options.video_stabilization = True
+    config.compiler_options.render_mode = render_mode
+    config.timelapse_video.hdr_tonemap = hdr_tonemap
+    return config
+
+
+def _reset_directories(config: Configuration) -> None:
+    for directory in (config.directories.scratch, config.directories.output_video):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def _time(function: Callable[[], object], repeat: int, before: Callable[[], None] = None) -> float:
+    timings = []
+    for _ in range(repeat):
+        if before:
+            before()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def benchmark_scenario(
+    work_directory: str, scenario: Scenario, clips: int, duration: float, repeat: int
+) -> Dict[str, float]:
+    videos = generate_scenario_clips(os.path.join(work_directory, "clips"), scenario, clips, duration)
+    video_collection = VideoCollection(videos)
+    results: Dict[str, float] = {}
+
+    config = get_benchmark_configuration(os.path.join(work_directory, scenario.name), clips)
+    compiler = VideoCollectionCompiler(config, video_collection)
+    reset = lambda: _reset_directories(config)
+
+    results["head_tail_algorithm"] = _time(
+        lambda: compiler.run_head_tail_algorithm(video_collection), repeat, reset
+    )
+    results["video_stabilization"] = _time(
+        lambda: compiler.run_video_stabilization(video_collection), repeat, reset
+    )
+
+    # the filter and save stages each start from the previous stage's cached output
+    head_tail_algorithm_collection = compiler.run_head_tail_algorithm(video_collection)
+    results["video_filters"] = _time(
+        lambda: compiler.run_video_filters(head_tail_algorithm_collection),
+        repeat,
+        lambda: _remove_scratch_files(config, "-video-filters."),
+    )
+    compiler.compiled_video_collection = compiler.run_video_filters(head_tail_algorithm_collection)
+    results["save"] = _time(compiler.save, repeat)
+
+    for render_mode in ("staged", "fused"):
+        end_to_end_config = get_benchmark_configuration(
+            os.path.join(work_directory, scenario.name), clips, render_mode
+        )
+        end_to_end_compiler = VideoCollectionCompiler(end_to_end_config, video_collection)
+        results[f"end_to_end_{render_mode}"] = _time(
+            lambda: (end_to_end_compiler.compile(), end_to_end_compiler.save()),
+            repeat,
+            lambda: _reset_directories(end_to_end_config),
+        )
+    return results
+
+
+def benchmark_hdr_tonemap(
+    work_directory: str, scenario: Scenario, clips: int, duration: float, repeat: int
+) -> Tuple[Dict[str, float], Dict[str, float]]:
+    """
+    Time the video filter stage with the exact tonemap chain and with its LUT, and measure
+    how close the LUT output is to the exact one
+
+    Returns:
+        The timings, and the mean SSIM and PSNR of the LUT output against the exact output
+    """
+    videos = generate_scenario_clips(os.path.join(work_directory, "clips"), scenario, clips, duration)
+    video_collection = VideoCollection(videos)
+    timings: Dict[str, float] = {}
+    outputs: Dict[str, VideoCollection] = {}
+    for hdr_tonemap in ("exact", "lut"):
+        # a scratch directory per tonemap, so resetting one run's outputs keeps the other's for the comparison
+        config = get_benchmark_configuration(
+            os.path.join(work_directory, scenario.name, f"hdr-tonemap-{hdr_tonemap}"), clips, hdr_tonemap=hdr_tonemap
+        )
+        os.makedirs(config.directories.scratch, exist_ok=True)
+        compiler = VideoCollectionCompiler(config, video_collection)
+        head_tail_algorithm_collection = compiler.run_head_tail_algorithm(video_collection)
+        # generate the LUT outside of the timing, it is made once and cached
+        compiler.prepare_hdr_tonemap_lut(videos[0].color_transfer)
+        timings[f"hdr_tonemap_{hdr_tonemap}"] = _time(
+            lambda: compiler.run_video_filters(head_tail_algorithm_collection),
+            repeat,
+            lambda: _remove_scratch_files(config, "-video-filters."),
+        )
+        outputs[hdr_tonemap] = compiler.run_video_filters(head_tail_algorithm_collection)
+
+    metrics = [
+        measure_quality(exact_video.file_path, lut_video.file_path)
+        for exact_video, lut_video in zip(outputs["exact"].sorted(), outputs["lut"].sorted())
+    ]
+    quality = {
+        "ssim": sum(metric.ssim for metric in metrics) / len(metrics),
+        "psnr": sum(metric.psnr for metric in metrics) / len(metrics),
+    }
+    return timings, quality
+
+
+def _remove_scratch_files(config: Configuration, name_part: str) -> None:
+    for file_name in os.listdir(config.directories.scratch):
+        if name_part in file_name:
+            os.remove(os.path.join(config.directories.scratch, file_name))
+
+
+def get_environment() -> dict:
+    ffmpeg_version = subprocess.run(["ffmpeg", "-version"], capture_output=True, universal_newlines=True)
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "ffmpeg_version": ffmpeg_version.stdout.splitlines()[0] if ffmpeg_version.stdout else "",
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def compare_results(baseline: dict, results: dict, threshold: float) -> List[str]:
+    """Return a description of every timing that got slower than the baseline by more than threshold"""
+    regressions = []
+    for scenario_name, timings in results["results"].items():
+        baseline_timings = baseline.get("results", {}).get(scenario_name, {})
+        for stage, seconds in timings.items():
+            baseline_seconds = baseline_timings.get(stage)
+            if baseline_seconds and seconds > baseline_seconds * (1 + threshold):
+                regressions.append(
+                    f"{scenario_name}/{stage}: {baseline_seconds:.2f}s -> {seconds:.2f}s "
+                    f"(+{(seconds / baseline_seconds - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def run_benchmarks(
+    work_directory: str,
+    scenario_names: List[str],
+    clips: int = 3,
+    duration: float = 20.0,
+    repeat: int = 1,
+) -> dict:
+    scenarios = {scenario.name: scenario for scenario in SCENARIOS}
+    results = {}
+    quality = {}
+    for scenario_name in scenario_names:
+        print(f"benchmarking {scenario_name}")
+        results[scenario_name] = benchmark_scenario(
+            work_directory, scenarios[scenario_name], clips, duration, repeat
+        )
+        if scenarios[scenario_name].hdr:
+            tonemap_timings, quality[f"{scenario_name}/hdr_tonemap_lut"] = benchmark_hdr_tonemap(
+                work_directory, scenarios[scenario_name], clips, duration, repeat
+            )
+            results[scenario_name].update(tonemap_timings)
+    return {
+        "environment": get_environment(),
+        "parameters": {"clips": clips, "duration": duration, "repeat": repeat},
+        "results": results,
+        "quality": quality,
+    }
+
+
+def check_quality(results: dict, min_hdr_tonemap_ssim: float) -> List[str]:
+    """Return a description of every approximation whose output is too far from the exact one"""
+    return [
+        f"{name}: SSIM {metrics['ssim']:.4f} < {min_hdr_tonemap_ssim} (PSNR {metrics['psnr']:.1f}dB)"
+        for name, metrics in results.get("quality", {}).items()
+        if metrics["ssim"] < min_hdr_tonemap_ssim
+    ]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the video compiler pipeline stages on synthetic clips.')
+    parser.add_argument('--work-dir', type=str, default='./benchmark', help='Directory for the synthetic clips and scratch files')
+    parser.add_argument('--output', type=str, default='benchmark-results.json', help='Path of the JSON results file')
+    parser.add_argument('--scenarios', nargs='+', default=DEFAULT_SCENARIOS, choices=[scenario.name for scenario in SCENARIOS], help='Scenarios to run')
+    parser.add_argument('--clips', type=int, default=3, help='Number of clips per scenario')
+    parser.add_argument('--duration', type=float, default=20.0, help='Duration of each synthetic clip in seconds')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per timing, the fastest one is kept')
+    parser.add_argument('--compare', type=str, help='Results file of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.15, help='Slowdown ratio reported as a regression')
+    parser.add_argument('--min-hdr-tonemap-ssim', type=float, default=DEFAULT_MIN_HDR_TONEMAP_SSIM, help='Lowest SSIM of the LUT tonemap against the exact tonemap')
+    args = parser.parse_args(argv)
+
+    if shutil.which("ffmpeg") is None:
+        print("ffmpeg was not found on the PATH")
+        return 2
+
+    results = run_benchmarks(args.work_dir, args.scenarios, args.clips, args.duration, args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"wrote benchmark results to {args.output}")
+
+    for name, metrics in results["quality"].items():
+        print(f"quality {name}: SSIM {metrics['ssim']:.4f}, PSNR {metrics['psnr']:.1f}dB")
+    quality_failures = check_quality(results, args.min_hdr_tonemap_ssim)
+    for quality_failure in quality_failures:
+        print(f"quality below floor: {quality_failure}")
+    if quality_failures:
+        return 1
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, results, args.threshold)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            return 1
+        print(f"no regressions against {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+from dataclasses import asdict, dataclass, field
+import json
+import os
+from typing import Dict, List, Optional
+
+
+@dataclass
+class ClipManifest:
+    base_name: str
+    source_file_path: str
+    source_size: int = 0
+    source_mtime_ns: int = 0
+    segment_file_path: str = ""
+
+
+@dataclass
+class ManifestDiff:
+    added: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+    unchanged: List[str] = field(default_factory=list)
+    # parameter name -> (previous value, new value)
+    changed_parameters: Dict[str, tuple] = field(default_factory=dict)
+
+    @property
+    def full_rebuild(self) -> bool:
+        """Parameter changes apply to every clip, so every segment has to be rendered again"""
+        return bool(self.changed_parameters)
+
+    def print_summary(self) -> None:
+        if self.full_rebuild:
+            print(f"full rebuild of {len(self.added) + len(self.changed) + len(self.unchanged)} clips, parameters changed:")
+            for name, (previous_value, value) in self.changed_parameters.items():
+                print(f"\t{name}: {previous_value} -> {value}")
+        else:
+            print(
+                f"incremental build: {len(self.added)} new, {len(self.changed)} changed, "
+                f"{len(self.removed)} removed, {len(self.unchanged)} unchanged clips"
+            )
+        for base_name in self.added:
+            print(f"\tnew: {base_name}")
+        for base_name in self.changed:
+            print(f"\tchanged: {base_name}")
+        for base_name in self.removed:
+            print(f"\tremoved: {base_name}")
+
+
+@dataclass
+class BuildManifest:
+    """Record of the clips, their order, the render parameters and the segment outputs of a build"""
+
+    parameters: dict = field(default_factory=dict)
+    clips: List[ClipManifest] = field(default_factory=list)
+    output_video_path: str = ""
+
+    def get_segment_file_paths(self) -> List[str]:
+        return [clip.segment_file_path for clip in self.clips]
+
+    def diff(self, previous: Optional["BuildManifest"]) -> ManifestDiff:
+        previous = previous or BuildManifest(parameters=self.parameters)
+        previous_clips = {clip.base_name: clip for clip in previous.clips}
+        clips = {clip.base_name: clip for clip in self.clips}
+        manifest_diff = ManifestDiff(
+            removed=[base_name for base_name in previous_clips if base_name not in clips],
+            changed_parameters={
+                name: (previous.parameters.get(name), value)
+                for name, value in self.parameters.items()
+                if previous.parameters.get(name) != value
+            },
+        )
+        for clip in self.clips:
+            previous_clip = previous_clips.get(clip.base_name)
+            if previous_clip is None:
+                manifest_diff.added.append(clip.base_name)
+            elif (
+                previous_clip.source_file_path,
+                previous_clip.source_size,
+                previous_clip.source_mtime_ns,
+            ) != (clip.source_file_path, clip.source_size, clip.source_mtime_ns):
+                manifest_diff.changed.append(clip.base_name)
+            else:
+                manifest_diff.unchanged.append(clip.base_name)
+        return manifest_diff
+
+    def save(self, manifest_file_path: str) -> None:
+        partial_file_path = f"{manifest_file_path}.partial"
+        with open(partial_file_path, "w") as f:
+            json.dump(asdict(self), f, indent=2, default=str)
+        os.replace(partial_file_path, manifest_file_path)
+
+    @staticmethod
+    def load(manifest_file_path: str) -> Optional["BuildManifest"]:
+        if not os.path.isfile(manifest_file_path):
+            return None
+        try:
+            with open(manifest_file_path, "r") as f:
+                data = json.load(f)
+            return BuildManifest(
+                parameters=data.get("parameters", {}),
+                clips=[ClipManifest(**clip) for clip in data.get("clips", [])],
+                output_video_path=data.get("output_video_path", ""),
+            )
+        except (ValueError, TypeError) as e:
+            print(f"ignoring unreadable build manifest {manifest_file_path}: {e}")
+            return None
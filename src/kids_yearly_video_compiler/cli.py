@@ -4,11 +4,16 @@ import argparse
 import glob
 import os
 import shutil
+import sys
+from typing import List
 
 from kids_yearly_video_compiler.configuration import Configuration, load_configuration
 from kids_yearly_video_compiler.video_collection import VideoCollection
-from kids_yearly_video_compiler.video_collection_compiler import VideoCollectionCompiler
-from kids_yearly_video_compiler.video_inspector import get_all_video_info
+from kids_yearly_video_compiler.video_index import VideoIndex, get_video_index_file_path
+from kids_yearly_video_compiler.video_inspector import VideoInfo, get_all_video_info
+
+# modules that import ffmpeg-python, tqdm or asyncio are imported by the commands that
+# use them, so --verify-only and list_weeks on an indexed folder start in a few milliseconds
 
 def cli():
     parser = argparse.ArgumentParser(description='Generate a yearly video timelapse.')
@@ -18,11 +23,87 @@ def cli():
     parser.add_argument('--clear-stabilized-data', action='store_true', help='Clear the stabilization data')
     parser.add_argument('--clear-compiled', action='store_true', help='Clear the compiled videos')
     parser.add_argument('--clear-scratch', action='store_true', help='Clear the scratch directory')
+    parser.add_argument('--preview', action='store_true', help='Render a quick low resolution draft without stabilization, in its own scratch directory')
+    parser.add_argument('--plan', action='store_true', help='Print the estimated cost of every job, the critical path and an ETA without compiling')
+    parser.add_argument('--distributed', action='store_true', help='Queue the per-clip jobs for `kyvc worker` processes instead of running them locally')
+    subparsers = parser.add_subparsers(dest='command')
+    worker_parser = subparsers.add_parser('worker', help='Run queued jobs of a distributed render')
+    worker_parser.add_argument('--config', type=str, default=argparse.SUPPRESS, help='Path to the configuration file, its scratch directory holds the job queue')
+    worker_parser.add_argument('--worker-id', type=str, help='Name of this worker in job leases (default: hostname-pid)')
+    worker_parser.add_argument('--lease', dest='lease_seconds', type=float, default=argparse.SUPPRESS, help='Seconds a claimed job stays leased without a heartbeat (default: 60)')
+    worker_parser.add_argument('--exit-when-idle', action='store_true', help='Exit once the queue is empty instead of waiting for more jobs')
+    batch_parser = subparsers.add_parser('batch', help='Compile several configurations as one job set, sharing probe and render work')
+    batch_parser.add_argument('configs', nargs='+', help='Configuration files, e.g. one per kid and year')
+    batch_parser.add_argument('--verify-only', action='store_true', default=argparse.SUPPRESS, help='Verify the videos without compiling')
+    watch_parser = subparsers.add_parser('watch', help='Pre-process clips in the background as they arrive in the input directory')
+    watch_parser.add_argument('--config', type=str, default=argparse.SUPPRESS, help='Path to the configuration file')
+    watch_parser.add_argument('--interval', dest='poll_interval', type=float, default=argparse.SUPPRESS, help='Seconds between scans of the input directory (default: 10)')
+    watch_parser.add_argument('--stable-seconds', type=float, default=argparse.SUPPRESS, help='Seconds a file has to stay unchanged before it is processed (default: 30)')
+    watch_parser.add_argument('--settle-seconds', type=float, default=argparse.SUPPRESS, help='Seconds without new clips before the whole collection is pre-rendered (default: 600)')
+    watch_parser.add_argument('--max-load', type=float, default=argparse.SUPPRESS, help='Load average above which no new work starts (default: number of cores)')
+    watch_parser.add_argument('--nice', type=int, default=argparse.SUPPRESS, help='Niceness added to the watcher and its ffmpeg processes (default: 10)')
+    tune_parser = subparsers.add_parser('tune', help='Pick the encoder preset and CRF for this box and write them into the configuration')
+    tune_parser.add_argument('--config', type=str, default=argparse.SUPPRESS, help='Path to the configuration file to tune and update')
+    tune_parser.add_argument('--profile', dest='section', choices=['output_encoding', 'intermediate_encoding'], default=argparse.SUPPRESS, help='Encoding profile to tune (default: output_encoding)')
+    tune_parser.add_argument('--samples', type=int, default=argparse.SUPPRESS, help='Number of clips sampled from the collection (default: 4)')
+    tune_parser.add_argument('--window', dest='window_seconds', type=float, default=argparse.SUPPRESS, help='Seconds encoded from each sampled clip (default: 4)')
+    tune_parser.add_argument('--presets', nargs='+', help='x264 presets to try (default: ultrafast to slow)')
+    tune_parser.add_argument('--crfs', nargs='+', type=float, help='CRF values to try (default: 18 20 23 26)')
+    tune_parser.add_argument('--threads', nargs='+', type=int, help='Encoder thread counts to try, 0 lets the job scheduler decide (default: 0)')
+    tune_goal = tune_parser.add_mutually_exclusive_group()
+    tune_goal.add_argument('--min-ssim', type=float, default=argparse.SUPPRESS, help='Pick the fastest profile whose every sample reaches this SSIM (default: 0.97)')
+    tune_goal.add_argument('--time-budget', type=float, default=argparse.SUPPRESS, help='Pick the best quality profile that encodes the whole timelapse within this many seconds')
+    tune_parser.add_argument('--dry-run', action='store_true', help='Print the chosen profile without updating the configuration file')
     args = parser.parse_args()
 
+    if args.command == 'batch':
+        from kids_yearly_video_compiler.batch_compiler import compile_batch
+
+        batch_compiler = compile_batch([load_configuration(config_path) for config_path in args.configs], args.verify_only)
+        if batch_compiler is not None and batch_compiler.errors:
+            # a nightly batch has to notice configurations that failed
+            sys.exit(f"{len(batch_compiler.errors)} of {len(args.configs)} configurations failed")
+        return
+
     config_path = args.config if args.config else None
     config = load_configuration(config_path)
 
+    if args.command == 'worker':
+        from kids_yearly_video_compiler.ffmpeg_process_manager import FfmpegProcessManager
+        from kids_yearly_video_compiler.job_queue import JobQueue, get_job_queue_file_path, run_worker
+
+        job_queue = JobQueue(get_job_queue_file_path(config.directories.scratch))
+        run_worker(
+            job_queue,
+            args.worker_id,
+            exit_when_idle=args.exit_when_idle,
+            process_manager=FfmpegProcessManager(config.compiler_options.stall_timeout),
+            **_get_given_arguments(args, 'lease_seconds'),
+        )
+        return
+    if args.command == 'tune':
+        # without a configuration file to update, the chosen profile is only printed
+        writable = config_path and os.path.isfile(config_path) and not args.dry_run
+        tune_encoder(config, config_path if writable else None, args)
+        return
+    if args.command == 'watch':
+        from kids_yearly_video_compiler.watcher import watch
+
+        watch(config, **_get_given_arguments(args, 'poll_interval', 'stable_seconds', 'settle_seconds', 'max_load', 'nice'))
+        return
+
+    if args.distributed:
+        config.compiler_options.distributed = True
+    if config.compiler_options.distributed:
+        # workers on other nodes resolve the job commands' paths on the shared mount
+        config.directories.input_videos = os.path.abspath(config.directories.input_videos)
+        config.directories.output_video = os.path.abspath(config.directories.output_video)
+        config.directories.scratch = os.path.abspath(config.directories.scratch)
+
+    if args.preview:
+        config = config.get_preview_configuration()
+        os.makedirs(config.directories.scratch, exist_ok=True)
+
     if args.clear_compiled:
         clear_scratch_file_type(config, 'compiled')
     if args.clear_stabilized:
@@ -32,7 +113,26 @@ def cli():
     if args.clear_scratch:
         clear_scratch(config)
 
-    kids_yearly_video_compiler(config, args.verify_only)
+    kids_yearly_video_compiler(config, args.verify_only, args.plan)
+
+def _get_given_arguments(args: argparse.Namespace, *names: str) -> dict:
+    # options without a default are only set when given, so the called function's defaults apply
+    return {name: getattr(args, name) for name in names if hasattr(args, name)}
+
+def tune_encoder(config: Configuration, config_path: str, args: argparse.Namespace):
+    from kids_yearly_video_compiler import tuner
+
+    candidates = tuner.get_candidates(
+        args.presets or tuner.DEFAULT_PRESETS, args.crfs or tuner.DEFAULT_CRFS, args.threads or tuner.DEFAULT_THREADS
+    )
+    video_collection = VideoCollection(load_videos(config))
+    tuner.tune(
+        config,
+        video_collection,
+        config_path,
+        candidates=candidates,
+        **_get_given_arguments(args, 'section', 'samples', 'window_seconds', 'min_ssim', 'time_budget'),
+    )
 
 def clear_scratch(config: Configuration):
     shutil.rmtree(config.directories.scratch)
@@ -50,11 +150,18 @@ def clear_scratch_file_type(config: Configuration, type: str):
             print(f"error deleting {video_path}: {e}")
     print(f"deleted all {type} videos in {config.directories.scratch}")
 
-def kids_yearly_video_compiler(config: Configuration, verify_only: bool = False) -> None:
+def load_videos(config: Configuration) -> List[VideoInfo]:
     print(f"loading videos from {config.directories.input_videos}")
-    videos = get_all_video_info(config.directories.input_videos)
+    os.makedirs(config.directories.scratch, exist_ok=True)
+    return get_all_video_info(
+        config.directories.input_videos,
+        config.compiler_options.probe_workers,
+        config.compiler_options.probe_timeout,
+        VideoIndex(get_video_index_file_path(config.directories.scratch)),
+    )
 
-    video_collection = VideoCollection(videos)
+def kids_yearly_video_compiler(config: Configuration, verify_only: bool = False, plan_only: bool = False) -> None:
+    video_collection = VideoCollection(load_videos(config))
     video_collection.print_info()
 
     if config.compiler_options.list_weeks:
@@ -67,7 +174,12 @@ def kids_yearly_video_compiler(config: Configuration, verify_only: bool = False)
     if verify_only:
         return
 
+    from kids_yearly_video_compiler.video_collection_compiler import VideoCollectionCompiler
+
     video_collection_compiler = VideoCollectionCompiler(config, video_collection)
+    if plan_only:
+        video_collection_compiler.plan().print_plan()
+        return
     video_collection_compiler.compile()
     video_collection_compiler.save()
 
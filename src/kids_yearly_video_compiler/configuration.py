@@ -1,9 +1,13 @@
 import os
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass, field, replace
 from datetime import date
-from typing import Tuple, Any
+from fractions import Fraction
+from typing import Any, Dict, List, Optional, Tuple
 import yaml
 
+# width of --preview drafts
+PREVIEW_MAX_WIDTH = 640
+
 @dataclass
 class KidInfo:
     name: str = "Jane Doe"
@@ -21,6 +25,9 @@ class TimelapseVideo:
     max_width: int = 1920
     max_height: int = 1080
     instagram_style: bool = True
+    frame_rate: str = "30000/1001"
+    font_size: int = 36  # size of the birthday week label
+    hdr_tonemap: str = "exact"  # "exact" runs the float tonemap chain on every pixel, "lut" applies a 3D LUT generated from it once
 
     def get_length_in_seconds(self) -> float:
         """Parse time string (e.g., '5m', '15s', '1h30m') into seconds."""
@@ -57,6 +64,38 @@ class TimelapseVideo:
 
         return total_seconds
 
+@dataclass
+class OutputVariant:
+    name: str = "main"  # added to the output file name, e.g. "instagram" or "tv-720p"
+    max_width: int = 1920
+    max_height: int = 1080
+    instagram_style: bool = False
+
+@dataclass
+class EncodingProfile:
+    codec: str = "libx264"
+    preset: str = "medium"
+    crf: Optional[float] = 23  # libx264/libx265 quality, 0 is lossless
+    threads: int = 0  # encoder threads, 0 lets the job scheduler decide
+    pix_fmt: str = "yuv420p"
+    options: Dict[str, Any] = field(default_factory=dict)  # extra ffmpeg output options, e.g. {"tune": "fastdecode"}
+
+    def get_output_options(self) -> dict:
+        output_options = {"vcodec": self.codec, "pix_fmt": self.pix_fmt}
+        if self.preset:
+            output_options["preset"] = self.preset
+        if self.crf is not None:
+            output_options["crf"] = self.crf
+        if self.threads:
+            output_options["threads"] = self.threads
+        output_options.update(self.options)
+        return output_options
+
+def _default_intermediate_encoding() -> EncodingProfile:
+    # intermediates are decoded again right away, so favour encode speed over file size
+    # while staying close to lossless
+    return EncodingProfile(preset="ultrafast", crf=12)
+
 @dataclass
 class TimelapseOptions:
     reverse: bool = False
@@ -69,20 +108,107 @@ class TimelapseOptions:
 class TimelapseStabilizationOptions:
     shakiness: int = 5  # 1-10
     smoothing: int = 10  # number of forwards and backwards frames +1 to use for smoothing
+    analysis_width: int = 0  # width motion is detected and corrected at, 0 uses max_width; lower is a faster, softer proxy
 
 @dataclass
 class CompilerOptions:
     show_ffmpeg_commands: bool = False
     list_weeks: bool = False
+    probe_workers: int = 0  # concurrent ffprobe processes, 0 uses the number of cores
+    probe_timeout: float = 30.0  # seconds before a single ffprobe is abandoned
+    cpu_budget: int = 0  # cores shared by all concurrent ffmpeg jobs, 0 uses the number of cores
+    parallel_jobs: int = 0  # concurrent ffmpeg jobs, 0 derives it from cpu_budget
+    render_mode: str = "fused"  # "fused" renders each clip in one pass, "staged" keeps every intermediate for debugging
+    distributed: bool = False  # queue per-clip jobs for `kyvc worker` processes sharing the scratch directory
+    scratch_max_size: str = ""  # e.g. "50G", least recently used scratch files are evicted above it, empty is unlimited
+    stall_timeout: float = 120.0  # seconds without ffmpeg progress before a job is killed, 0 waits forever
+    preview: bool = False  # draft render, set by Configuration.get_preview_configuration
+    verify_metadata_sample: float = 0.0  # fraction of each stage's outputs probed to check their derived metadata, 0 probes none
+
+    def get_scratch_max_size_in_bytes(self) -> int:
+        """Parse size string (e.g., '500M', '50G', '1T') into bytes."""
+        size = str(self.scratch_max_size).strip().upper()
+        if not size:
+            return 0
+        units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+        if size.endswith("B"):
+            size = size[:-1]
+        try:
+            if size[-1] in units:
+                return int(float(size[:-1]) * units[size[-1]])
+            return int(float(size))
+        except ValueError:
+            raise ValueError(f"Invalid size format: {self.scratch_max_size}")
 
 @dataclass
 class Configuration:
     kid_info: KidInfo = field(default_factory=KidInfo)
     directories: Directories = field(default_factory=Directories)
     timelapse_video: TimelapseVideo = field(default_factory=TimelapseVideo)
+    intermediate_encoding: EncodingProfile = field(default_factory=_default_intermediate_encoding)
+    output_encoding: EncodingProfile = field(default_factory=EncodingProfile)
+    # a delivery profile the joined timeline is re-encoded into in parallel chunks, e.g. HEVC,
+    # None joins the clips encoded with output_encoding with a stream copy
+    final_encoding: Optional[EncodingProfile] = None
     timelapse_options: TimelapseOptions = field(default_factory=TimelapseOptions)
     timelapse_stabilization_options: TimelapseStabilizationOptions = field(default_factory=TimelapseStabilizationOptions)
     compiler_options: CompilerOptions = field(default_factory=CompilerOptions)
+    # outputs rendered from one shared decode, stabilization and tonemap of every clip,
+    # empty renders the single timelapse_video output
+    output_variants: List[OutputVariant] = field(default_factory=list)
+
+    def get_preview_configuration(self, max_width: int = PREVIEW_MAX_WIDTH) -> 'Configuration':
+        """
+        Configuration of a quick draft of the same compilation
+
+        The draft keeps the clip order, timing, labels and crop framing, scaled down so the
+        widest output is max_width, at half the frame rate. Stabilization is skipped, HDR clips get an
+        approximate tonemap and everything is encoded with the fastest preset. Its
+        intermediates live in their own scratch subdirectory, away from the full quality
+        cache.
+        """
+        widest = max([self.timelapse_video.max_width] + [variant.max_width for variant in self.output_variants])
+        scale = min(1.0, max_width / widest)
+        frame_rate = Fraction(self.timelapse_video.frame_rate) / 2
+        draft_encoding = EncodingProfile(codec="libx264", preset="ultrafast", crf=30)
+        return replace(
+            self,
+            directories=replace(self.directories, scratch=os.path.join(self.directories.scratch, "preview")),
+            timelapse_video=replace(
+                self.timelapse_video,
+                # libx264 needs even dimensions
+                max_width=round(self.timelapse_video.max_width * scale / 2) * 2,
+                max_height=round(self.timelapse_video.max_height * scale / 2) * 2,
+                frame_rate=f"{frame_rate.numerator}/{frame_rate.denominator}",
+                font_size=max(8, round(self.timelapse_video.font_size * scale)),
+            ),
+            output_variants=[
+                replace(
+                    variant,
+                    max_width=round(variant.max_width * scale / 2) * 2,
+                    max_height=round(variant.max_height * scale / 2) * 2,
+                )
+                for variant in self.output_variants
+            ],
+            intermediate_encoding=replace(draft_encoding, crf=18),
+            output_encoding=draft_encoding,
+            final_encoding=None,
+            timelapse_options=replace(self.timelapse_options, video_stabilization=False),
+            compiler_options=replace(self.compiler_options, render_mode="fused", preview=True),
+        )
+
+    def get_variant_configuration(self, variant: OutputVariant) -> 'Configuration':
+        """Configuration of a single output variant, rendered like a timelapse_video of its size"""
+        return replace(
+            self,
+            timelapse_video=replace(
+                self.timelapse_video,
+                max_width=variant.max_width,
+                max_height=variant.max_height,
+                instagram_style=variant.instagram_style,
+            ),
+            output_variants=[],
+        )
 
     @staticmethod
     def from_dict(data: dict) -> 'Configuration':
@@ -91,9 +217,13 @@ class Configuration:
             kid_info_data['birthday'] = date.fromisoformat(kid_info_data['birthday'])
         directories_data = data.get('directories', {})
         timelapse_video_data = data.get('timelapse_video', {})
+        intermediate_encoding_data = data.get('intermediate_encoding', {})
+        output_encoding_data = data.get('output_encoding', {})
+        final_encoding_data = data.get('final_encoding')
         timelapse_options_data = data.get('timelapse_options', {})
         timelapse_stabilization_options_data =  data.get('timelapse_stabilization_options', {})
         compiler_options_data = data.get('compiler_options', {})
+        output_variants_data = data.get('output_variants') or []
 
         # yaml to python conversion
         if 'head_tail_ratio' in timelapse_options_data and isinstance(timelapse_options_data['head_tail_ratio'], list):
@@ -106,9 +236,13 @@ class Configuration:
             kid_info=KidInfo(**kid_info_data),
             directories=Directories(**directories_data),
             timelapse_video=TimelapseVideo(**timelapse_video_data),
+            intermediate_encoding=EncodingProfile(**{**asdict(_default_intermediate_encoding()), **intermediate_encoding_data}),
+            output_encoding=EncodingProfile(**output_encoding_data),
+            final_encoding=EncodingProfile(**final_encoding_data) if final_encoding_data else None,
             timelapse_options=TimelapseOptions(**timelapse_options_data),
             timelapse_stabilization_options=TimelapseStabilizationOptions(**timelapse_stabilization_options_data),
             compiler_options=CompilerOptions(**compiler_options_data),
+            output_variants=[OutputVariant(**variant_data) for variant_data in output_variants_data],
         )
 
 def load_configuration(config_path: str = None) -> Configuration:
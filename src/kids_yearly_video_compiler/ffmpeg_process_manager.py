@@ -0,0 +1,215 @@
+import asyncio
+from collections import deque
+import os
+import signal
+import subprocess
+import threading
+from typing import Awaitable, Deque, Dict, List, Optional, TypeVar
+
+from kids_yearly_video_compiler.ffmpeg_progress import (
+    STDERR_TAIL_LINES,
+    FfmpegError,
+    FfmpegProgress,
+    FfmpegProgressParser,
+    create_progress_bar,
+    finish_progress_bar,
+    update_progress_bar,
+    with_progress_arguments,
+)
+
+DEFAULT_STALL_TIMEOUT = 120.0
+# seconds a stopped ffmpeg gets to exit after SIGTERM before it is killed
+TERMINATE_GRACE_SECONDS = 5.0
+
+T = TypeVar("T")
+
+
+class FfmpegStalledError(FfmpegError):
+    def __init__(self, stall_timeout: float, stderr_tail: List[str]):
+        self.stall_timeout = stall_timeout
+        self.return_code = None
+        self.stderr_tail = stderr_tail
+        stderr_output = "\n".join(stderr_tail)
+        RuntimeError.__init__(self, f"FFmpeg made no progress for {stall_timeout:g}s: {stderr_output}")
+
+
+class FfmpegProcessManager:
+    """
+    Runs ffmpeg processes as asyncio tasks
+
+    Any number of run() calls can be awaited concurrently. A job is killed when its
+    progress (frames or output time) doesn't advance for stall_timeout seconds, and a
+    job that fails, stalls or is cancelled kills its ffmpeg process and removes its
+    partial output before the error reaches the caller.
+
+    A service embedding the compiler can run it in a worker thread and stop it from any
+    thread with cancel_all().
+    """
+
+    def __init__(self, stall_timeout: float = DEFAULT_STALL_TIMEOUT):
+        self.stall_timeout = stall_timeout
+        self._running_tasks: Dict[asyncio.Task, asyncio.AbstractEventLoop] = {}
+        self._lock = threading.Lock()
+
+    async def run(
+        self,
+        command: List[str],
+        duration: float = None,
+        description: str = "Processing",
+        position: int = 0,
+        partial_file_path: str = None,
+    ) -> FfmpegProgress:
+        """
+        Run an ffmpeg command with a progress bar
+
+        Args:
+            command: FFmpeg command as list of strings
+            duration: Total duration of processing time in seconds
+            description: Description for progress bar
+            position: Line to draw the progress bar at when several jobs run at once
+            partial_file_path: Output file removed when the job doesn't finish
+
+        Returns:
+            The final progress report, with the frame count, fps and speed of the whole run
+
+        Raises:
+            FfmpegError: if ffmpeg exits with an error, including the last lines it logged
+            FfmpegStalledError: if ffmpeg stopped making progress
+            asyncio.CancelledError: if the job was cancelled
+        """
+        task = asyncio.current_task()
+        with self._lock:
+            self._running_tasks[task] = asyncio.get_running_loop()
+        try:
+            return await self._run(command, duration, description, position, partial_file_path)
+        finally:
+            with self._lock:
+                del self._running_tasks[task]
+
+    async def _run(
+        self,
+        command: List[str],
+        duration: Optional[float],
+        description: str,
+        position: int,
+        partial_file_path: Optional[str],
+    ) -> FfmpegProgress:
+        process = await asyncio.create_subprocess_exec(
+            *with_progress_arguments(command),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        # drain stderr concurrently so a chatty ffmpeg can never block on a full pipe
+        stderr_tail: Deque[str] = deque(maxlen=STDERR_TAIL_LINES)
+        stderr_reader = asyncio.ensure_future(_read_lines(process.stderr, stderr_tail))
+        try:
+            last_progress = await self._read_progress(process, duration, description, position, stderr_tail)
+            return_code = await process.wait()
+            await stderr_reader
+            if return_code != 0:
+                raise FfmpegError(return_code, list(stderr_tail))
+            return last_progress
+        except BaseException:
+            await _stop_process(process)
+            stderr_reader.cancel()
+            if partial_file_path and os.path.exists(partial_file_path):
+                os.remove(partial_file_path)
+            raise
+
+    async def _read_progress(
+        self,
+        process: asyncio.subprocess.Process,
+        duration: Optional[float],
+        description: str,
+        position: int,
+        stderr_tail: Deque[str],
+    ) -> FfmpegProgress:
+        loop = asyncio.get_running_loop()
+        parser = FfmpegProgressParser()
+        last_progress = FfmpegProgress()
+        # ffmpeg writes a progress block every half second even when it is stuck, so a
+        # stall is measured from the last time frames or output time moved forward
+        stall_deadline = loop.time() + self.stall_timeout
+        with create_progress_bar(duration, description, position) as pbar:
+            while True:
+                timeout = max(0.0, stall_deadline - loop.time()) if self.stall_timeout else None
+                try:
+                    line = await asyncio.wait_for(process.stdout.readline(), timeout)
+                except asyncio.TimeoutError:
+                    raise FfmpegStalledError(self.stall_timeout, list(stderr_tail))
+                if not line:
+                    break
+                progress = parser.feed(line.decode(errors="replace"))
+                if progress is None:
+                    continue
+                if progress.frame > last_progress.frame or progress.out_time > last_progress.out_time:
+                    stall_deadline = loop.time() + self.stall_timeout
+                last_progress = progress
+                update_progress_bar(pbar, progress, duration)
+            finish_progress_bar(pbar, duration)
+        return last_progress
+
+    def cancel_all(self) -> None:
+        """Cancel every running job, safe to call from any thread"""
+        with self._lock:
+            running_tasks = list(self._running_tasks.items())
+        for task, loop in running_tasks:
+            loop.call_soon_threadsafe(task.cancel)
+
+
+async def _read_lines(stream: asyncio.StreamReader, lines: Deque[str]) -> None:
+    async for line in stream:
+        lines.append(line.decode(errors="replace").rstrip())
+
+
+async def _stop_process(process: asyncio.subprocess.Process) -> None:
+    if process.returncode is not None:
+        return
+    try:
+        process.terminate()
+        await asyncio.wait_for(process.wait(), TERMINATE_GRACE_SECONDS)
+    except ProcessLookupError:
+        pass
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+def run_cancellable(awaitable: Awaitable[T]) -> T:
+    """
+    Run an awaitable on a new event loop, turning SIGINT into its cancellation
+
+    Cancelling lets every running job kill its ffmpeg process and remove its partial
+    output before KeyboardInterrupt is raised to the caller.
+    """
+    interrupted = False
+
+    async def main() -> T:
+        task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+
+        def interrupt() -> None:
+            nonlocal interrupted
+            interrupted = True
+            task.cancel()
+
+        # signal handlers can only be installed from the main thread, and not on Windows
+        handles_sigint = threading.current_thread() is threading.main_thread()
+        if handles_sigint:
+            try:
+                loop.add_signal_handler(signal.SIGINT, interrupt)
+            except NotImplementedError:
+                handles_sigint = False
+        try:
+            return await awaitable
+        finally:
+            if handles_sigint:
+                loop.remove_signal_handler(signal.SIGINT)
+
+    try:
+        return asyncio.run(main())
+    except asyncio.CancelledError:
+        if interrupted:
+            raise KeyboardInterrupt from None
+        raise
@@ -0,0 +1,109 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from tqdm import tqdm
+
+# number of stderr lines kept to explain a failed ffmpeg run
+STDERR_TAIL_LINES = 40
+
+
+@dataclass
+class FfmpegProgress:
+    frame: int = 0
+    fps: float = 0.0
+    bitrate: str = ""
+    total_size: int = 0
+    out_time: float = 0.0  # seconds of output written so far
+    speed: float = 0.0  # multiple of real time
+    finished: bool = False
+
+
+class FfmpegError(RuntimeError):
+    def __init__(self, return_code: int, stderr_tail: List[str]):
+        self.return_code = return_code
+        self.stderr_tail = stderr_tail
+        stderr_output = "\n".join(stderr_tail)
+        super().__init__(f"FFmpeg failed with return code {return_code}: {stderr_output}")
+
+
+class FfmpegProgressParser:
+    """
+    Incremental parser for the key=value blocks ffmpeg writes with -progress
+
+    Each block ends with a progress=continue or progress=end line, at which point feed()
+    returns the completed snapshot.
+    """
+
+    def __init__(self):
+        self._values: Dict[str, str] = {}
+
+    def feed(self, line: str) -> Optional[FfmpegProgress]:
+        key, separator, value = line.strip().partition("=")
+        if not separator:
+            return None
+        if key != "progress":
+            self._values[key] = value
+            return None
+        values, self._values = self._values, {}
+        return FfmpegProgress(
+            frame=_parse_int(values.get("frame")),
+            fps=_parse_float(values.get("fps")),
+            bitrate=values.get("bitrate", ""),
+            total_size=_parse_int(values.get("total_size")),
+            out_time=_parse_out_time(values),
+            speed=_parse_float(values.get("speed", "").rstrip("x")),
+            finished=value == "end",
+        )
+
+
+def _parse_int(value: Optional[str]) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _parse_float(value: Optional[str]) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _parse_out_time(values: Dict[str, str]) -> float:
+    # out_time_ms is in microseconds as well, older ffmpeg versions only write that one
+    for key in ("out_time_us", "out_time_ms"):
+        if key in values and values[key] not in ("", "N/A"):
+            return max(0.0, _parse_int(values[key]) / 1_000_000)
+    hours, _, rest = values.get("out_time", "").partition(":")
+    minutes, _, seconds = rest.partition(":")
+    return max(0.0, _parse_int(hours) * 3600 + _parse_int(minutes) * 60 + _parse_float(seconds))
+
+
+def with_progress_arguments(command: List[str]) -> List[str]:
+    # progress goes to stdout; the only "-" output the compiler uses is the null muxer,
+    # which never opens it
+    return [command[0], "-hide_banner", "-nostats", "-progress", "pipe:1"] + command[1:]
+
+
+def create_progress_bar(duration: Optional[float], description: str, position: int) -> tqdm:
+    return tqdm(
+        total=duration,
+        desc=description,
+        unit="s",
+        position=position,
+        leave=position == 0,
+        bar_format="{l_bar}{bar}| {n:.1f}/{total:.1f}s [{elapsed}<{remaining}{postfix}]" if duration else None,
+    )
+
+
+def update_progress_bar(pbar: tqdm, progress: FfmpegProgress, duration: Optional[float]) -> None:
+    pbar.n = min(progress.out_time, duration) if duration else progress.out_time
+    pbar.set_postfix(frame=progress.frame, fps=progress.fps, speed=f"{progress.speed}x", refresh=False)
+    pbar.refresh()
+
+
+def finish_progress_bar(pbar: tqdm, duration: Optional[float]) -> None:
+    if duration:
+        pbar.n = duration
+        pbar.refresh()
@@ -0,0 +1,141 @@
+"""
+Filter graphs for the per-clip ffmpeg commands.
+
+A clip's graph is one or more segments, each an input with its own chain of filters,
+concatenated and followed by a shared chain. The compiler describes every filter as a
+step that knows the size, length and dynamic range of its output, so a graph's output
+can be described without probing the encoded file.
+"""
+
+from dataclasses import dataclass, field, replace
+from typing import Callable, List, Sequence
+
+import ffmpeg
+from ffmpeg.nodes import Stream
+
+
+@dataclass(frozen=True)
+class StreamState:
+    width: int
+    height: int
+    frames: float
+    duration: float
+    hdr: bool = False
+
+
+class FilterStep:
+    def apply(self, stream: Stream) -> Stream:
+        raise NotImplementedError
+
+    def get_output_state(self, state: StreamState) -> StreamState:
+        return state
+
+
+@dataclass(frozen=True)
+class Scale(FilterStep):
+    width: int
+    height: int = -1  # -1 keeps the aspect ratio
+
+    def apply(self, stream: Stream) -> Stream:
+        return stream.filter("scale", self.width, self.height)
+
+    def get_output_state(self, state: StreamState) -> StreamState:
+        if self.height > 0:
+            height = self.height
+        else:
+            height = round(state.height * self.width / state.width) if state.width else 0
+        return replace(state, width=self.width, height=height)
+
+
+@dataclass(frozen=True)
+class Crop(FilterStep):
+    width: float
+    height: float
+    x: float
+    y: float
+
+    def apply(self, stream: Stream) -> Stream:
+        return stream.filter("crop", self.width, self.height, self.x, self.y)
+
+    def get_output_state(self, state: StreamState) -> StreamState:
+        # like ffmpeg, the size is rounded down to whole chroma samples of 4:2:0 frames
+        return replace(state, width=int(self.width) & ~1, height=int(self.height) & ~1)
+
+
+@dataclass(frozen=True)
+class SetPts(FilterStep):
+    factor: float
+
+    def apply(self, stream: Stream) -> Stream:
+        return stream.filter("setpts", str(self.factor) + "*PTS")
+
+    def get_output_state(self, state: StreamState) -> StreamState:
+        return replace(state, duration=state.duration * self.factor)
+
+
+@dataclass(frozen=True)
+class PixelFilter(FilterStep):
+    """Filters that compute each output pixel from the same input pixel, like colour conversions"""
+
+    name: str
+    function: Callable[[Stream], Stream] = field(compare=False)
+    # True for filters that convert HDR frames to SDR
+    tonemap: bool = False
+
+    def apply(self, stream: Stream) -> Stream:
+        return self.function(stream)
+
+    def get_output_state(self, state: StreamState) -> StreamState:
+        return replace(state, hdr=False) if self.tonemap else state
+
+
+@dataclass(frozen=True)
+class FrameFilter(FilterStep):
+    """Filters that depend on the frame geometry, like text placed relative to the frame size"""
+
+    name: str
+    function: Callable[[Stream], Stream] = field(compare=False)
+
+    def apply(self, stream: Stream) -> Stream:
+        return self.function(stream)
+
+
+@dataclass
+class Segment:
+    stream: Stream
+    steps: List[FilterStep]
+    state: StreamState  # of the input stream
+
+
+@dataclass
+class FilterGraph:
+    segments: List[Segment]
+    steps: List[FilterStep] = field(default_factory=list)
+
+    def apply(self) -> Stream:
+        streams = [apply_steps(segment.stream, segment.steps) for segment in self.segments]
+        stream = streams[0] if len(streams) == 1 else ffmpeg.concat(*streams)
+        return apply_steps(stream, self.steps)
+
+    def get_output_state(self) -> StreamState:
+        return get_steps_output_state(self.steps, self._get_concat_state())
+
+    def _get_concat_state(self) -> StreamState:
+        states = [get_steps_output_state(segment.steps, segment.state) for segment in self.segments]
+        return replace(
+            states[0],
+            frames=sum(state.frames for state in states),
+            duration=sum(state.duration for state in states),
+        )
+
+
+def apply_steps(stream: Stream, steps: Sequence[FilterStep]) -> Stream:
+    for step in steps:
+        stream = step.apply(stream)
+    return stream
+
+
+def get_steps_output_state(steps: Sequence[FilterStep], state: StreamState) -> StreamState:
+    for step in steps:
+        state = step.get_output_state(state)
+    return state
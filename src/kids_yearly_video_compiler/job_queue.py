@@ -0,0 +1,396 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+import uuid
+
+from tqdm import tqdm
+
+from kids_yearly_video_compiler.ffmpeg_process_manager import FfmpegProcessManager, run_cancellable
+from kids_yearly_video_compiler.job_scheduler import FfmpegJob, JobScheduler, JobSchedulerError, order_longest_first
+from kids_yearly_video_compiler.scratch_cache import CacheEntry, ScratchCache
+
+DEFAULT_LEASE_SECONDS = 60.0
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_POLL_INTERVAL = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch TEXT NOT NULL,
+    description TEXT NOT NULL,
+    command TEXT NOT NULL,
+    duration REAL,
+    output_file_path TEXT,
+    partial_file_path TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires_at REAL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+CREATE INDEX IF NOT EXISTS jobs_batch ON jobs (batch, state);
+"""
+
+
+@dataclass
+class QueuedJob:
+    id: int
+    batch: str
+    description: str
+    command: List[str]
+    duration: float
+    output_file_path: Optional[str]
+    partial_file_path: Optional[str]
+    attempts: int
+
+    def get_cache_entry(self) -> Optional[CacheEntry]:
+        """The scratch cache entry the job writes, None for a job without output file"""
+        if not self.output_file_path or not self.partial_file_path:
+            return None
+        file_name = os.path.basename(self.output_file_path)
+        return CacheEntry(file_name.split(".")[-2], file_name, self.output_file_path, self.partial_file_path)
+
+
+class JobQueue:
+    """
+    SQLite backed queue of ffmpeg jobs shared by a coordinator and any number of workers
+
+    The database lives in the shared scratch directory. Workers claim jobs under a lease
+    that they extend with heartbeats; a job whose lease expires (its worker died or lost
+    the mount) is handed to the next worker, up to max_attempts times. SQLite's default
+    rollback journal is used because WAL mode doesn't work on network file systems.
+    """
+
+    def __init__(self, database_file_path: str, max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.database_file_path = database_file_path
+        self.max_attempts = max_attempts
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # a connection per operation keeps the queue safe to use from several threads
+        connection = sqlite3.connect(self.database_file_path, timeout=60, isolation_level=None)
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def enqueue(self, batch: str, jobs: Sequence[FfmpegJob]) -> None:
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT INTO jobs (batch, description, command, duration, output_file_path, partial_file_path) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        batch,
+                        job.description,
+                        json.dumps(job.command),
+                        job.duration,
+                        job.cache_entry.file_path if job.cache_entry else None,
+                        job.cache_entry.partial_file_path if job.cache_entry else None,
+                    )
+                    for job in jobs
+                ],
+            )
+
+    def claim(self, worker_id: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> Optional[QueuedJob]:
+        now = time.time()
+        with self._transaction() as connection:
+            # jobs whose worker stopped sending heartbeats go back to whoever asks next
+            connection.execute(
+                "UPDATE jobs SET state = 'failed', error = 'lease expired ' || attempts || ' times' "
+                "WHERE state = 'running' AND lease_expires_at < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            row = connection.execute(
+                "SELECT id, batch, description, command, duration, output_file_path, partial_file_path, attempts "
+                "FROM jobs WHERE state = 'pending' OR (state = 'running' AND lease_expires_at < ?) "
+                "ORDER BY id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, lease_owner = ?, lease_expires_at = ? "
+                "WHERE id = ?",
+                (worker_id, now + lease_seconds, row[0]),
+            )
+        return QueuedJob(
+            id=row[0],
+            batch=row[1],
+            description=row[2],
+            command=json.loads(row[3]),
+            duration=row[4],
+            output_file_path=row[5],
+            partial_file_path=row[6],
+            attempts=row[7] + 1,
+        )
+
+    def heartbeat(self, job_id: int, worker_id: str, lease_seconds: float = DEFAULT_LEASE_SECONDS) -> bool:
+        """Extend the lease of a running job, returns False if the worker lost the job"""
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND lease_owner = ? AND state = 'running'",
+                (time.time() + lease_seconds, job_id, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job_id: int, worker_id: str, publish: Callable[[], None] = None) -> bool:
+        """
+        Mark a job done if the worker still holds its lease
+
+        Args:
+            publish: Called while the queue is locked and the lease is confirmed, e.g. to
+                move the output into place, so a worker that lost the job can't publish it
+
+        Returns:
+            False if the worker lost the job, publish isn't called then
+        """
+        with self._transaction() as connection:
+            if not self._holds_lease(connection, job_id, worker_id):
+                return False
+            if publish:
+                publish()
+            connection.execute("UPDATE jobs SET state = 'done', error = NULL WHERE id = ?", (job_id,))
+        return True
+
+    def fail(self, job_id: int, worker_id: str, error: str, discard: Callable[[], None] = None) -> bool:
+        """
+        Put a job back in the queue, or fail it after max_attempts, if the worker still holds its lease
+
+        Args:
+            discard: Called while the queue is locked and the lease is confirmed, e.g. to
+                remove the partial output, so a worker that lost the job can't remove the
+                output of the worker that took it over
+
+        Returns:
+            False if the worker lost the job, discard isn't called then
+        """
+        with self._transaction() as connection:
+            if not self._holds_lease(connection, job_id, worker_id):
+                return False
+            if discard:
+                discard()
+            connection.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "error = ?, lease_owner = NULL, lease_expires_at = NULL WHERE id = ?",
+                (self.max_attempts, error, job_id),
+            )
+        return True
+
+    def _holds_lease(self, connection: sqlite3.Connection, job_id: int, worker_id: str) -> bool:
+        row = connection.execute(
+            "SELECT 1 FROM jobs WHERE id = ? AND state = 'running' AND lease_owner = ?", (job_id, worker_id)
+        ).fetchone()
+        return row is not None
+
+    def release_cancelled(self, job_id: int, worker_id: str, discard: Callable[[], None]) -> bool:
+        """
+        Call discard if the job's batch was cancelled while the worker held its lease
+
+        Returns:
+            False if the job wasn't cancelled under this worker, discard isn't called then
+        """
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT 1 FROM jobs WHERE id = ? AND state = 'cancelled' AND lease_owner = ?", (job_id, worker_id)
+            ).fetchone()
+            if row is None:
+                return False
+            discard()
+        return True
+
+    def cancel(self, batch: str) -> None:
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET state = 'cancelled' WHERE batch = ? AND state IN ('pending', 'running')",
+                (batch,),
+            )
+
+    def get_states(self, batch: str) -> Dict[int, Tuple[str, Optional[str]]]:
+        """Map each job id of the batch to its state and last error"""
+        with self._connect() as connection:
+            rows = connection.execute("SELECT id, state, error FROM jobs WHERE batch = ?", (batch,)).fetchall()
+        return {job_id: (state, error) for job_id, state, error in rows}
+
+    def get_job_ids(self, batch: str) -> List[int]:
+        with self._connect() as connection:
+            rows = connection.execute("SELECT id FROM jobs WHERE batch = ? ORDER BY id", (batch,)).fetchall()
+        return [row[0] for row in rows]
+
+
+class DistributedJobScheduler(JobScheduler):
+    """
+    Runs a stage's jobs on `kyvc worker` processes through a JobQueue instead of locally
+
+    plan() still splits the per-node cpu budget, so every worker node should have a
+    similar core count to the one configured.
+    """
+
+    def __init__(
+        self,
+        job_queue: JobQueue,
+        cpu_budget: int = 0,
+        max_jobs: int = 0,
+        poll_interval: float = DEFAULT_POLL_INTERVAL,
+    ):
+        super().__init__(cpu_budget, max_jobs)
+        self.job_queue = job_queue
+        self.poll_interval = poll_interval
+
+    def run(
+        self,
+        jobs: Sequence[FfmpegJob],
+        run_job: Callable[[FfmpegJob, int], None],
+        on_job_done: Callable[[FfmpegJob], None] = None,
+    ) -> None:
+        if not jobs:
+            return
+        batch = uuid.uuid4().hex
+        # workers claim jobs in id order, so the queue hands out the longest jobs first
+        jobs = order_longest_first(jobs)
+        self.job_queue.enqueue(batch, jobs)
+        jobs_by_id = dict(zip(self.job_queue.get_job_ids(batch), jobs))
+        print(f"queued {len(jobs)} jobs in {self.job_queue.database_file_path}, waiting for workers")
+
+        finished_job_ids = set()
+        failures: List[Tuple[FfmpegJob, BaseException]] = []
+        try:
+            while len(finished_job_ids) < len(jobs_by_id):
+                for job_id, (state, error) in self.job_queue.get_states(batch).items():
+                    if job_id in finished_job_ids or state not in ("done", "failed", "cancelled"):
+                        continue
+                    finished_job_ids.add(job_id)
+                    if state == "done":
+                        if on_job_done:
+                            on_job_done(jobs_by_id[job_id])
+                    else:
+                        failures.append((jobs_by_id[job_id], RuntimeError(error or state)))
+                if len(finished_job_ids) < len(jobs_by_id):
+                    time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            self.job_queue.cancel(batch)
+            raise
+
+        if failures:
+            raise JobSchedulerError(failures)
+
+
+def get_job_queue_file_path(scratch_directory: str) -> str:
+    return os.path.join(scratch_directory, "job-queue.sqlite")
+
+
+def get_default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def run_worker(
+    job_queue: JobQueue,
+    worker_id: str = None,
+    lease_seconds: float = DEFAULT_LEASE_SECONDS,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+    exit_when_idle: bool = False,
+    process_manager: FfmpegProcessManager = None,
+) -> int:
+    """
+    Claim and run jobs from the queue until interrupted
+
+    A job whose lease can't be extended any more may already run on another worker, so
+    its ffmpeg process is stopped and its output left to that worker. The partial output of
+    a job whose batch was cancelled is removed.
+
+    Args:
+        job_queue: Queue shared with the coordinator
+        worker_id: Name of this worker in the job leases
+        lease_seconds: How long a claimed job stays ours without a heartbeat
+        poll_interval: Seconds to wait when the queue is empty
+        exit_when_idle: Return once the queue has no job left to claim
+        process_manager: Runs the ffmpeg commands, with the default stall timeout when None
+
+    Returns:
+        The number of jobs this worker completed
+    """
+    worker_id = worker_id or get_default_worker_id()
+    process_manager = process_manager or FfmpegProcessManager()
+    # the queue lives in the shared scratch directory, next to the entries its jobs write
+    scratch_cache = ScratchCache(os.path.dirname(job_queue.database_file_path))
+    completed_jobs = 0
+    print(f"worker {worker_id} waiting for jobs in {job_queue.database_file_path}")
+    while True:
+        queued_job = job_queue.claim(worker_id, lease_seconds)
+        if queued_job is None:
+            if exit_when_idle:
+                return completed_jobs
+            time.sleep(poll_interval)
+            continue
+
+        stop_heartbeat = threading.Event()
+        lease_lost = threading.Event()
+
+        def heartbeat():
+            while not stop_heartbeat.wait(lease_seconds / 3):
+                if not job_queue.heartbeat(queued_job.id, worker_id, lease_seconds):
+                    lease_lost.set()
+                    process_manager.cancel_all()
+                    return
+
+        cache_entry = queued_job.get_cache_entry()
+
+        def publish():
+            if cache_entry:
+                scratch_cache.commit(cache_entry)
+
+        def discard():
+            if cache_entry:
+                scratch_cache.discard(cache_entry)
+
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            # a worker that lost this job earlier may still write to the old file, a new one is
+            # created so its writes can't end up in ours
+            discard()
+            # the partial output is only removed while the lease is confirmed, not by the process manager
+            run_cancellable(process_manager.run(queued_job.command, queued_job.duration, queued_job.description))
+        except BaseException as e:
+            if lease_lost.is_set():
+                if job_queue.release_cancelled(queued_job.id, worker_id, discard):
+                    tqdm.write(f"{queued_job.description} stopped: its batch was cancelled")
+                else:
+                    tqdm.write(f"{queued_job.description} stopped: the lease was lost to another worker")
+                continue
+            if not isinstance(e, Exception):
+                job_queue.fail(queued_job.id, worker_id, "worker interrupted", discard)
+                raise
+            tqdm.write(f"{queued_job.description} failed (attempt {queued_job.attempts}): {e}")
+            job_queue.fail(queued_job.id, worker_id, str(e), discard)
+        else:
+            if job_queue.complete(queued_job.id, worker_id, publish):
+                completed_jobs += 1
+            elif job_queue.release_cancelled(queued_job.id, worker_id, discard):
+                tqdm.write(f"{queued_job.description} finished after its batch was cancelled, its output is discarded")
+            else:
+                # the worker that took the job over writes the same partial file, it is left to it
+                tqdm.write(f"{queued_job.description} finished after its lease was lost, its output is discarded")
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
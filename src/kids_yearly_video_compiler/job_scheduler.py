@@ -0,0 +1,126 @@
+import asyncio
+from dataclasses import dataclass
+import os
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple, Union
+
+from kids_yearly_video_compiler.ffmpeg_process_manager import run_cancellable
+from kids_yearly_video_compiler.scratch_cache import CacheEntry
+
+# below this many threads per job x264 and the filter graph stop scaling well enough
+# to be worth running fewer, wider jobs
+MIN_THREADS_PER_JOB = 2
+
+
+@dataclass
+class FfmpegJob:
+    command: List[str]
+    duration: float
+    description: str
+    cache_entry: Optional[CacheEntry] = None
+    threads: int = 0  # threads the command was built with, 0 if it isn't limited
+    # cost model inputs and estimate, see render_planner.CostModel
+    stage_key: str = ""
+    cost_units: float = 0.0
+    estimated_seconds: float = 0.0
+
+
+def order_longest_first(jobs: Sequence[FfmpegJob]) -> List[FfmpegJob]:
+    """
+    Start the most expensive jobs first so a long clip doesn't begin last and run alone
+    while the other slots sit idle; ties keep their original order
+    """
+    return sorted(jobs, key=lambda job: job.estimated_seconds, reverse=True)
+
+
+class JobSchedulerError(RuntimeError):
+    def __init__(self, failures: List[Tuple[FfmpegJob, BaseException]]):
+        self.failures = failures
+        messages = "\n".join(f"\t{job.description}: {error}" for job, error in failures)
+        super().__init__(f"{len(failures)} ffmpeg jobs failed:\n{messages}")
+
+
+class JobScheduler:
+    """Runs independent ffmpeg jobs concurrently on an event loop within a fixed cpu budget"""
+
+    def __init__(self, cpu_budget: int = 0, max_jobs: int = 0):
+        self.cpu_budget = cpu_budget or os.cpu_count() or 1
+        self.max_jobs = max_jobs
+
+    def plan(self, job_count: int) -> Tuple[int, int]:
+        """
+        Split the cpu budget between concurrent jobs and threads per job
+
+        Args:
+            job_count: Number of jobs that are ready to run
+
+        Returns:
+            The number of concurrent jobs and the threads each job may use
+        """
+        concurrent_jobs = self.max_jobs or self.cpu_budget // MIN_THREADS_PER_JOB
+        concurrent_jobs = max(1, min(concurrent_jobs, job_count, self.cpu_budget))
+        return concurrent_jobs, max(1, self.cpu_budget // concurrent_jobs)
+
+    def run(
+        self,
+        jobs: Sequence[FfmpegJob],
+        run_job: Callable[[FfmpegJob, int], Union[None, Awaitable[None]]],
+        on_job_done: Callable[[FfmpegJob], None] = None,
+    ) -> None:
+        """
+        Run all jobs on a new event loop, see run_async()
+
+        Raises:
+            JobSchedulerError: after every job finished, if any of them failed
+            KeyboardInterrupt: on SIGINT, once the running jobs were cancelled
+        """
+        run_cancellable(self.run_async(jobs, run_job, on_job_done))
+
+    async def run_async(
+        self,
+        jobs: Sequence[FfmpegJob],
+        run_job: Callable[[FfmpegJob, int], Union[None, Awaitable[None]]],
+        on_job_done: Callable[[FfmpegJob], None] = None,
+    ) -> None:
+        """
+        Run all jobs longest first, at most plan(len(jobs)) at a time
+
+        Args:
+            jobs: Jobs to run
+            run_job: Runs a single job; receives the job and the progress bar position to draw at.
+                Coroutine functions are awaited, plain functions run on the loop's thread pool
+            on_job_done: Called on the event loop after each successful job
+
+        Raises:
+            JobSchedulerError: after every job finished, if any of them failed
+        """
+        if not jobs:
+            return
+        concurrent_jobs, _ = self.plan(len(jobs))
+
+        # position 0 is left for the caller's overall progress bar
+        positions: "asyncio.Queue[int]" = asyncio.Queue()
+        for position in range(1, concurrent_jobs + 1):
+            positions.put_nowait(position)
+
+        failures: List[Tuple[FfmpegJob, BaseException]] = []
+
+        async def run_at_free_position(job: FfmpegJob) -> None:
+            position = await positions.get()
+            try:
+                if asyncio.iscoroutinefunction(run_job):
+                    await run_job(job, position)
+                else:
+                    await asyncio.get_running_loop().run_in_executor(None, run_job, job, position)
+            except Exception as error:
+                failures.append((job, error))
+            else:
+                if on_job_done:
+                    on_job_done(job)
+            finally:
+                positions.put_nowait(position)
+
+        # waiting for a position is first come first served, so jobs start in this order
+        await asyncio.gather(*(run_at_free_position(job) for job in order_longest_first(jobs)))
+
+        if failures:
+            raise JobSchedulerError(failures)
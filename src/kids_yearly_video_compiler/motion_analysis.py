@@ -0,0 +1,62 @@
+"""Helpers for the vid.stab motion data (.trf) files written by ffmpeg's vidstabdetect."""
+
+import functools
+import re
+import subprocess
+from typing import Dict
+
+FRAME_LINE_PATTERN = re.compile(r"^Frame (\d+) \(")
+
+
+@functools.lru_cache(maxsize=None)
+def get_vidstabdetect_format_options() -> Dict[str, str]:
+    """
+    Options that make vidstabdetect write the ascii format windows are cut from
+
+    vid.stab 1.1 writes binary files by default, and the ffmpeg builds linked against it
+    take a fileformat option. Older builds only write ascii and reject the option.
+    """
+    try:
+        process = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-h", "filter=vidstabdetect"],
+            capture_output=True,
+            universal_newlines=True,
+            timeout=30,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return {}
+    return {"fileformat": "ascii"} if "fileformat" in process.stdout else {}
+
+
+def write_motion_data_window(motion_data_file_path: str, window_file_path: str, first_frame: int) -> None:
+    """
+    Write the motion data of a source clip starting at first_frame as a standalone file
+
+    vidstabtransform applies the transforms of a .trf file to the frames it receives in
+    order, starting with the first entry. A clip segment that starts part way through the
+    source therefore needs a file whose first entry is the segment's first frame.
+
+    Args:
+        motion_data_file_path: Motion data of the whole source clip (vid.stab ascii format)
+        window_file_path: File to write the window to, ScratchCache.write moves it in place
+        first_frame: Zero based index of the first source frame of the segment
+    """
+    with open(motion_data_file_path, "r", errors="replace") as f:
+        lines = f.readlines()
+    if not lines or not lines[0].startswith("VID.STAB"):
+        raise ValueError(f"{motion_data_file_path} is not a vid.stab ascii motion data file")
+
+    window_lines = []
+    for line in lines:
+        frame_match = FRAME_LINE_PATTERN.match(line)
+        if not frame_match:
+            # version header and detection parameter comments
+            window_lines.append(line)
+            continue
+        # vid.stab numbers its frames from 1
+        frame_number = int(frame_match.group(1)) - first_frame
+        if frame_number >= 1:
+            window_lines.append(f"Frame {frame_number} (" + line[frame_match.end():])
+
+    with open(window_file_path, "w") as f:
+        f.writelines(window_lines)
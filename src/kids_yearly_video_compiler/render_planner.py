@@ -0,0 +1,160 @@
+from dataclasses import dataclass, field
+import heapq
+import json
+import os
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+# samples kept per stage for calibration, older ones are dropped
+MAX_SAMPLES_PER_STAGE = 200
+
+# cpu seconds per (second of decoded source x megapixel) before any run has been timed;
+# calibration from real runs replaces these as soon as a stage has samples
+DEFAULT_COEFFICIENTS = {
+    "stabilized-data/sdr": 0.15,
+    "stabilized-data/hdr": 0.2,
+    "head-tail-algorithm/sdr": 0.1,
+    "head-tail-algorithm/hdr": 0.12,
+    "stabilized/sdr": 0.25,
+    "stabilized/hdr": 0.3,
+    "video-filters/sdr": 0.1,
+    "video-filters/hdr": 0.6,
+    "compiled/sdr": 0.3,
+    "compiled/hdr": 0.8,
+    "shared/sdr": 0.25,
+    "shared/hdr": 0.7,
+    "normalized/sdr": 0.1,
+    "normalized/hdr": 0.1,
+    "save/sdr": 0.002,
+}
+FALLBACK_COEFFICIENT = 0.3
+
+
+class CostModel:
+    """
+    Estimates the cost of an ffmpeg job from the source seconds it decodes and their resolution
+
+    Cost units are decoded seconds x megapixels. Each stage (split into SDR and HDR clips,
+    since tonemapping dominates HDR filter cost) has a coefficient of cpu seconds per unit,
+    calibrated from the timings of past runs stored next to the scratch files.
+    """
+
+    def __init__(self, timings_file_path: str = None):
+        self.timings_file_path = timings_file_path
+        self._samples: Dict[str, List[Tuple[float, float]]] = {}
+        self._lock = threading.Lock()
+        if timings_file_path and os.path.isfile(timings_file_path):
+            try:
+                with open(timings_file_path, "r") as f:
+                    self._samples = {
+                        stage_key: [tuple(sample) for sample in samples]
+                        for stage_key, samples in json.load(f).items()
+                    }
+            except (ValueError, TypeError) as e:
+                print(f"ignoring unreadable render timings {timings_file_path}: {e}")
+
+    @staticmethod
+    def get_stage_key(stage: str, hdr: bool) -> str:
+        return f"{stage}/{'hdr' if hdr else 'sdr'}"
+
+    @staticmethod
+    def get_units(decoded_duration: float, width: int, height: int) -> float:
+        return decoded_duration * width * height / 1_000_000
+
+    def get_coefficient(self, stage_key: str) -> float:
+        with self._lock:
+            samples = self._samples.get(stage_key)
+            if samples:
+                total_units = sum(units for units, _ in samples)
+                if total_units > 0:
+                    return sum(cpu_seconds for _, cpu_seconds in samples) / total_units
+        return DEFAULT_COEFFICIENTS.get(stage_key, FALLBACK_COEFFICIENT)
+
+    def estimate(self, stage_key: str, units: float, threads: int = 1) -> float:
+        """Estimated wall clock seconds of a job running with the given number of threads"""
+        return self.get_coefficient(stage_key) * units / max(1, threads)
+
+    def record(self, stage_key: str, units: float, seconds: float, threads: int = 1) -> None:
+        if units <= 0:
+            return
+        with self._lock:
+            samples = self._samples.setdefault(stage_key, [])
+            samples.append((units, seconds * max(1, threads)))
+            del samples[:-MAX_SAMPLES_PER_STAGE]
+
+    def save(self) -> None:
+        if not self.timings_file_path:
+            return
+        with self._lock:
+            partial_file_path = f"{self.timings_file_path}.partial"
+            with open(partial_file_path, "w") as f:
+                json.dump(self._samples, f)
+            os.replace(partial_file_path, self.timings_file_path)
+
+
+@dataclass
+class PlannedJob:
+    base_name: str
+    estimated_seconds: float
+    cached: bool = False
+
+
+@dataclass
+class PlannedStage:
+    name: str
+    concurrent_jobs: int = 1
+    jobs: List[PlannedJob] = field(default_factory=list)
+
+    def get_pending_jobs(self) -> List[PlannedJob]:
+        return [job for job in self.jobs if not job.cached]
+
+
+def get_makespan(durations: Sequence[float], slots: int) -> float:
+    """Wall clock time of running durations longest first on a number of parallel slots"""
+    if not durations:
+        return 0.0
+    finish_times = [0.0] * max(1, slots)
+    for duration in sorted(durations, reverse=True):
+        heapq.heapreplace(finish_times, finish_times[0] + duration)
+    return max(finish_times)
+
+
+@dataclass
+class RenderPlan:
+    stages: List[PlannedStage] = field(default_factory=list)
+
+    def get_critical_path(self) -> List[Tuple[str, PlannedJob]]:
+        """
+        Stages start once the previous one finished, so the longest chain through the job
+        graph runs through the longest pending job of every stage
+        """
+        critical_path = []
+        for stage in self.stages:
+            pending_jobs = stage.get_pending_jobs()
+            if pending_jobs:
+                critical_path.append((stage.name, max(pending_jobs, key=lambda job: job.estimated_seconds)))
+        return critical_path
+
+    def get_eta(self) -> float:
+        return sum(
+            get_makespan([job.estimated_seconds for job in stage.get_pending_jobs()], stage.concurrent_jobs)
+            for stage in self.stages
+        )
+
+    def print_plan(self) -> None:
+        print("render plan:")
+        for stage in self.stages:
+            pending_jobs = stage.get_pending_jobs()
+            print(
+                f"\t{stage.name}: {len(pending_jobs)} of {len(stage.jobs)} jobs to run, "
+                f"{sum(job.estimated_seconds for job in pending_jobs):.1f}s of work "
+                f"on {stage.concurrent_jobs} concurrent jobs"
+            )
+            for job in sorted(pending_jobs, key=lambda job: job.estimated_seconds, reverse=True):
+                print(f"\t\t{job.estimated_seconds:8.1f}s  {job.base_name}")
+        critical_path = self.get_critical_path()
+        print("critical path:")
+        for stage_name, job in critical_path:
+            print(f"\t{stage_name}: {job.base_name} ({job.estimated_seconds:.1f}s)")
+        print(f"\tlength: {sum(job.estimated_seconds for _, job in critical_path):.1f}s")
+        print(f"estimated time to finish: {self.get_eta() / 60:.1f} minutes")
@@ -0,0 +1,157 @@
+from dataclasses import dataclass
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Callable, Dict, List, Set
+import uuid
+
+# stands in for the output file path while the cache key of a command is computed
+OUTPUT_FILE_PLACEHOLDER = "__kyvc_output__"
+
+KEY_LENGTH = 16
+ENTRY_FILE_NAME_PATTERN = re.compile(r"^.+\.[0-9a-f]{%d}\.[^.]+$" % KEY_LENGTH)
+
+
+@dataclass
+class CacheEntry:
+    key: str
+    file_name: str
+    file_path: str
+    partial_file_path: str
+
+
+class ScratchCache:
+    """
+    Content addressed store for the files written to the scratch directory
+
+    Every entry is named after a hash of the ffmpeg command that produces it (with the
+    output path replaced by OUTPUT_FILE_PLACEHOLDER) and the identity of its inputs, so
+    a change to any transform parameter or input file lands on a new entry. Entries are
+    written to a partial file and renamed once ffmpeg succeeds, so an interrupted run
+    never leaves a truncated entry behind. When max_size is set, the least recently
+    used entries are evicted to keep the scratch directory under budget.
+    """
+
+    def __init__(self, directory: str, max_size: int = 0):
+        self.directory = directory
+        self.max_size = max_size
+        # entries used by this run are never evicted by it
+        self._pinned_file_paths: Set[str] = set()
+        # one lock per entry written by write(), for compilers sharing the cache across threads
+        self._entry_locks: Dict[str, threading.Lock] = {}
+        self._entry_locks_lock = threading.Lock()
+
+    def get_entry(self, name: str, extension: str, command: List[str]) -> CacheEntry:
+        """
+        Args:
+            name: Readable prefix of the entry file name, e.g. "{base_name}-{transform_name}"
+            extension: File extension of the entry, which also selects the ffmpeg muxer
+            command: FFmpeg command writing to OUTPUT_FILE_PLACEHOLDER
+        """
+        key = self.get_key(command)
+        file_name = f"{name}.{key}.{extension}"
+        return CacheEntry(
+            key=key,
+            file_name=file_name,
+            file_path=os.path.join(self.directory, file_name),
+            partial_file_path=os.path.join(self.directory, f"{name}.{key}.partial.{extension}"),
+        )
+
+    def get_key(self, command: List[str]) -> str:
+        input_identities = [
+            self._get_input_identity(command[index + 1])
+            for index, argument in enumerate(command[:-1])
+            if argument == "-i"
+        ]
+        fingerprint = json.dumps({"command": command, "inputs": input_identities})
+        return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:KEY_LENGTH]
+
+    def _get_input_identity(self, file_path: str) -> list:
+        if self._is_entry(file_path):
+            # entry names already carry the hash of everything that produced them
+            return [os.path.basename(file_path)]
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return [os.path.abspath(file_path)]
+        return [os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns]
+
+    def _is_entry(self, file_path: str) -> bool:
+        return (
+            os.path.abspath(os.path.dirname(file_path)) == os.path.abspath(self.directory)
+            and ENTRY_FILE_NAME_PATTERN.match(os.path.basename(file_path)) is not None
+            and ".partial." not in os.path.basename(file_path)
+        )
+
+    def is_cached(self, entry: CacheEntry) -> bool:
+        if not os.path.isfile(entry.file_path):
+            return False
+        self._pinned_file_paths.add(entry.file_path)
+        # the modification time doubles as the last use time for eviction
+        os.utime(entry.file_path)
+        return True
+
+    def pin(self, entry: CacheEntry) -> None:
+        """Protect an entry written by someone else, e.g. a distributed worker, from this run's eviction"""
+        self._pinned_file_paths.add(entry.file_path)
+
+    def prepare(self, entry: CacheEntry) -> None:
+        # a previous run may have been killed while writing this entry
+        if os.path.exists(entry.partial_file_path):
+            os.remove(entry.partial_file_path)
+
+    def commit(self, entry: CacheEntry) -> None:
+        os.replace(entry.partial_file_path, entry.file_path)
+        self._pinned_file_paths.add(entry.file_path)
+
+    def write(self, entry: CacheEntry, write_file: Callable[[str], None]) -> None:
+        """
+        Write an entry produced outside the job set, like a tonemap LUT or a motion data window
+
+        Threads sharing this cache write each entry once, the others wait for it and find it
+        cached. The file is written under a partial name of its own, so processes sharing the
+        scratch directory never remove or rename each other's partial files.
+
+        Args:
+            write_file: Writes the entry to the file path it is given
+        """
+        with self._entry_locks_lock:
+            entry_lock = self._entry_locks.setdefault(entry.file_path, threading.Lock())
+        with entry_lock:
+            if self.is_cached(entry):
+                return
+            partial_root, extension = os.path.splitext(entry.partial_file_path)
+            partial_file_path = f"{partial_root}.{uuid.uuid4().hex[:8]}{extension}"
+            try:
+                write_file(partial_file_path)
+                os.replace(partial_file_path, entry.file_path)
+            except BaseException:
+                if os.path.exists(partial_file_path):
+                    os.remove(partial_file_path)
+                raise
+            self._pinned_file_paths.add(entry.file_path)
+
+    def discard(self, entry: CacheEntry) -> None:
+        if os.path.exists(entry.partial_file_path):
+            os.remove(entry.partial_file_path)
+
+    def evict(self) -> None:
+        if not self.max_size:
+            return
+        entries = []
+        for dir_entry in os.scandir(self.directory):
+            if dir_entry.is_file() and self._is_entry(dir_entry.path):
+                stat = dir_entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, file_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if file_path in self._pinned_file_paths:
+                continue
+            os.remove(file_path)
+            total_size -= size
+        if total_size > self.max_size:
+            print(f"scratch cache is {total_size} bytes, over its {self.max_size} byte budget, with files this run needs")
@@ -0,0 +1,299 @@
+"""
+Encoder tuning for the Kids Yearly Video Compiler.
+
+Short windows of a sample of the real clips are encoded at every combination of preset,
+CRF and thread count. Each combination is timed and scored with ffmpeg's SSIM and PSNR
+filters against a lossless reference of the same window, and the chosen profile is
+written back into the configuration file.
+"""
+
+from dataclasses import dataclass
+import os
+import re
+import shutil
+import subprocess
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import ffmpeg
+
+from kids_yearly_video_compiler.configuration import Configuration, EncodingProfile
+from kids_yearly_video_compiler.ffmpeg_progress import STDERR_TAIL_LINES, FfmpegError
+from kids_yearly_video_compiler.job_scheduler import JobScheduler
+from kids_yearly_video_compiler.video_collection import VideoCollection
+from kids_yearly_video_compiler.video_inspector import VideoInfo
+from kids_yearly_video_compiler.video_quality import measure_quality
+
+DEFAULT_PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow")
+DEFAULT_CRFS = (18.0, 20.0, 23.0, 26.0)
+DEFAULT_THREADS = (0,)
+DEFAULT_SAMPLES = 4
+DEFAULT_WINDOW_SECONDS = 4.0
+DEFAULT_MIN_SSIM = 0.97
+
+
+@dataclass
+class TuneCandidate:
+    preset: str
+    crf: float
+    threads: int = 0
+
+    def get_encoding_profile(self, encoding: EncodingProfile) -> EncodingProfile:
+        return EncodingProfile(
+            codec=encoding.codec,
+            preset=self.preset,
+            crf=self.crf,
+            threads=self.threads,
+            pix_fmt=encoding.pix_fmt,
+            options=dict(encoding.options),
+        )
+
+
+@dataclass
+class TuneResult:
+    candidate: TuneCandidate
+    seconds_per_second: float  # wall clock encode seconds per second of video
+    ssim: float  # lowest of the samples
+    psnr: float  # lowest of the samples
+
+
+def get_candidates(
+    presets: Sequence[str] = DEFAULT_PRESETS,
+    crfs: Sequence[float] = DEFAULT_CRFS,
+    threads: Sequence[int] = DEFAULT_THREADS,
+) -> List[TuneCandidate]:
+    return [TuneCandidate(preset, crf, thread_count) for preset in presets for crf in crfs for thread_count in threads]
+
+
+def sample_videos(video_collection: VideoCollection, samples: int) -> List[VideoInfo]:
+    """Clips spread evenly over the year, so the sample covers every age and lighting"""
+    videos = video_collection.sorted_by_date()
+    if samples >= len(videos):
+        return list(videos)
+    return [videos[index * len(videos) // samples] for index in range(samples)]
+
+
+def select_fastest(results: Sequence[TuneResult], min_ssim: float) -> Optional[TuneResult]:
+    """The fastest result whose every sample scored at least min_ssim"""
+    passing = [result for result in results if result.ssim >= min_ssim]
+    return min(passing, key=lambda result: (result.seconds_per_second, -result.ssim), default=None)
+
+
+def select_best_quality(
+    results: Sequence[TuneResult], time_budget: float, encoded_seconds: float, concurrent_jobs: int = 1
+) -> Optional[TuneResult]:
+    """
+    The best scoring result that encodes encoded_seconds of video within time_budget seconds
+
+    Args:
+        concurrent_jobs: Encodes the render runs at once, each as fast as a measured one
+    """
+    fitting = [
+        result for result in results if result.seconds_per_second * encoded_seconds / concurrent_jobs <= time_budget
+    ]
+    return max(fitting, key=lambda result: (result.ssim, -result.seconds_per_second), default=None)
+
+
+def update_encoding_profile(yaml_text: str, section: str, values: Dict[str, object]) -> str:
+    """
+    Set keys of a top level section in a configuration file, keeping its comments and layout
+
+    Missing keys are added at the end of the section, and a missing section at the end of the file.
+    """
+    lines = yaml_text.splitlines()
+    start = next((index for index, line in enumerate(lines) if re.match(rf"{re.escape(section)}:\s*(#.*)?$", line)), None)
+    if start is None:
+        lines.append(f"{section}:")
+        start = len(lines) - 1
+    end = start + 1
+    while end < len(lines) and (not lines[end].strip() or lines[end].startswith((" ", "\t"))):
+        end += 1
+    # trailing blank lines belong to whatever follows the section
+    while end > start + 1 and not lines[end - 1].strip():
+        end -= 1
+
+    indent = "  "
+    remaining = dict(values)
+    for index in range(start + 1, end):
+        match = re.match(r"(\s+)([A-Za-z_]+):(\s*)([^#]*?)(\s*#.*)?$", lines[index])
+        if not match:
+            continue
+        indent = match.group(1)
+        key = match.group(2)
+        if key in remaining:
+            lines[index] = f"{indent}{key}: {remaining.pop(key)}{match.group(5) or ''}"
+    lines[end:end] = [f"{indent}{key}: {value}" for key, value in remaining.items()]
+    return "\n".join(lines) + "\n"
+
+
+def is_encoding_used(config: Configuration, section: str) -> bool:
+    """Whether any stage of the render encodes with a profile"""
+    if section == "intermediate_encoding":
+        # the staged render's intermediate clips and the shared clips of the output variants
+        return config.compiler_options.render_mode == "staged" or bool(config.output_variants)
+    return True
+
+
+def plan_encodes(config: Configuration, section: str, video_collection: VideoCollection) -> Tuple[int, int]:
+    """
+    The concurrent jobs and threads per job the render runs the encodes of a profile with
+
+    Every stage encoding with the output or the intermediate profile runs one job per clip,
+    the save step joins the clips with a stream copy.
+    """
+    job_scheduler = JobScheduler(config.compiler_options.cpu_budget, config.compiler_options.parallel_jobs)
+    return job_scheduler.plan(video_collection.size())
+
+
+def write_encoding_profile(config_path: str, section: str, candidate: TuneCandidate) -> None:
+    with open(config_path, "r") as f:
+        yaml_text = f.read()
+    yaml_text = update_encoding_profile(
+        yaml_text, section, {"preset": candidate.preset, "crf": f"{candidate.crf:g}", "threads": candidate.threads}
+    )
+    partial_file_path = f"{config_path}.partial"
+    with open(partial_file_path, "w") as f:
+        f.write(yaml_text)
+    os.replace(partial_file_path, config_path)
+
+
+class EncoderTuner:
+    def __init__(
+        self, config: Configuration, encoding: EncodingProfile, work_directory: str, threads_per_job: int = 0
+    ):
+        self.config = config
+        self.encoding = encoding
+        self.work_directory = work_directory
+        # used by candidates that leave the thread count to the job scheduler, like the render does
+        self.threads_per_job = threads_per_job
+
+    def run(self, videos: Sequence[VideoInfo], window_seconds: float, candidates: Sequence[TuneCandidate]) -> List[TuneResult]:
+        """
+        Returns:
+            One result per candidate, measured over every sampled window
+        """
+        os.makedirs(self.work_directory, exist_ok=True)
+        try:
+            references = [self._write_reference(index, video, window_seconds) for index, video in enumerate(videos)]
+            results = []
+            for candidate in candidates:
+                result = self._measure(candidate, references)
+                results.append(result)
+                print(
+                    f"\tpreset {candidate.preset:<9} crf {candidate.crf:>4g} threads {candidate.threads:>2}: "
+                    f"{result.seconds_per_second:6.3f}s per second, ssim {result.ssim:.4f}, psnr {result.psnr:.2f}dB"
+                )
+            return results
+        finally:
+            shutil.rmtree(self.work_directory, ignore_errors=True)
+
+    def _write_reference(self, index: int, video: VideoInfo, window_seconds: float) -> Tuple[str, float]:
+        """Losslessly encoded window from the middle of a clip, at the size and rate of the timelapse"""
+        window_seconds = min(window_seconds, video.duration)
+        start = max(0.0, (video.duration - window_seconds) / 2)
+        reference_file_path = os.path.join(self.work_directory, f"reference-{index}.mkv")
+        stream = ffmpeg.input(video.file_path, ss=start, t=window_seconds).filter(
+            "scale",
+            self.config.timelapse_video.max_width,
+            self.config.timelapse_video.max_height,
+            force_original_aspect_ratio="decrease",
+            force_divisible_by=2,
+        )
+        stream = stream.filter("format", "yuv420p")
+        command = stream.output(
+            reference_file_path, r=self.config.timelapse_video.frame_rate, vcodec="libx264", preset="ultrafast", qp=0
+        ).overwrite_output().compile()
+        _run_ffmpeg(command)
+        return reference_file_path, window_seconds
+
+    def _measure(self, candidate: TuneCandidate, references: Sequence[Tuple[str, float]]) -> TuneResult:
+        output_options = candidate.get_encoding_profile(self.encoding).get_output_options()
+        if self.threads_per_job and "threads" not in output_options:
+            output_options["threads"] = self.threads_per_job
+        encode_seconds, video_seconds = 0.0, 0.0
+        ssims, psnrs = [], []
+        for index, (reference_file_path, reference_seconds) in enumerate(references):
+            output_file_path = os.path.join(self.work_directory, f"candidate-{index}.mp4")
+            command = ffmpeg.input(reference_file_path).output(output_file_path, **output_options).overwrite_output().compile()
+            start = time.perf_counter()
+            _run_ffmpeg(command)
+            encode_seconds += time.perf_counter() - start
+            video_seconds += reference_seconds
+            metrics = measure_quality(reference_file_path, output_file_path)
+            ssims.append(metrics.ssim)
+            psnrs.append(metrics.psnr)
+            os.remove(output_file_path)
+        return TuneResult(candidate, encode_seconds / max(video_seconds, 1e-9), min(ssims), min(psnrs))
+
+
+def _run_ffmpeg(command: List[str]) -> None:
+    process = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True, universal_newlines=True)
+    if process.returncode != 0:
+        raise FfmpegError(process.returncode, process.stderr.splitlines()[-STDERR_TAIL_LINES:])
+
+
+def tune(
+    config: Configuration,
+    video_collection: VideoCollection,
+    config_path: Optional[str] = None,
+    section: str = "output_encoding",
+    samples: int = DEFAULT_SAMPLES,
+    window_seconds: float = DEFAULT_WINDOW_SECONDS,
+    candidates: Sequence[TuneCandidate] = None,
+    min_ssim: float = DEFAULT_MIN_SSIM,
+    time_budget: Optional[float] = None,
+) -> Optional[TuneResult]:
+    """
+    Pick an encoding profile for a collection and write it into the configuration file
+
+    Without a time budget the fastest profile meeting min_ssim is picked. With one, the best
+    scoring profile whose estimated encode of the whole timelapse fits the budget is.
+
+    Args:
+        config: Configuration of the collection
+        video_collection: Clips to sample from
+        config_path: Configuration file to update, None only prints the result
+        section: Encoding profile to tune, "output_encoding" or "intermediate_encoding"
+        samples: Number of clips to sample
+        window_seconds: Seconds encoded from the middle of each sampled clip
+        candidates: Profiles to try, every default preset and CRF when None
+        min_ssim: Lowest SSIM any sample may score
+        time_budget: Seconds the encode of the timelapse may take
+
+    Returns:
+        The chosen result, None if no candidate met the floor or fit the budget
+    """
+    encoding = getattr(config, section)
+    if not is_encoding_used(config, section):
+        print(f"{section} isn't used by the fused render without output variants, the result only applies to staged renders")
+    videos = sample_videos(video_collection, samples)
+    candidates = candidates or get_candidates()
+    concurrent_jobs, threads_per_job = plan_encodes(config, section, video_collection)
+    print(
+        f"tuning {section} on {len(videos)} clips with {len(candidates)} candidates, "
+        f"as {concurrent_jobs} concurrent jobs of {threads_per_job} threads"
+    )
+    tuner = EncoderTuner(config, encoding, os.path.join(config.directories.scratch, "tune"), threads_per_job)
+    results = tuner.run(videos, window_seconds, candidates)
+
+    if time_budget is None:
+        result = select_fastest(results, min_ssim)
+        if result is None:
+            print(f"no candidate reached an SSIM of {min_ssim}")
+            return None
+    else:
+        encoded_seconds = config.timelapse_video.get_length_in_seconds()
+        result = select_best_quality(results, time_budget, encoded_seconds, concurrent_jobs)
+        if result is None:
+            print(f"no candidate encodes {encoded_seconds:g}s of video within {time_budget:g}s")
+            return None
+
+    candidate = result.candidate
+    print(
+        f"chose preset {candidate.preset}, crf {candidate.crf:g}, threads {candidate.threads}: "
+        f"ssim {result.ssim:.4f}, psnr {result.psnr:.2f}dB, {result.seconds_per_second:.3f}s per second"
+    )
+    if config_path:
+        write_encoding_profile(config_path, section, candidate)
+        print(f"wrote {section} to {config_path}")
+    return result
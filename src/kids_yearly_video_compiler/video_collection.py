@@ -1,29 +1,39 @@
-import sys
-from typing import Sequence
+from array import array
+from typing import Sequence, Tuple
 
 from kids_yearly_video_compiler.video_inspector import VideoInfo
 
 class VideoCollection:
+    """
+    Clips of a compilation, with columns of the fields used for stats
+
+    Durations and sizes are kept in typed arrays so the stats are computed by builtins
+    over contiguous memory, and the name and date orders are computed once here instead
+    of sorting again on every sorted() call.
+    """
+
     def __init__(self, videos: Sequence[VideoInfo]):
-        self.videos = videos
-        self.min_width, self.max_width = sys.maxsize, 0
-        self.min_height, self.max_height = sys.maxsize, 0
-        self.total_duration = 0
-        for video in videos:
-            self.total_duration += video.duration
-            self.min_width, self.max_width = min(self.min_width, video.width), max(
-                self.max_width, video.width
-            )
-            self.min_height, self.max_height = min(self.min_height, video.height), max(
-                self.max_height, video.height
-            )
-        self.average_duration = (self.total_duration / self.size())
+        self.videos: Tuple[VideoInfo, ...] = tuple(videos)
+        self.durations = array("d", (video.duration for video in self.videos))
+        self.widths = array("l", (video.width for video in self.videos))
+        self.heights = array("l", (video.height for video in self.videos))
+
+        self._by_name = tuple(sorted(self.videos, key=lambda video: video.base_name))
+        self._by_date = tuple(sorted(self.videos, key=lambda video: (video.date_taken, video.base_name)))
+
+        self.total_duration = sum(self.durations)
+        self.average_duration = self.total_duration / self.size() if self.videos else 0.0
+        self.min_width, self.max_width = min(self.widths, default=0), max(self.widths, default=0)
+        self.min_height, self.max_height = min(self.heights, default=0), max(self.heights, default=0)
 
     def size(self) -> int:
         return len(self.videos)
 
     def sorted(self, reverse: bool = False) -> Sequence[VideoInfo]:
-        return sorted(self.videos, key=lambda x: x.base_name, reverse=reverse)
+        return self._by_name[::-1] if reverse else self._by_name
+
+    def sorted_by_date(self, reverse: bool = False) -> Sequence[VideoInfo]:
+        return self._by_date[::-1] if reverse else self._by_date
 
     def print_info(self) -> None:
         print(f"video collection info:")
@@ -1,16 +1,104 @@
+from collections import Counter
+from dataclasses import asdict, replace
 from datetime import datetime
+from fractions import Fraction
+import json
+import math
 import os
-from typing import Callable, List, Tuple
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, Iterable, List, Sequence, Tuple
 
 import ffmpeg
-import re
-import subprocess
 from tqdm import tqdm
 from ffmpeg.nodes import Stream
-from kids_yearly_video_compiler.configuration import Configuration
+from kids_yearly_video_compiler.build_manifest import BuildManifest, ClipManifest
+from kids_yearly_video_compiler.configuration import Configuration, EncodingProfile, OutputVariant
+from kids_yearly_video_compiler.ffmpeg_process_manager import FfmpegProcessManager, run_cancellable
+from kids_yearly_video_compiler.ffmpeg_progress import FfmpegProgress
+from kids_yearly_video_compiler.filter_graph import (
+    Crop,
+    FilterGraph,
+    FilterStep,
+    FrameFilter,
+    PixelFilter,
+    Scale,
+    Segment,
+    SetPts,
+    StreamState,
+)
+from kids_yearly_video_compiler.job_queue import DistributedJobScheduler, JobQueue, get_job_queue_file_path
+from kids_yearly_video_compiler.job_scheduler import FfmpegJob, JobScheduler
+from kids_yearly_video_compiler.motion_analysis import get_vidstabdetect_format_options, write_motion_data_window
+from kids_yearly_video_compiler.render_planner import CostModel, PlannedJob, PlannedStage, RenderPlan
+from kids_yearly_video_compiler.scratch_cache import OUTPUT_FILE_PLACEHOLDER, CacheEntry, ScratchCache
 from kids_yearly_video_compiler.video_collection import VideoCollection
 from kids_yearly_video_compiler.video_inspector import VideoInfo, get_video_info
 
+if TYPE_CHECKING:
+    from kids_yearly_video_compiler.batch_compiler import BatchCompiler
+
+# transfers of the HDR clips the tonemap LUT can be generated for, HLG and PQ
+HDR_TONEMAP_LUT_TRANSFERS = ("arib-std-b67", "smpte2084")
+# a level 8 Hald CLUT samples 64 points per RGB axis
+HDR_TONEMAP_LUT_LEVEL = 8
+# codec ffprobe reports for the output of each software encoder, hardware encoders are named after theirs
+ENCODER_CODEC_NAMES = {
+    "libx264": "h264",
+    "libx265": "hevc",
+    "libvpx-vp9": "vp9",
+    "libaom-av1": "av1",
+    "libsvtav1": "av1",
+}
+# seconds a derived duration may differ from the probed one, the output frame rate rounds it by a frame or two
+DERIVED_DURATION_TOLERANCE = 0.1
+
+
+def split_timeline(durations: Sequence[float], chunk_count: int) -> List[range]:
+    """Split clips into at most chunk_count runs of consecutive clips with similar total durations"""
+    chunk_count = max(1, min(chunk_count, len(durations)))
+    target_duration = sum(durations) / chunk_count
+    chunks: List[range] = []
+    start, total_duration = 0, 0.0
+    for index, duration in enumerate(durations):
+        total_duration += duration
+        remaining_clips = len(durations) - index - 1
+        remaining_chunks = chunk_count - len(chunks) - 1
+        if 0 < remaining_chunks <= remaining_clips and (
+            total_duration >= target_duration * (len(chunks) + 1) or remaining_clips == remaining_chunks
+        ):
+            chunks.append(range(start, index + 1))
+            start = index + 1
+    chunks.append(range(start, len(durations)))
+    return chunks
+
+
+def get_codec_name(encoder: str) -> str:
+    """Codec an encoder writes, e.g. hevc for libx265 or hevc_nvenc"""
+    return ENCODER_CODEC_NAMES.get(encoder, encoder.split("_")[0])
+
+
+def get_metadata_differences(derived_video: VideoInfo, probed_video: VideoInfo) -> List[str]:
+    """Fields of derived metadata that don't match the probed file, empty when they all do"""
+    differences = [
+        f"{name} {getattr(derived_video, name)} != {getattr(probed_video, name)}"
+        for name in ("width", "height", "hdr", "codec_name", "pix_fmt")
+        if getattr(derived_video, name) != getattr(probed_video, name)
+    ]
+    try:
+        frame_rates_match = Fraction(derived_video.frame_rate) == Fraction(probed_video.frame_rate)
+    except (ValueError, ZeroDivisionError):
+        frame_rates_match = derived_video.frame_rate == probed_video.frame_rate
+    if not frame_rates_match:
+        differences.append(f"frame_rate {derived_video.frame_rate} != {probed_video.frame_rate}")
+    if abs(derived_video.duration - probed_video.duration) > DERIVED_DURATION_TOLERANCE:
+        differences.append(f"duration {derived_video.duration:.3f} != {probed_video.duration:.3f}")
+    return differences
+
+
+def _write_text(file_path: str, text: str) -> None:
+    with open(file_path, "w") as f:
+        f.write(text)
+
 
 class VideoCollectionCompiler:
     def __init__(self, config: Configuration, video_collection: VideoCollection):
@@ -18,19 +106,110 @@ class VideoCollectionCompiler:
         self.video_collection = video_collection
 
         self.compiled_video_collection: VideoCollection = None
+        self.build_manifest: BuildManifest = None
+        if config.compiler_options.distributed:
+            self.job_scheduler: JobScheduler = DistributedJobScheduler(
+                JobQueue(get_job_queue_file_path(config.directories.scratch)),
+                config.compiler_options.cpu_budget,
+                config.compiler_options.parallel_jobs,
+            )
+        else:
+            self.job_scheduler = JobScheduler(
+                config.compiler_options.cpu_budget, config.compiler_options.parallel_jobs
+            )
+        self._threads_per_job = 0
+        self._hdr_tonemap_lut_file_paths: Dict[str, str] = {}
+        # motion data windows the commands built since the last _run_jobs read, by file path
+        self._stabilization_data_windows: Dict[str, Tuple[CacheEntry, str, int]] = {}
+        self.process_manager = FfmpegProcessManager(config.compiler_options.stall_timeout)
+        self.scratch_cache = ScratchCache(
+            config.directories.scratch, config.compiler_options.get_scratch_max_size_in_bytes()
+        )
+        self.cost_model = CostModel(os.path.join(config.directories.scratch, "render-timings.json"))
+        # set while plan() walks the job graph, jobs are then recorded instead of run
+        self.render_plan: RenderPlan = None
+        # set when compiling as part of a batch, jobs then run in the batch's shared job set
+        self.batch: "BatchCompiler" = None
+        # name of the output variant this compiler renders, empty for the single output
+        self.variant_name = ""
+        # one per output variant, filled by compile() when the configuration lists variants
+        self.variant_compilers: List["VideoCollectionCompiler"] = []
+        # awaited before each job starts, the watcher holds jobs back here while the host is busy
+        self.before_job: Callable[[], Awaitable[None]] = None
 
     def _print_ffmpeg_command(self, command: Stream):
         if self.config.compiler_options.show_ffmpeg_commands:
             print("ffmpeg command:", " ".join(command.compile()))
 
-    def _get_transformed_video_file_path(
-        self, transform_name: str, video: VideoInfo
-    ) -> Tuple[str, str]:
-        transformed_file_name = f"{video.base_name}-{transform_name}.mp4"
-        return (
-            transformed_file_name,
-            f"{self.config.directories.scratch}/{transformed_file_name}",
-        )
+    def _get_cache_entry(
+        self, transform_name: str, video: VideoInfo, build_command: Callable[[str], Stream], extension: str = "mp4"
+    ) -> CacheEntry:
+        # the key is computed without a thread budget so it doesn't depend on how busy the machine is
+        threads_per_job, self._threads_per_job = self._threads_per_job, 0
+        command = build_command(OUTPUT_FILE_PLACEHOLDER).compile()
+        self._threads_per_job = threads_per_job
+        return self.scratch_cache.get_entry(f"{video.base_name}-{transform_name}", extension, command)
+
+    def _plan_jobs(
+        self,
+        transform_name: str,
+        video_collection: VideoCollection,
+        build_command: Callable[[VideoInfo, str], Stream],
+        get_duration: Callable[[VideoInfo], float],
+        extension: str = "mp4",
+        get_decoded_duration: Callable[[VideoInfo], float] = None,
+    ) -> Tuple[Dict[str, CacheEntry], List[FfmpegJob]]:
+        cache_entries = {
+            video.base_name: self._get_cache_entry(
+                transform_name, video, lambda output_file_path: build_command(video, output_file_path), extension
+            )
+            for video in video_collection.sorted()
+        }
+        pending_videos = [
+            video
+            for video in video_collection.sorted()
+            if not self.scratch_cache.is_cached(cache_entries[video.base_name])
+        ]
+        concurrent_jobs, self._threads_per_job = self.job_scheduler.plan(len(pending_videos))
+        jobs: List[FfmpegJob] = []
+        for video in pending_videos:
+            cache_entry = cache_entries[video.base_name]
+            command = build_command(video, cache_entry.partial_file_path)
+            self._print_ffmpeg_command(command)
+            stage_key = CostModel.get_stage_key(transform_name, video.hdr)
+            cost_units = CostModel.get_units(
+                (get_decoded_duration or get_duration)(video), video.width, video.height
+            )
+            jobs.append(
+                FfmpegJob(
+                    command.compile(),
+                    get_duration(video),
+                    f"processing {video.base_name}",
+                    cache_entry,
+                    self._threads_per_job,
+                    stage_key,
+                    cost_units,
+                    self.cost_model.estimate(stage_key, cost_units, self._threads_per_job),
+                )
+            )
+
+        if self.render_plan is not None:
+            estimated_seconds = {job.cache_entry.key: job.estimated_seconds for job in jobs}
+            self.render_plan.stages.append(
+                PlannedStage(
+                    transform_name,
+                    concurrent_jobs,
+                    [
+                        PlannedJob(
+                            video.base_name,
+                            estimated_seconds.get(cache_entries[video.base_name].key, 0.0),
+                            cache_entries[video.base_name].key not in estimated_seconds,
+                        )
+                        for video in video_collection.sorted()
+                    ],
+                )
+            )
+        return cache_entries, jobs
 
     # TODO move this to video collection
     def _transform(
@@ -38,186 +217,667 @@ class VideoCollectionCompiler:
         transform_name: str,
         video_collection: VideoCollection,
         transform_video_function: Callable[[VideoInfo, str, dict], Stream],
-        transform_argument_functions: dict[Callable, str] = {},
+        derive_video_function: Callable[[VideoInfo, dict], VideoInfo],
+        transform_argument_functions: Dict[Callable, str] = {},
     ) -> VideoCollection:
-        transformed_videos: List[VideoInfo] = []
+        """
+        Run a transform on every video that isn't cached yet
+
+        The outputs' metadata is derived from their inputs and the transform instead of
+        probing every output, a sample of them is probed when verify_metadata_sample is set.
+        """
         print(f"applying {transform_name} to {video_collection.size()} videos")
-        with tqdm(video_collection.sorted(), desc=f"applying {transform_name}", unit="video", colour="green") as pbar:
-            for video in pbar:
-                (
-                    transformed_file_name,
-                    transformed_file_path,
-                ) = self._get_transformed_video_file_path(transform_name, video)
-                if os.path.isfile(transformed_file_path):
-                    transformed_videos.append(
-                        get_video_info(
-                            self.config.directories.scratch,
-                            transformed_file_name,
-                            video.base_name,
-                        )
-                    )
-                    continue
+        cache_entries, jobs = self._plan_jobs(
+            transform_name,
+            video_collection,
+            lambda video, output_file_path: transform_video_function(
+                video, output_file_path, transform_argument_functions
+            ),
+            lambda video: transform_argument_functions.get("duration", video.duration),
+            get_decoded_duration=lambda video: self._get_decoded_duration(video, transform_argument_functions),
+        )
+        self._run_jobs(jobs, f"applying {transform_name}", video_collection.size())
 
-                command = transform_video_function(
-                    video, transformed_file_path, transform_argument_functions
-                )
-                self._print_ffmpeg_command(command)
-                duration = video.duration
-                if "duration" in transform_argument_functions:
-                    duration = transform_argument_functions["duration"]
-                self.run_ffmpeg_with_progress(command.compile(), duration, f"processing {video.base_name}")
-
-                transformed_videos.append(
-                    get_video_info(
-                        self.config.directories.scratch,
-                        transformed_file_name,
-                        video.base_name,
-                    )
+        transformed_videos = [
+            replace(
+                derive_video_function(video, transform_argument_functions),
+                file_path=cache_entries[video.base_name].file_path,
+            )
+            for video in video_collection.sorted()
+        ]
+        if self.render_plan is None:
+            transformed_videos = self._verify_derived_videos(transform_name, transformed_videos)
+        return VideoCollection(transformed_videos)
+
+    def _get_decoded_duration(self, video: VideoInfo, transform_arguments: dict) -> float:
+        """Seconds of the input video a transform decodes, only the head and tail of long clips are read"""
+        if "max_video_length" in transform_arguments and video.duration > transform_arguments["max_video_length"]:
+            return transform_arguments["head_length"] + transform_arguments["tail_length"]
+        return video.duration
+
+    def _derive_video(self, video: VideoInfo, state: StreamState, encoding: EncodingProfile) -> VideoInfo:
+        """Metadata of a transform's output, from the state of its filtered stream and its encoding"""
+        frame_rate = Fraction(self.config.timelapse_video.frame_rate)
+        frame_rate = f"{frame_rate.numerator}/{frame_rate.denominator}"
+        return replace(
+            video,
+            duration=state.duration,
+            width=state.width,
+            height=state.height,
+            hdr=state.hdr,
+            probe_info=None,
+            codec_name=get_codec_name(encoding.codec),
+            pix_fmt=encoding.pix_fmt,
+            frame_rate=frame_rate,
+            average_frame_rate=frame_rate,
+            # the tonemap writes bt709
+            color_transfer="bt709" if video.hdr and not state.hdr else video.color_transfer,
+        )
+
+    def _derive_graph_output(
+        self, build_graph: Callable[[VideoInfo, dict], FilterGraph], encoding: EncodingProfile
+    ) -> Callable[[VideoInfo, dict], VideoInfo]:
+        return lambda video, transform_arguments: self._derive_video(
+            video, build_graph(video, transform_arguments).get_output_state(), encoding
+        )
+
+    def _verify_derived_videos(self, transform_name: str, videos: List[VideoInfo]) -> List[VideoInfo]:
+        """
+        Probe an evenly spread sample of a stage's outputs and compare them with their derived metadata
+
+        Returns:
+            The videos, or every one of them probed if any sampled output differs
+        """
+        sample = self.config.compiler_options.verify_metadata_sample
+        if not sample or not videos:
+            return videos
+        sample_size = min(len(videos), math.ceil(len(videos) * sample))
+        for index in range(sample_size):
+            video = videos[index * len(videos) // sample_size]
+            differences = get_metadata_differences(video, self._probe_output(video))
+            if differences:
+                print(
+                    f"derived metadata of {video.base_name} after {transform_name} differs from the file "
+                    f"({', '.join(differences)}), probing all {len(videos)} outputs"
                 )
+                return [self._probe_output(video) for video in videos]
+        return videos
 
-        return VideoCollection(transformed_videos)
+    def _probe_output(self, video: VideoInfo) -> VideoInfo:
+        probed_video = get_video_info(os.path.dirname(video.file_path), os.path.basename(video.file_path), video.base_name)
+        return replace(probed_video, date_taken=video.date_taken)
+
+    def _run_jobs(self, jobs: List[FfmpegJob], description: str, total: int) -> None:
+        stabilization_data_windows, self._stabilization_data_windows = self._stabilization_data_windows, {}
+        if self.render_plan is not None:
+            return
+        if jobs:
+            self._write_stabilization_data_windows(stabilization_data_windows.values())
+        if self.batch is not None:
+            self.batch.run_jobs(self, jobs)
+        else:
+            with tqdm(total=total, initial=total - len(jobs), desc=description, unit="video", colour="green") as pbar:
+                self.job_scheduler.run(jobs, self._run_job, lambda job: self._on_job_done(job, pbar))
+        self.scratch_cache.evict()
+        self.cost_model.save()
+
+    def _on_job_done(self, job: FfmpegJob, pbar: tqdm) -> None:
+        self.scratch_cache.pin(job.cache_entry)
+        pbar.update(1)
 
-    def run_ffmpeg_with_progress(self, command: List[str], duration: float = None, description: str = "Processing"):
+    async def _run_job(self, job: FfmpegJob, position: int) -> None:
+        if self.before_job is not None:
+            await self.before_job()
+        self.scratch_cache.prepare(job.cache_entry)
+        start = time.perf_counter()
+        try:
+            await self.process_manager.run(
+                job.command, job.duration, job.description, position, job.cache_entry.partial_file_path
+            )
+        except BaseException:
+            self.scratch_cache.discard(job.cache_entry)
+            raise
+        self.cost_model.record(job.stage_key, job.cost_units, time.perf_counter() - start, job.threads)
+        self.scratch_cache.commit(job.cache_entry)
+
+    def _apply_thread_budget(self, output: Stream) -> Stream:
+        if not self._threads_per_job:
+            return output
+        threads = str(self._threads_per_job)
+        return output.global_args("-filter_threads", threads, "-filter_complex_threads", threads)
+
+    def run_ffmpeg_with_progress(
+        self,
+        command: List[str],
+        duration: float = None,
+        description: str = "Processing",
+        position: int = 0,
+        partial_file_path: str = None,
+    ) -> FfmpegProgress:
+        return run_cancellable(
+            self.process_manager.run(command, duration, description, position, partial_file_path)
+        )
+
+    def plan(self) -> RenderPlan:
         """
-        Run FFmpeg command with progress bar
+        Walk the job graph of compile() and save() without running any job
 
-        Args:
-            command: FFmpeg command as list of strings
-            duration: Total duration of processing time in seconds
-            description: Description for progress bar
+        Stages whose inputs aren't rendered yet are planned from the predicted metadata of
+        those inputs, so every job gets a cost estimate from the calibrated cost model.
         """
+        self.render_plan = RenderPlan()
+        try:
+            self.compile()
+            self.render_plan.stages.append(
+                PlannedStage(
+                    "save",
+                    jobs=[compiler._plan_save_job() for compiler in self.variant_compilers or [self]],
+                )
+            )
+            return self.render_plan
+        finally:
+            self.render_plan = None
+
+    def _plan_save_job(self) -> PlannedJob:
+        videos = self.compiled_video_collection.videos
+        cost_units = sum(CostModel.get_units(video.duration, video.width, video.height) for video in videos)
+        return PlannedJob(
+            f"final video{self._get_output_name_suffix()}",
+            self.cost_model.estimate(CostModel.get_stage_key("save", False), cost_units),
+            self._is_output_up_to_date(BuildManifest.load(self._get_build_manifest_file_path())),
+        )
 
-        # Start FFmpeg process
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            universal_newlines=True,
-            bufsize=1
-        )
-
-        # Create progress bar
-        with tqdm(
-            total=duration,
-            desc=description,
-            unit="s",
-            #bar_format='{l_bar}{bar}| {n:.1f}/{total:.1f}s [{elapsed}<{remaining}, {rate_fmt}]'
-        ) as pbar:
-
-            # Monitor stderr for progress
-            for line in process.stderr:
-                # Look for time= in FFmpeg output
-                time_match = re.search(r'time=(\d+):(\d+):(\d+\.\d+)', line)
-                if time_match:
-                    hours, minutes, seconds = time_match.groups()
-                    current_time = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
-
-                    # Update progress bar (but don't exceed total)
-                    pbar.n = min(current_time, duration)
-                    pbar.refresh()
-
-                # Also capture any errors
-                if "Error" in line or "error" in line:
-                    pbar.write(f"FFmpeg error: {line.strip()}")
-            pbar.n = duration
-            pbar.refresh()
-
-        # Wait for process to complete
-        return_code = process.wait()
-
-        if return_code != 0:
-            # Get any remaining error output
-            stderr_output = process.stderr.read()
-            raise RuntimeError(f"FFmpeg failed with return code {return_code}: {stderr_output}")
-
-        return return_code
+    def _is_output_up_to_date(self, previous_build_manifest: BuildManifest) -> bool:
+        return (
+            self.build_manifest is not None
+            and previous_build_manifest is not None
+            and previous_build_manifest.get_segment_file_paths() == self.build_manifest.get_segment_file_paths()
+            # parameters of the save step alone, like final_encoding, change no segment
+            and previous_build_manifest.parameters == self.build_manifest.parameters
+            and os.path.isfile(previous_build_manifest.output_video_path)
+        )
 
     def save(self):
-        output_video_name = f"{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}-{self.config.kid_info.name.replace(' ', '-')}.mp4"
+        if self.variant_compilers:
+            for compiler in self.variant_compilers:
+                compiler.save()
+            return
+
+        previous_build_manifest = BuildManifest.load(self._get_build_manifest_file_path())
+        if self._is_output_up_to_date(previous_build_manifest):
+            print(f"final video is up to date: {previous_build_manifest.output_video_path}")
+            return
+
+        output_video_name = f"{datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}-{self.config.kid_info.name.replace(' ', '-')}{self._get_output_name_suffix()}.mp4"
         output_video_path = os.path.join(self.config.directories.output_video, output_video_name)
         print(f"saving final video to {output_video_path}")
+        videos = self._normalize_clip_parameters(self.compiled_video_collection).sorted(
+            reverse=self.config.timelapse_options.reverse
+        )
+
+        final_encoding = self.config.final_encoding
+        if final_encoding is not None and final_encoding != self.config.output_encoding:
+            videos = self._encode_timeline_chunks(videos, final_encoding)
+
+        # every clip now shares codec, size, pixel format and frame rate, so the concat
+        # demuxer can join them with a stream copy instead of decoding and re-encoding
+        concat_list_file_path = self._write_concat_list(output_video_name, videos)
         command = (
-            ffmpeg.concat(
-                *[
-                    ffmpeg.input(scratch_video.file_path)
-                    for scratch_video in self.compiled_video_collection.sorted(
-                        reverse=self.config.timelapse_options.reverse
-                    )
-                ]
-            )
-            .output(output_video_path)
+            ffmpeg.input(concat_list_file_path, f="concat", safe=0)
+            .output(output_video_path, c="copy")
             .overwrite_output()
         )
         self._print_ffmpeg_command(command)
 
         # Calculate total duration for all videos being concatenated
-        total_duration = sum(video.duration for video in self.compiled_video_collection.videos)
-        self.run_ffmpeg_with_progress(command.compile(), total_duration, f"writing {output_video_name}")
+        total_duration = sum(video.duration for video in videos)
+        start = time.perf_counter()
+        self.run_ffmpeg_with_progress(
+            command.compile(), total_duration, f"writing {output_video_name}", partial_file_path=output_video_path
+        )
+        self.cost_model.record(
+            CostModel.get_stage_key("save", False),
+            sum(CostModel.get_units(video.duration, video.width, video.height) for video in videos),
+            time.perf_counter() - start,
+        )
+        self.cost_model.save()
+
+        if self.build_manifest is not None:
+            self.build_manifest.output_video_path = output_video_path
+            self.build_manifest.save(self._get_build_manifest_file_path())
+
+    def _get_output_name_suffix(self) -> str:
+        variant_suffix = f"-{self.variant_name}" if self.variant_name else ""
+        preview_suffix = "-preview" if self.config.compiler_options.preview else ""
+        return variant_suffix + preview_suffix
+
+    def _normalize_clip_parameters(self, video_collection: VideoCollection) -> VideoCollection:
+        clip_parameters = Counter(video.get_clip_parameters() for video in video_collection.videos)
+        reference_parameters, _ = clip_parameters.most_common(1)[0]
+        matching_videos = [
+            video for video in video_collection.videos if video.get_clip_parameters() == reference_parameters
+        ]
+        mismatched_videos = [
+            video for video in video_collection.videos if video.get_clip_parameters() != reference_parameters
+        ]
+        if not mismatched_videos:
+            return video_collection
+
+        print(f"re-encoding {len(mismatched_videos)} videos that don't match {reference_parameters}")
+        normalized_video_collection = self._transform(
+            "normalized",
+            VideoCollection(mismatched_videos),
+            self._transform_normalize,
+            lambda video, transform_arguments: self._derive_video(
+                video,
+                replace(
+                    self._get_stream_state(video),
+                    width=transform_arguments["reference_video"].width,
+                    height=transform_arguments["reference_video"].height,
+                ),
+                self.config.output_encoding,
+            ),
+            {"reference_video": matching_videos[0]},
+        )
+        return VideoCollection(matching_videos + list(normalized_video_collection.videos))
+
+    def _transform_normalize(self, video: VideoInfo, output_file_path: str, transform_arguments: dict = {}) -> Stream:
+        reference_video: VideoInfo = transform_arguments["reference_video"]
+        stream = (
+            ffmpeg.input(video.file_path)
+            .filter(
+                "scale",
+                reference_video.width,
+                reference_video.height,
+                force_original_aspect_ratio="decrease",
+            )
+            .filter(
+                "pad", reference_video.width, reference_video.height, "(ow-iw)/2", "(oh-ih)/2"
+            )
+            .filter("setsar", 1)
+        )
+        return self._save(stream, output_file_path, self.config.output_encoding)
+
+    def _write_concat_list(self, output_video_name: str, videos: Sequence[VideoInfo]) -> str:
+        concat_list_file_path = os.path.join(self.config.directories.scratch, f"{output_video_name}.concat.txt")
+        with open(concat_list_file_path, "w") as f:
+            f.write(self._get_concat_list(videos))
+        return concat_list_file_path
+
+    def _get_concat_list(self, videos: Sequence[VideoInfo]) -> str:
+        lines = []
+        for video in videos:
+            escaped_file_path = os.path.abspath(video.file_path).replace("'", "'\\''")
+            lines.append(f"file '{escaped_file_path}'\n")
+        return "".join(lines)
+
+    def _encode_timeline_chunks(self, videos: Sequence[VideoInfo], encoding: EncodingProfile) -> List[VideoInfo]:
+        """
+        Re-encode the timeline into another profile as clip-aligned chunks in parallel, one per concurrent job
+
+        Each chunk is a run of consecutive clips read through the concat demuxer. Every chunk
+        encode starts on a keyframe with closed GOPs at the same constant frame rate, so the
+        chunks join with a stream copy into one seamless video.
+
+        Returns:
+            The encoded chunks in timeline order
+        """
+        concurrent_jobs, _ = self.job_scheduler.plan(len(videos))
+        chunk_videos: List[VideoInfo] = []
+        for index, chunk in enumerate(split_timeline([video.duration for video in videos], concurrent_jobs)):
+            chunk_name = f"{self.config.kid_info.name.replace(' ', '-')}-{index:04d}"
+            concat_list = self._get_concat_list([videos[clip_index] for clip_index in chunk])
+            # the list is named after its content, so unchanged chunks stay cached across runs
+            list_cache_entry = self.scratch_cache.get_entry(f"{chunk_name}-timeline-list", "txt", [concat_list])
+            if self.render_plan is None:
+                self.scratch_cache.write(list_cache_entry, lambda file_path: _write_text(file_path, concat_list))
+            chunk_videos.append(
+                replace(
+                    videos[chunk[0]],
+                    base_name=chunk_name,
+                    file_path=list_cache_entry.file_path,
+                    duration=sum(videos[clip_index].duration for clip_index in chunk),
+                )
+            )
+        print(f"re-encoding the timeline in {len(chunk_videos)} chunks")
+        return list(
+            self._transform(
+                "timeline-chunk",
+                VideoCollection(chunk_videos),
+                self._transform_timeline_chunk,
+                lambda video, transform_arguments: self._derive_video(
+                    video, self._get_stream_state(video), transform_arguments["encoding"]
+                ),
+                {"encoding": encoding},
+            ).sorted()
+        )
+
+    def _transform_timeline_chunk(self, video: VideoInfo, output_file_path: str, transform_arguments: dict = {}) -> Stream:
+        encoding: EncodingProfile = transform_arguments["encoding"]
+        encoding = replace(encoding, options={"force_key_frames": "expr:eq(n,0)", "flags": "+cgop", **encoding.options})
+        return self._save(ffmpeg.input(video.file_path, f="concat", safe=0), output_file_path, encoding)
 
     def compile(self):
-        # apply head-tail algorithm
-        head_tail_algorithm_collection = self._apply_head_tail_algorithm(self.video_collection)
+        render_mode = self.config.compiler_options.render_mode
+        if render_mode not in ("fused", "staged"):
+            raise ValueError(f"Invalid render mode: {render_mode}")
+        if self.config.timelapse_video.hdr_tonemap not in ("exact", "lut"):
+            raise ValueError(f"Invalid HDR tonemap: {self.config.timelapse_video.hdr_tonemap}")
+        if self.config.output_variants:
+            self._compile_variants()
+            return
+
+        self._plan_and_diff_build_manifest()
+        if render_mode == "fused":
+            self._compile_fused()
+        else:
+            self._compile_staged()
+        self._record_segment_file_paths()
+
+    # stages of compile(), run one at a time by kyvc-benchmark to time them separately
+
+    def run_head_tail_algorithm(self, video_collection: VideoCollection) -> VideoCollection:
+        return self._apply_head_tail_algorithm(video_collection)
+
+    def run_video_stabilization(self, video_collection: VideoCollection) -> VideoCollection:
+        return self._apply_video_stabilization(video_collection)
+
+    def run_video_filters(self, video_collection: VideoCollection) -> VideoCollection:
+        return self._apply_video_filters(video_collection)
+
+    def run_fused(self) -> VideoCollection:
+        """Render the collection in a single encode per clip, whatever the configured render mode"""
+        self._compile_fused()
+        return self.compiled_video_collection
+
+    def prepare_hdr_tonemap_lut(self, color_transfer: str) -> str:
+        """Generate the tonemap LUT of a source transfer, if it isn't cached yet, and return its path"""
+        return self._get_hdr_tonemap_lut_file_path(color_transfer)
 
-        # apply video stabilization
+    def _plan_and_diff_build_manifest(self):
+        self.build_manifest = self._plan_build_manifest()
+        self.build_manifest.diff(BuildManifest.load(self._get_build_manifest_file_path())).print_summary()
+
+    def _record_segment_file_paths(self):
+        segment_file_paths = {video.base_name: video.file_path for video in self.compiled_video_collection.videos}
+        for clip in self.build_manifest.clips:
+            clip.segment_file_path = segment_file_paths[clip.base_name]
+
+    def _get_build_manifest_file_path(self) -> str:
+        variant_suffix = f"-{self.variant_name}" if self.variant_name else ""
+        return os.path.join(
+            self.config.directories.scratch,
+            f"{self.config.kid_info.name.replace(' ', '-')}{variant_suffix}-build-manifest.json",
+        )
+
+    def _plan_build_manifest(self) -> BuildManifest:
+        head_tail_arguments = self._get_head_tail_arguments()
+        parameters = {
+            "clip_duration": head_tail_arguments["duration"],
+            "head_length": head_tail_arguments["head_length"],
+            "tail_length": head_tail_arguments["tail_length"],
+            "speed_up_factor": self.config.timelapse_options.speed_up_factor,
+            "max_width": self.config.timelapse_video.max_width,
+            "max_height": self.config.timelapse_video.max_height,
+            "frame_rate": self.config.timelapse_video.frame_rate,
+            "font_size": self.config.timelapse_video.font_size,
+            "hdr_tonemap": self.config.timelapse_video.hdr_tonemap,
+            "final_encoding": asdict(self.config.final_encoding) if self.config.final_encoding else None,
+            "preview": self.config.compiler_options.preview,
+            "instagram_style": self.config.timelapse_video.instagram_style,
+            "list_weeks_centered": self.config.timelapse_options.list_weeks_centered,
+            "video_stabilization": self.config.timelapse_options.video_stabilization,
+            "shakiness": self.config.timelapse_stabilization_options.shakiness,
+            "smoothing": self.config.timelapse_stabilization_options.smoothing,
+            "analysis_width": self.config.timelapse_stabilization_options.analysis_width,
+            "birthday": self.config.kid_info.birthday,
+            "render_mode": self.config.compiler_options.render_mode,
+            "intermediate_encoding": asdict(self.config.intermediate_encoding),
+            "output_encoding": asdict(self.config.output_encoding),
+        }
+        clips: List[ClipManifest] = []
+        for video in self.video_collection.sorted(reverse=self.config.timelapse_options.reverse):
+            stat = os.stat(video.file_path)
+            clips.append(ClipManifest(video.base_name, video.file_path, stat.st_size, stat.st_mtime_ns))
+        # round trip through json so parameters compare equal to the ones loaded from disk
+        return BuildManifest(parameters=json.loads(json.dumps(parameters, default=str)), clips=clips)
+
+    def _compile_staged(self):
+        # apply head-tail algorithm, together with video stabilization when it's enabled
         pre_filtered_video_collection = (
-            self._apply_video_stabilization(head_tail_algorithm_collection)
+            self._apply_video_stabilization(self.video_collection)
             if self.config.timelapse_options.video_stabilization
-            else head_tail_algorithm_collection
+            else self._apply_head_tail_algorithm(self.video_collection)
         )
 
         # apply video filters
+        self.compiled_video_collection = self._apply_video_filters(pre_filtered_video_collection)
+
+    def _apply_head_tail_algorithm(self, original_video_collection: VideoCollection) -> VideoCollection:
+        return self._transform(
+            "head-tail-algorithm",
+            original_video_collection,
+            self._transform_head_tail_algorithm,
+            self._derive_graph_output(self._head_tail_graph, self.config.intermediate_encoding),
+            self._get_head_tail_arguments(),
+        )
+
+    def _apply_video_stabilization(self, original_video_collection: VideoCollection) -> VideoCollection:
+        transform_arguments = self._get_head_tail_arguments()
+        transform_arguments["stabilization_data_file_path"] = self._detect_video_stabilization(
+            original_video_collection
+        )
+        return self._transform(
+            "stabilized",
+            original_video_collection,
+            self._transform_head_tail_algorithm,
+            self._derive_graph_output(self._head_tail_graph, self.config.intermediate_encoding),
+            transform_arguments,
+        )
+
+    def _apply_video_filters(self, pre_filtered_video_collection: VideoCollection) -> VideoCollection:
+        return self._transform(
+            "video-filters",
+            pre_filtered_video_collection,
+            self._transform_video_filters,
+            self._derive_graph_output(self._video_filters_graph, self.config.output_encoding),
+        )
+
+    def _compile_fused(self):
+        # one filter graph and a single encode per clip, no intermediate files
+        transform_arguments = self._get_head_tail_arguments()
+        if self.config.timelapse_options.video_stabilization:
+            transform_arguments["stabilization_data_file_path"] = self._detect_video_stabilization(
+                self.video_collection
+            )
+
         self.compiled_video_collection = self._transform(
-            "video-filters", pre_filtered_video_collection, self._transform_video_filters
+            "compiled",
+            self.video_collection,
+            self._transform_fused,
+            self._derive_graph_output(self._fused_graph, self.config.output_encoding),
+            transform_arguments,
         )
 
+    def _compile_variants(self):
+        """
+        Render every output variant from one shared intermediate per clip
+
+        The decode, head-tail cut, stabilization and HDR tonemap run once per clip, at the
+        size of the largest variant and with the intermediate encoding. Each variant then
+        only scales, crops, labels and encodes the shared clips, so N variants cost about one
+        full render plus N light encodes instead of N full renders. The shared stage always
+        renders in one pass, whatever the render mode.
+        """
+        variants = self.config.output_variants
+        variant_names = [variant.name for variant in variants]
+        if not all(variant_names) or len(set(variant_names)) != len(variant_names):
+            raise ValueError(f"Output variants need unique, non-empty names: {variant_names}")
+
+        shared_variant = OutputVariant(
+            "shared",
+            max(variant.max_width for variant in variants),
+            max(variant.max_height for variant in variants),
+        )
+        shared_compiler = self._create_variant_compiler(shared_variant)
+        transform_arguments = shared_compiler._get_head_tail_arguments()
+        if self.config.timelapse_options.video_stabilization:
+            transform_arguments["stabilization_data_file_path"] = shared_compiler._detect_video_stabilization(
+                self.video_collection
+            )
+        shared_video_collection = shared_compiler._transform(
+            "shared",
+            self.video_collection,
+            shared_compiler._transform_shared,
+            shared_compiler._derive_graph_output(shared_compiler._shared_graph, self.config.intermediate_encoding),
+            transform_arguments,
+        )
+
+        self.variant_compilers = []
+        for variant in variants:
+            compiler = self._create_variant_compiler(variant)
+            compiler._plan_and_diff_build_manifest()
+            compiler.compiled_video_collection = compiler._transform(
+                f"{variant.name}-compiled",
+                shared_video_collection,
+                compiler._transform_variant,
+                compiler._derive_graph_output(compiler._variant_graph, compiler.config.output_encoding),
+            )
+            compiler._record_segment_file_paths()
+            self.variant_compilers.append(compiler)
+
+    def _create_variant_compiler(self, variant: OutputVariant) -> "VideoCollectionCompiler":
+        compiler = VideoCollectionCompiler(self.config.get_variant_configuration(variant), self.video_collection)
+        compiler.variant_name = variant.name
+        # variants share the cache, the calibration and the job set of this compiler
+        compiler.job_scheduler = self.job_scheduler
+        compiler.process_manager = self.process_manager
+        compiler.scratch_cache = self.scratch_cache
+        compiler.cost_model = self.cost_model
+        compiler.render_plan = self.render_plan
+        compiler.batch = self.batch
+        compiler.before_job = self.before_job
+        compiler._hdr_tonemap_lut_file_paths = self._hdr_tonemap_lut_file_paths
+        return compiler
+
+    def _transform_shared(self, video: VideoInfo, output_file_path: str, transform_arguments: dict = {}) -> Stream:
+        stream = self._shared_graph(video, transform_arguments).apply()
+        return self._save(stream, output_file_path, self.config.intermediate_encoding)
+
+    def _shared_graph(self, video: VideoInfo, transform_arguments: dict) -> FilterGraph:
+        graph = self._head_tail_graph(video, transform_arguments)
+        if video.hdr:
+            graph.steps.append(self._hdr_to_sdr_step(video))
+        return graph
+
+    def _transform_variant(self, video: VideoInfo, output_file_path: str, transform_arguments: dict = {}) -> Stream:
+        stream = self._variant_graph(video, transform_arguments).apply()
+        return self._save(stream, output_file_path, self.config.output_encoding)
+
+    def _variant_graph(self, video: VideoInfo, transform_arguments: dict = {}) -> FilterGraph:
+        graph = FilterGraph([Segment(ffmpeg.input(video.file_path), [], self._get_stream_state(video))])
+        if video.width != self.config.timelapse_video.max_width:
+            graph.steps.append(Scale(self.config.timelapse_video.max_width))
+        graph.steps.extend(self._filter_steps(video))
+        return graph
+
+    def _transform_fused(self, video: VideoInfo, output_file_path: str, transform_arguments: dict = {}) -> Stream:
+        stream = self._fused_graph(video, transform_arguments).apply()
+        return self._save(stream, output_file_path, self.config.output_encoding)
+
+    def _fused_graph(self, video: VideoInfo, transform_arguments: dict) -> FilterGraph:
+        graph = self._head_tail_graph(video, transform_arguments)
+        graph.steps.extend(self._filter_steps(video))
+        return graph
+
     def _transform_head_tail_algorithm(self, video: VideoInfo, output_file_path: str, transform_arguments: dict = {}) -> Stream:
+        stream = self._head_tail_graph(video, transform_arguments).apply()
+        return self._save(stream, output_file_path, self.config.intermediate_encoding)
+
+    def _get_stream_state(self, video: VideoInfo, duration: float = None) -> StreamState:
+        duration = video.duration if duration is None else duration
+        try:
+            frame_rate = float(Fraction(video.average_frame_rate or video.frame_rate))
+        except (ValueError, ZeroDivisionError):
+            # an unknown rate keeps every frame rate conversion where it is
+            frame_rate = 0.0
+        return StreamState(video.width, video.height, duration * frame_rate, duration, video.hdr)
+
+    def _head_tail_graph(self, video: VideoInfo, transform_arguments: dict) -> FilterGraph:
         if (
             video.duration > transform_arguments["max_video_length"]
         ):  # TODO this calculation is wrong, we need to take into account the speed up factor
             # video length is longer than max_video_length, we need to split it into head and tail
-            video_head = (
-                ffmpeg.input(video.file_path, **{"noautorotate": None})
-                .trim(duration=transform_arguments["head_length"])
-                .filter(
-                    "setpts",
-                    str(self.config.timelapse_options.speed_up_factor) + "*PTS",
-                )
-                .filter("scale", self.config.timelapse_video.max_width, -1)
-            )
-            video_tail = (
-                ffmpeg.input(
-                    video.file_path,
-                    **{"noautorotate": None},
-                    ss=video.duration - transform_arguments["tail_length"],
-                )
-                .trim(duration=transform_arguments["tail_length"])
-                .filter(
-                    "setpts",
-                    str(self.config.timelapse_options.speed_up_factor) + "*PTS",
-                )
-                .filter("scale", self.config.timelapse_video.max_width, -1)
+            video_head = self._head_tail_segment(
+                video,
+                transform_arguments,
+                self.config.timelapse_options.speed_up_factor,
+                duration=transform_arguments["head_length"],
             )
-            return self._save(
-                ffmpeg.concat(video_head, video_tail), output_file_path
+            video_tail = self._head_tail_segment(
+                video,
+                transform_arguments,
+                self.config.timelapse_options.speed_up_factor,
+                start=video.duration - transform_arguments["tail_length"],
+                duration=transform_arguments["tail_length"],
             )
+            return FilterGraph([video_head, video_tail])
         else:
             # sped up video length is shorter than max_video_length, we can speed up the entire video to fit the max length
             speed_up_factor = (
-                self.config.directories.timelapse_options.speed_up_factor
+                self.config.timelapse_options.speed_up_factor
                 * transform_arguments["max_video_length"]
             ) / video.duration
             # if the speed up factor is greater than 1.0, we need to set it to 1.0 so we aren't in slow motion
             # (its okay if the video is shorter than the max length)
             if speed_up_factor > 1.0:
                 speed_up_factor = 1.0
-            video_full = (
-                ffmpeg.input(video.file_path, **{"noautorotate": None})
-                .filter("setpts", str(speed_up_factor) + "*PTS")
-                .filter("scale", self.config.directories.output_video.width, -1)
-            )
-            return self._save(video_full, output_file_path)
+            return FilterGraph([self._head_tail_segment(video, transform_arguments, speed_up_factor)])
 
-    def _apply_head_tail_algorithm(self, original_video_collection: VideoCollection) -> VideoCollection:
+    def _head_tail_segment(
+        self,
+        video: VideoInfo,
+        transform_arguments: dict,
+        speed_up_factor: float,
+        start: float = 0.0,
+        duration: float = None,
+    ) -> Segment:
+        # bound the read at the input so only the segment is demuxed and decoded: -ss seeks to
+        # the keyframe before start and decodes forward to it, -t stops reading at the end, and
+        # trim only guards the exact boundary
+        input_options = {"noautorotate": None}
+        if start:
+            input_options["ss"] = start
+        if duration is not None:
+            input_options["t"] = duration
+        stream = ffmpeg.input(video.file_path, **input_options)
+        if duration is not None:
+            stream = stream.trim(duration=duration)
+        state = self._get_stream_state(video, duration)
+
+        if "stabilization_data_file_path" not in transform_arguments:
+            return Segment(stream, [Scale(self.config.timelapse_video.max_width), SetPts(speed_up_factor)], state)
+
+        # the motion data was detected on the whole source clip at the analysis width, so the
+        # transform runs on the segment's source frames at that width before they are sped up
+        analysis_width = self._get_stabilization_analysis_width()
+        stabilization_data_file_path = self._get_stabilization_data_window_file_path(
+            transform_arguments["stabilization_data_file_path"](video),
+            self._get_frame_index(video, start),
+        )
+        steps: List[FilterStep] = [
+            Scale(analysis_width),
+            FrameFilter(
+                "vidstabtransform",
+                lambda stream: self._video_stabilization_filter(stream, stabilization_data_file_path),
+            ),
+            SetPts(speed_up_factor),
+        ]
+        if analysis_width != self.config.timelapse_video.max_width:
+            steps.append(Scale(self.config.timelapse_video.max_width))
+        return Segment(stream, steps, state)
+
+    def _get_head_tail_arguments(self) -> dict:
         duration = (
             self.config.timelapse_video.get_length_in_seconds() / self.video_collection.size()
         )
@@ -236,32 +896,53 @@ class VideoCollectionCompiler:
         tail_length = (
             video_part_length * self.config.timelapse_options.head_tail_ratio[1]
         )
-
-        return self._transform(
-            "head-tail-algorithm", original_video_collection, self._transform_head_tail_algorithm, {"duration": duration, "max_video_length": max_video_length, "head_length": head_length, "tail_length": tail_length}
-        )
+        return {"duration": duration, "max_video_length": max_video_length, "head_length": head_length, "tail_length": tail_length}
 
     def _transform_video_filters(
         self, video: VideoInfo, output_file_path: str, transform_arguments: dict = {}
     ) -> Stream:
-        stream = ffmpeg.input(video.file_path)
-        stream = self._apply_filters(stream, video)
-        return self._save(stream, output_file_path)
+        stream = self._video_filters_graph(video, transform_arguments).apply()
+        return self._save(stream, output_file_path, self.config.output_encoding)
+
+    def _video_filters_graph(self, video: VideoInfo, transform_arguments: dict = {}) -> FilterGraph:
+        graph = FilterGraph([Segment(ffmpeg.input(video.file_path), [], self._get_stream_state(video))])
+        graph.steps.extend(self._filter_steps(video))
+        return graph
 
-    def _apply_filters(self, stream: Stream, video: VideoInfo) -> Stream:
+    def _filter_steps(self, video: VideoInfo) -> List[FilterStep]:
+        steps: List[FilterStep] = []
         if video.hdr:
-            #print(f"\tfixing contrast for hdr video {video.file_path}")
-            stream = self._hdr_to_sdr_filter(stream)
+            steps.append(self._hdr_to_sdr_step(video))
 
         if self.config.timelapse_video.instagram_style:
-            stream = self._instagram_style_filter(stream)
+            steps.append(self._instagram_style_crop())
+
+        steps.append(
+            FrameFilter(
+                "drawtext",
+                lambda stream: self._draw_birthday_week(
+                    stream, video, self.config.timelapse_options.list_weeks_centered
+                ),
+            )
+        )
+        return steps
 
-        stream = self._draw_birthday_week(
-            stream, video, self.config.timelapse_options.list_weeks_centered
+    def _hdr_to_sdr_step(self, video: VideoInfo) -> PixelFilter:
+        return PixelFilter(
+            "hdr-to-sdr",
+            lambda stream: self._hdr_to_sdr_filter(stream, video),
+            tonemap=True,
         )
-        return stream
 
-    def _hdr_to_sdr_filter(self, stream: Stream) -> Stream:
+    def _hdr_to_sdr_filter(self, stream: Stream, video: VideoInfo) -> Stream:
+        if self.config.compiler_options.preview:
+            # drafts convert straight to bt709 without the float tonemap, highlights clip
+            # but colours and framing are close enough to review
+            return stream.filter("zscale", t="bt709", m="bt709", p="bt709", r="tv").filter(
+                "format", pix_fmts="yuv420p"
+            )
+        if self.config.timelapse_video.hdr_tonemap == "lut" and video.color_transfer in HDR_TONEMAP_LUT_TRANSFERS:
+            return self._hdr_to_sdr_lut_filter(stream, video.color_transfer)
         return (
             stream.filter("zscale", t="linear", npl=100)
             .filter("format", pix_fmts="gbrpf32le")
@@ -271,9 +952,63 @@ class VideoCollectionCompiler:
             .filter("format", pix_fmts="yuv420p")
         )
 
-    def _instagram_style_filter(self, stream: Stream) -> Stream:
-        return stream.filter(
-            "crop",
+    def _hdr_to_sdr_lut_filter(self, stream: Stream, color_transfer: str) -> Stream:
+        """
+        The exact tonemap chain baked into a 3D LUT, applied in 16 bit integer RGB
+
+        The per-pixel work is a matrix conversion and one interpolated lookup instead of
+        three zscale passes and the tonemap in 32 bit float.
+        """
+        lut = ffmpeg.input(self._get_hdr_tonemap_lut_file_path(color_transfer))
+        stream = stream.filter("scale", in_color_matrix="bt2020", in_range="tv", out_range="full").filter(
+            "format", pix_fmts="rgb48le"
+        )
+        return (
+            ffmpeg.filter([stream, lut], "haldclut")
+            .filter("scale", out_color_matrix="bt709", out_range="tv")
+            .filter("format", pix_fmts="yuv420p")
+            .filter("setparams", color_primaries="bt709", color_trc="bt709", colorspace="bt709", range="tv")
+        )
+
+    def _get_hdr_tonemap_lut_file_path(self, color_transfer: str) -> str:
+        """Generate the LUT once per source transfer by running a Hald CLUT identity image through the exact chain"""
+        if color_transfer in self._hdr_tonemap_lut_file_paths:
+            return self._hdr_tonemap_lut_file_paths[color_transfer]
+
+        def build_command(output_file_path: str) -> Stream:
+            return (
+                ffmpeg.input(f"haldclutsrc=level={HDR_TONEMAP_LUT_LEVEL}", f="lavfi")
+                .filter("format", pix_fmts="gbrpf32le")
+                .filter("zscale", tin=color_transfer, pin="bt2020", rin="full", t="linear", npl=100)
+                .filter("zscale", p="bt709")
+                .filter("tonemap", tonemap="hable", desat=0)
+                .filter("zscale", t="bt709", r="full")
+                .filter("format", pix_fmts="rgb48le")
+                .output(output_file_path, vframes=1, update=1)
+                .overwrite_output()
+            )
+
+        cache_entry = self.scratch_cache.get_entry(
+            f"hdr-tonemap-lut-{color_transfer}", "png", build_command(OUTPUT_FILE_PLACEHOLDER).compile()
+        )
+
+        def write_lut(file_path: str) -> None:
+            command = build_command(file_path)
+            self._print_ffmpeg_command(command)
+            self.run_ffmpeg_with_progress(
+                command.compile(),
+                description=f"generating {color_transfer} tonemap LUT",
+                partial_file_path=file_path,
+            )
+
+        if self.render_plan is None:
+            # batch threads share the scratch cache, so the LUT goes through its locked write
+            self.scratch_cache.write(cache_entry, write_lut)
+        self._hdr_tonemap_lut_file_paths[color_transfer] = cache_entry.file_path
+        return cache_entry.file_path
+
+    def _instagram_style_crop(self) -> Crop:
+        return Crop(
             self.config.timelapse_video.max_height * (9 / 16),
             self.config.timelapse_video.max_height,
             (
@@ -293,7 +1028,7 @@ class VideoCollectionCompiler:
                 text=timelapse_text,
                 x="(w-text_w)/2",
                 y="h-th-20",
-                fontsize=36,
+                fontsize=self.config.timelapse_video.font_size,
                 fontcolor="white",
             )
         else:
@@ -301,70 +1036,88 @@ class VideoCollectionCompiler:
                 text=timelapse_text,
                 x="w-tw-10",
                 y="h-th-10",
-                fontsize=36,
+                fontsize=self.config.timelapse_video.font_size,
                 fontcolor="white",
             )
 
-    def _save(self, stream: Stream, output_file_path: str) -> Stream:
-        return stream.output(
-            output_file_path,
-            r="30000/1001",
-            vcodec="libx264",
-            pix_fmt="yuv420p",
+    def _save(self, stream: Stream, output_file_path: str, encoding: EncodingProfile) -> Stream:
+        output_options = encoding.get_output_options()
+        if self._threads_per_job and "threads" not in output_options:
+            output_options["threads"] = self._threads_per_job
+        return self._apply_thread_budget(
+            stream.output(
+                output_file_path,
+                r=self.config.timelapse_video.frame_rate,
+                **output_options,
+            )
         )
 
-    def _get_unstabilized_video_file_path(self, video: VideoInfo) -> Tuple[str, str]:
-        unstabilized_file_name = f"{video.base_name}-unstabilized.mp4"
+    def _get_stabilization_analysis_width(self) -> int:
         return (
-            unstabilized_file_name,
-            f"{self.config.directories.scratch}/{unstabilized_file_name}",
+            self.config.timelapse_stabilization_options.analysis_width
+            or self.config.timelapse_video.max_width
         )
 
-    def _get_stabilization_data_file_path(self, video: VideoInfo) -> str:
-        return (
-            f"{self.config.directories.scratch}/{video.base_name}-stabilized-data.trf"
-        )
+    def _get_frame_index(self, video: VideoInfo, time: float) -> int:
+        if not time:
+            return 0
+        frame_rate = Fraction(video.average_frame_rate or video.frame_rate or "30000/1001")
+        return round(time * frame_rate)
 
+    def _detect_video_stabilization(self, video_collection: VideoCollection) -> Callable[[VideoInfo], str]:
+        """
+        Run vidstabdetect once over every whole source clip
 
-    def _apply_video_stabilization(
-        self, unstabilized_video_collection: VideoCollection
-    ) -> VideoCollection:
-        print(f"detecting video stabilization for {unstabilized_video_collection.size()} videos")
-        with tqdm(unstabilized_video_collection.sorted(), desc="detecting video stabilization", unit="video", colour="green") as pbar:
-            for video in pbar:
-                stabilization_data_file_path = self._get_stabilization_data_file_path(video)
-                if os.path.isfile(stabilization_data_file_path):
-                    continue
-
-                command = (
-                    ffmpeg.input(video.file_path)
-                    .filter(
-                        "vidstabdetect",
-                        shakiness=self.config.timelapse_stabilization_options.shakiness,
-                        result=stabilization_data_file_path,
-                    )
-                    .output("-", f="null")
+        The motion data only depends on the source clip and the detection parameters, so
+        changing the timelapse length or head-tail ratio reuses it from the scratch cache.
+
+        Returns:
+            A lookup of each video's motion data file
+        """
+        print(f"detecting video stabilization for {video_collection.size()} videos")
+        cache_entries, jobs = self._plan_jobs(
+            "stabilized-data",
+            video_collection,
+            lambda video, output_file_path: self._apply_thread_budget(
+                ffmpeg.input(video.file_path, **{"noautorotate": None})
+                .filter("scale", self._get_stabilization_analysis_width(), -1)
+                .filter(
+                    "vidstabdetect",
+                    shakiness=self.config.timelapse_stabilization_options.shakiness,
+                    result=output_file_path,
+                    **get_vidstabdetect_format_options(),
                 )
-                self._print_ffmpeg_command(command)
-                ffmpeg_command = command.compile()
-                self.run_ffmpeg_with_progress(ffmpeg_command, video.duration, f"processing {video.base_name}...")
+                .output("-", f="null")
+            ),
+            lambda video: video.duration,
+            extension="trf",
+        )
+        self._run_jobs(jobs, "detecting video stabilization", video_collection.size())
+        return lambda video: cache_entries[video.base_name].file_path
 
-        return self._transform(
-            "stabilized",
-            unstabilized_video_collection,
-            self._transform_video_stabilization,
-            {"stabilization_data_file_path": self._get_stabilization_data_file_path},
+    def _get_stabilization_data_window_file_path(self, stabilization_data_file_path: str, first_frame: int) -> str:
+        if first_frame == 0:
+            return stabilization_data_file_path
+        stabilization_data_file_name = os.path.basename(stabilization_data_file_path)
+        cache_entry = self.scratch_cache.get_entry(
+            stabilization_data_file_name.split(".")[0].replace("-stabilized-data", "-stabilized-window"),
+            "trf",
+            [stabilization_data_file_name, str(first_frame)],
         )
+        # only written once the jobs reading it run, building commands and keys writes nothing
+        self._stabilization_data_windows[cache_entry.file_path] = (cache_entry, stabilization_data_file_path, first_frame)
+        return cache_entry.file_path
 
-    def _transform_video_stabilization(
-        self, video: VideoInfo, output_file_path: str, transform_arguments: dict = {}
-    ) -> Stream:
-        return (
-            ffmpeg.input(video.file_path)
-            .filter(
-                "vidstabtransform",
-                smoothing=self.config.timelapse_stabilization_options.smoothing,
-                input=transform_arguments["stabilization_data_file_path"](video),
+    def _write_stabilization_data_windows(self, windows: Iterable[Tuple[CacheEntry, str, int]]) -> None:
+        for cache_entry, stabilization_data_file_path, first_frame in windows:
+            self.scratch_cache.write(
+                cache_entry,
+                lambda file_path: write_motion_data_window(stabilization_data_file_path, file_path, first_frame),
             )
-            .output(output_file_path)
+
+    def _video_stabilization_filter(self, stream: Stream, stabilization_data_file_path: str) -> Stream:
+        return stream.filter(
+            "vidstabtransform",
+            smoothing=self.config.timelapse_stabilization_options.smoothing,
+            input=stabilization_data_file_path,
         )
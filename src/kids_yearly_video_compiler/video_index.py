@@ -0,0 +1,139 @@
+from contextlib import contextmanager
+from datetime import date
+import os
+import sqlite3
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+
+from kids_yearly_video_compiler.video_inspector import VideoInfo
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS videos (
+    file_path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    date_taken TEXT,
+    base_name TEXT NOT NULL,
+    duration REAL NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    hdr INTEGER NOT NULL,
+    codec_name TEXT NOT NULL,
+    pix_fmt TEXT NOT NULL,
+    frame_rate TEXT NOT NULL,
+    average_frame_rate TEXT NOT NULL,
+    color_transfer TEXT NOT NULL
+);
+"""
+
+COLUMNS = (
+    "file_path",
+    "size",
+    "mtime_ns",
+    "date_taken",
+    "base_name",
+    "duration",
+    "width",
+    "height",
+    "hdr",
+    "codec_name",
+    "pix_fmt",
+    "frame_rate",
+    "average_frame_rate",
+    "color_transfer",
+)
+
+# (size, mtime_ns) of a file, it is probed again as soon as either changes
+FileIdentity = Tuple[int, int]
+
+
+class VideoIndex:
+    """
+    SQLite index of probed video metadata, kept in the scratch directory
+
+    Entries are keyed by absolute path, size and modification time, so a file is only
+    probed again when it was added or changed. A date taken that couldn't be parsed from
+    the file name is stored as NULL and falls back to today on every lookup, like a fresh
+    probe would.
+    """
+
+    def __init__(self, database_file_path: str):
+        self.database_file_path = database_file_path
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.database_file_path, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def lookup(self, directory: str, identities: Dict[str, FileIdentity]) -> Dict[str, VideoInfo]:
+        """
+        Look up the videos of a directory, dropping the entries of files that are gone
+
+        Args:
+            directory: Absolute path of the directory
+            identities: (size, mtime_ns) of every file in the directory, by absolute path
+
+        Returns:
+            The indexed videos of the files that didn't change, by absolute path
+        """
+        with self._connect() as connection:
+            rows = connection.execute(f"SELECT {', '.join(COLUMNS)} FROM videos").fetchall()
+            removed_file_paths = [
+                (row[0],) for row in rows if os.path.dirname(row[0]) == directory and row[0] not in identities
+            ]
+            connection.executemany("DELETE FROM videos WHERE file_path = ?", removed_file_paths)
+        videos = {}
+        for row in rows:
+            file_path, size, mtime_ns, date_taken = row[:4]
+            if identities.get(file_path) != (size, mtime_ns):
+                continue
+            videos[file_path] = VideoInfo(
+                date_taken=date.fromisoformat(date_taken) if date_taken else date.today(),
+                base_name=row[4],
+                file_path=file_path,
+                duration=row[5],
+                width=row[6],
+                height=row[7],
+                hdr=bool(row[8]),
+                codec_name=row[9],
+                pix_fmt=row[10],
+                frame_rate=row[11],
+                average_frame_rate=row[12],
+                color_transfer=row[13],
+            )
+        return videos
+
+    def store(self, videos: Sequence[Tuple[VideoInfo, FileIdentity, Optional[date]]]) -> None:
+        """Store probed videos with the identity of their file and the date parsed from their name"""
+        with self._connect() as connection:
+            connection.executemany(
+                f"INSERT OR REPLACE INTO videos ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                [
+                    (
+                        os.path.abspath(video.file_path),
+                        size,
+                        mtime_ns,
+                        date_taken.isoformat() if date_taken else None,
+                        video.base_name,
+                        video.duration,
+                        video.width,
+                        video.height,
+                        int(video.hdr),
+                        video.codec_name,
+                        video.pix_fmt,
+                        video.frame_rate,
+                        video.average_frame_rate,
+                        video.color_transfer,
+                    )
+                    for video, (size, mtime_ns), date_taken in videos
+                ],
+            )
+
+
+def get_video_index_file_path(scratch_directory: str) -> str:
+    return os.path.join(scratch_directory, "video-index.sqlite")
@@ -1,11 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
-from dataclasses import dataclass
+from dataclasses import dataclass, field, fields, replace
+import json
 import os
 import re
-from typing import List
-import ffmpeg
+import subprocess
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
+if TYPE_CHECKING:
+    from kids_yearly_video_compiler.video_index import FileIdentity, VideoIndex
 
+DEFAULT_PROBE_TIMEOUT = 30.0
+
+
+def _with_slots(cls: type) -> type:
+    """dataclass(slots=True) for python before 3.10, rebuilds the class with a slot per field"""
+    field_names = tuple(f.name for f in fields(cls))
+    namespace = {
+        key: value for key, value in cls.__dict__.items() if key not in field_names + ("__dict__", "__weakref__")
+    }
+    namespace["__slots__"] = field_names
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
+# a record per clip, so slots keep large libraries from paying for an attribute dict each
+@_with_slots
 @dataclass
 class VideoInfo:
     date_taken: date = date.today()
@@ -14,8 +33,17 @@ class VideoInfo:
     duration: float = 0.0
     width: int = 0
     height: int = 0
-    probe_info: dict = None
+    probe_info: dict = None  # raw ffprobe stream, only kept when asked for
     hdr: bool = False
+    codec_name: str = ""
+    pix_fmt: str = ""
+    frame_rate: str = ""
+    average_frame_rate: str = ""
+    color_transfer: str = ""  # e.g. "arib-std-b67" for HLG, "smpte2084" for PQ
+
+    def get_clip_parameters(self) -> Tuple[str, int, int, str, str]:
+        """Parameters that must match for clips to be joined without re-encoding"""
+        return (self.codec_name, self.width, self.height, self.pix_fmt, self.frame_rate)
 
     def get_since_birthday(self, birthday: date) -> str:
         days = self.date_taken - birthday
@@ -32,45 +60,172 @@ class VideoInfo:
             return f"Year {year} / Week {week}"
 
 
-def get_all_video_info(path: str) -> List[VideoInfo]:
-    video_file_names = [
+class VideoProbeError(Exception):
+    """Raised when ffprobe fails, times out, prints invalid output or finds no usable video stream in a file."""
+
+    def __init__(self, video_file_name: str, message: str):
+        super().__init__(f"error probing {video_file_name}: {message}")
+        self.video_file_name = video_file_name
+        self.message = message
+
+
+@dataclass
+class ProbeResults:
+    videos: List[VideoInfo] = field(default_factory=list)
+    errors: List[VideoProbeError] = field(default_factory=list)
+
+
+def get_video_file_names(path: str) -> List[str]:
+    return sorted(
         video_file_name
         for video_file_name in os.listdir(path)
         if os.path.isfile(path + "/" + video_file_name)
         and not video_file_name.startswith(".")
-    ]
-    return [
-        get_video_info(path, video_file_name) for video_file_name in video_file_names
-    ]
+    )
 
 
-def get_video_info(path: str, video_file_name: str, base_name: str = None) -> VideoInfo:
-    video_file_path = os.path.join(path, video_file_name)
+def probe_all_video_info(
+    path: str,
+    max_workers: int = 0,
+    timeout: Optional[float] = DEFAULT_PROBE_TIMEOUT,
+    video_index: "VideoIndex" = None,
+) -> ProbeResults:
+    """
+    Probe every video in a folder using a bounded pool of ffprobe processes
+
+    Args:
+        path: Folder containing the videos
+        max_workers: Number of concurrent ffprobe processes (0 uses the number of cores)
+        timeout: Seconds to wait for a single ffprobe before giving up on that file
+        video_index: Index of earlier probes, only files it doesn't know unchanged are probed
+
+    Returns:
+        The probed videos in file name order and the errors of every file that failed
+    """
+    video_file_names = get_video_file_names(path)
+    max_workers = max_workers or os.cpu_count() or 1
+
+    identities: Dict[str, "FileIdentity"] = {}
+    indexed_videos: Dict[str, VideoInfo] = {}
+    if video_index is not None:
+        directory = os.path.abspath(path)
+        for video_file_name in video_file_names:
+            try:
+                stat = os.stat(os.path.join(directory, video_file_name))
+            except OSError:
+                continue
+            identities[os.path.join(directory, video_file_name)] = (stat.st_size, stat.st_mtime_ns)
+        indexed_videos = video_index.lookup(directory, identities)
+
+    def get_indexed_video(video_file_name: str) -> Optional[VideoInfo]:
+        video_file_path = os.path.join(path, video_file_name)
+        indexed_video = indexed_videos.get(os.path.abspath(video_file_path))
+        # keep the path as given, it ends up in ffmpeg commands and so in cache keys
+        return replace(indexed_video, file_path=video_file_path) if indexed_video else None
+
+    def probe_video(video_file_name: str):
+        try:
+            return get_video_info(path, video_file_name, timeout=timeout)
+        except VideoProbeError as e:
+            return e
+
+    unindexed_file_names = [name for name in video_file_names if get_indexed_video(name) is None]
+    probed = {}
+    if unindexed_file_names:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unindexed_file_names)))) as executor:
+            probed = dict(zip(unindexed_file_names, executor.map(probe_video, unindexed_file_names)))
+
+    results = ProbeResults()
+    new_videos = []
+    for video_file_name in video_file_names:
+        result = probed.get(video_file_name) or get_indexed_video(video_file_name)
+        if isinstance(result, VideoProbeError):
+            results.errors.append(result)
+            continue
+        results.videos.append(result)
+        identity = identities.get(os.path.abspath(result.file_path))
+        if video_file_name in probed and identity:
+            new_videos.append((result, identity, get_date_taken(video_file_name)))
+    if video_index is not None and new_videos:
+        video_index.store(new_videos)
+    return results
+
+
+def get_all_video_info(
+    path: str,
+    max_workers: int = 0,
+    timeout: Optional[float] = DEFAULT_PROBE_TIMEOUT,
+    video_index: "VideoIndex" = None,
+) -> List[VideoInfo]:
+    results = probe_all_video_info(path, max_workers, timeout, video_index)
+    for error in results.errors:
+        print(error)
+    if results.errors:
+        print(f"skipped {len(results.errors)} videos that could not be probed")
+    return results.videos
+
+
+def probe(video_file_path: str, timeout: Optional[float] = None) -> dict:
+    args = ["ffprobe", "-show_format", "-show_streams", "-of", "json", video_file_path]
+    video_file_name = os.path.basename(video_file_path)
+    try:
+        process = subprocess.run(args, capture_output=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise VideoProbeError(video_file_name, f"ffprobe timed out after {timeout} seconds")
+    except OSError as e:
+        raise VideoProbeError(video_file_name, str(e))
+    if process.returncode != 0:
+        raise VideoProbeError(
+            video_file_name, f"ffprobe error: {process.stderr.decode('utf-8', errors='replace').strip()}"
+        )
     try:
-        probe = ffmpeg.probe(video_file_path)
-    except ffmpeg.Error as e:
-        print(f"error probing {video_file_name}: {e}")
-        print(f"ffprobe error: {e.stderr.decode('utf-8')}")
-        exit(1)
+        return json.loads(process.stdout.decode("utf-8"))
+    except ValueError as e:
+        raise VideoProbeError(video_file_name, f"invalid ffprobe output: {e}")
+
+
+def get_video_info(
+    path: str,
+    video_file_name: str,
+    base_name: str = None,
+    timeout: Optional[float] = None,
+    keep_probe_info: bool = False,
+) -> VideoInfo:
+    video_file_path = os.path.join(path, video_file_name)
+    probe_info = probe(video_file_path, timeout)
 
     video = next(
-        (stream for stream in probe["streams"] if stream["codec_type"] == "video"), None
+        (stream for stream in probe_info.get("streams", []) if stream.get("codec_type") == "video"), None
     )
-    video_date = date.today()
-    regex = re.match(r".*?PXL_(\d\d\d\d)(\d\d)(\d\d).*", video_file_name)
-    if regex:
-        video_date = date.fromisoformat(
-            f"{regex.group(1)}-{regex.group(2)}-{regex.group(3)}"
-        )
     if not video:
-        return VideoInfo()
+        raise VideoProbeError(video_file_name, "no video stream found")
+    try:
+        duration, width, height = float(video["duration"]), int(video["width"]), int(video["height"])
+    except KeyError as e:
+        raise VideoProbeError(video_file_name, f"video stream has no {e}")
+    except (TypeError, ValueError) as e:
+        raise VideoProbeError(video_file_name, f"invalid video stream: {e}")
     return VideoInfo(
-        date_taken=video_date,
+        date_taken=get_date_taken(video_file_name) or date.today(),
         base_name=base_name or video_file_name.split(".")[0],
         file_path=video_file_path,
-        duration=float(video["duration"]),
-        width=int(video["width"]),
-        height=int(video["height"]),
-        hdr=video["color_primaries"] == "bt2020",  # "bt709" is for normal videos
-        probe_info=video,
+        duration=duration,
+        width=width,
+        height=height,
+        hdr=video.get("color_primaries") == "bt2020",  # "bt709" is for normal videos
+        # thousands of clips are kept in memory, so the raw stream is dropped by default
+        probe_info=video if keep_probe_info else None,
+        codec_name=video.get("codec_name", ""),
+        pix_fmt=video.get("pix_fmt", ""),
+        frame_rate=video.get("r_frame_rate", ""),
+        average_frame_rate=video.get("avg_frame_rate", ""),
+        color_transfer=video.get("color_transfer", ""),
     )
+
+
+def get_date_taken(video_file_name: str) -> Optional[date]:
+    """Date in a Pixel camera file name, e.g. PXL_20230412_..., None when there is none"""
+    regex = re.match(r".*?PXL_(\d\d\d\d)(\d\d)(\d\d).*", video_file_name)
+    if not regex:
+        return None
+    return date.fromisoformat(f"{regex.group(1)}-{regex.group(2)}-{regex.group(3)}")
@@ -0,0 +1,52 @@
+from dataclasses import dataclass
+import re
+import subprocess
+from typing import List, Optional
+
+from kids_yearly_video_compiler.ffmpeg_progress import STDERR_TAIL_LINES, FfmpegError
+
+SSIM_PATTERN = re.compile(r"SSIM .*All:(\d+(?:\.\d+)?)")
+PSNR_PATTERN = re.compile(r"PSNR .*average:(\d+(?:\.\d+)?|inf)")
+
+
+@dataclass
+class QualityMetrics:
+    ssim: float  # 1.0 is identical
+    psnr: float  # in dB, inf is identical
+
+
+def get_quality_command(reference_file_path: str, distorted_file_path: str) -> List[str]:
+    return [
+        "ffmpeg", "-hide_banner", "-nostats",
+        "-i", distorted_file_path,
+        "-i", reference_file_path,
+        "-filter_complex", "[0:v]split[d0][d1];[1:v]split[r0][r1];[d0][r0]ssim;[d1][r1]psnr",
+        "-f", "null", "-",
+    ]
+
+
+def parse_quality_metrics(stderr: str) -> Optional[QualityMetrics]:
+    ssim_match = SSIM_PATTERN.search(stderr)
+    psnr_match = PSNR_PATTERN.search(stderr)
+    if not ssim_match or not psnr_match:
+        return None
+    return QualityMetrics(ssim=float(ssim_match.group(1)), psnr=float(psnr_match.group(1)))
+
+
+def measure_quality(reference_file_path: str, distorted_file_path: str) -> QualityMetrics:
+    """
+    Compare two videos of the same size and frame count with ffmpeg's ssim and psnr filters
+
+    Raises:
+        FfmpegError: if ffmpeg fails or doesn't report both metrics
+    """
+    process = subprocess.run(
+        get_quality_command(reference_file_path, distorted_file_path),
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        universal_newlines=True,
+    )
+    metrics = parse_quality_metrics(process.stderr)
+    if process.returncode != 0 or metrics is None:
+        raise FfmpegError(process.returncode, process.stderr.splitlines()[-STDERR_TAIL_LINES:])
+    return metrics
@@ -0,0 +1,212 @@
+import asyncio
+from dataclasses import dataclass, field, replace
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+from kids_yearly_video_compiler.configuration import Configuration
+from kids_yearly_video_compiler.video_collection import VideoCollection
+from kids_yearly_video_compiler.video_collection_compiler import VideoCollectionCompiler
+from kids_yearly_video_compiler.video_index import FileIdentity, VideoIndex, get_video_index_file_path
+from kids_yearly_video_compiler.video_inspector import (
+    VideoInfo,
+    VideoProbeError,
+    get_date_taken,
+    get_video_file_names,
+    get_video_info,
+)
+
+DEFAULT_POLL_INTERVAL = 10.0
+# a file whose size and modification time didn't change for this long is done being copied
+DEFAULT_STABLE_SECONDS = 30.0
+# the whole collection is pre-rendered once no clip arrived for this long
+DEFAULT_SETTLE_SECONDS = 600.0
+DEFAULT_NICE = 10
+
+
+@dataclass
+class _FileState:
+    size: int
+    mtime_ns: int
+    unchanged_since: float
+
+
+@dataclass
+class DirectoryChanges:
+    ready: List[str] = field(default_factory=list)  # new or changed files that stopped changing
+    removed: List[str] = field(default_factory=list)
+    identities: Dict[str, FileIdentity] = field(default_factory=dict)  # of the ready files
+
+
+class InputDirectoryWatcher:
+    """
+    Polls the input directory for video files that finished arriving
+
+    A file is ready once its size and modification time stayed the same for
+    stable_seconds, so clips still being copied from a phone aren't probed half written.
+    """
+
+    def __init__(self, directory: str, stable_seconds: float = DEFAULT_STABLE_SECONDS):
+        self.directory = directory
+        self.stable_seconds = stable_seconds
+        self._pending: Dict[str, _FileState] = {}
+        self._ready: Dict[str, FileIdentity] = {}
+
+    def poll(self, now: float = None) -> DirectoryChanges:
+        now = time.monotonic() if now is None else now
+        changes = DirectoryChanges()
+        seen = set()
+        for file_name in get_video_file_names(self.directory):
+            try:
+                stat = os.stat(os.path.join(self.directory, file_name))
+            except OSError:
+                continue
+            seen.add(file_name)
+            identity = (stat.st_size, stat.st_mtime_ns)
+            if self._ready.get(file_name) == identity:
+                continue
+            state = self._pending.get(file_name)
+            if state is None or (state.size, state.mtime_ns) != identity:
+                self._pending[file_name] = _FileState(stat.st_size, stat.st_mtime_ns, now)
+            elif now - state.unchanged_since >= self.stable_seconds:
+                del self._pending[file_name]
+                self._ready[file_name] = identity
+                changes.ready.append(file_name)
+                changes.identities[file_name] = identity
+
+        for file_name in set(self._ready) - seen:
+            del self._ready[file_name]
+            changes.removed.append(file_name)
+        for file_name in set(self._pending) - seen:
+            del self._pending[file_name]
+        return changes
+
+
+def is_host_busy(max_load: float) -> bool:
+    """Whether the one minute load average is above max_load"""
+    return bool(max_load) and hasattr(os, "getloadavg") and os.getloadavg()[0] > max_load
+
+
+def wait_for_idle_host(max_load: float, poll_interval: float, sleep: Callable[[float], None] = time.sleep) -> None:
+    """Block while the one minute load average is above max_load"""
+    while is_host_busy(max_load):
+        sleep(poll_interval)
+
+
+def create_warm_up_compiler(
+    config: Configuration, videos: List[VideoInfo], max_load: float, poll_interval: float
+) -> VideoCollectionCompiler:
+    """A compiler that checks the load again before each of its jobs, not only before it starts"""
+    compiler = VideoCollectionCompiler(config, VideoCollection(videos))
+
+    async def wait_for_idle_host_between_jobs() -> None:
+        while is_host_busy(max_load):
+            await asyncio.sleep(poll_interval)
+
+    compiler.before_job = wait_for_idle_host_between_jobs
+    return compiler
+
+
+def watch(
+    config: Configuration,
+    poll_interval: float = DEFAULT_POLL_INTERVAL,
+    stable_seconds: float = DEFAULT_STABLE_SECONDS,
+    settle_seconds: float = DEFAULT_SETTLE_SECONDS,
+    max_load: Optional[float] = None,
+    nice: int = DEFAULT_NICE,
+) -> None:
+    """
+    Keep the scratch cache warm while clips arrive, until interrupted
+
+    Work that only depends on a clip itself (probing and stabilization analysis) runs as
+    soon as the clip is ready. Every other per-clip stage depends on the number of clips,
+    so the whole collection is compiled, without the final save, once no clip arrived for
+    settle_seconds. The yearly run then only has to join the cached segments.
+
+    Args:
+        config: Configuration of the compilation to keep warm
+        poll_interval: Seconds between scans of the input directory
+        stable_seconds: Seconds a file has to stay unchanged before it is probed
+        settle_seconds: Seconds without new clips before the collection is pre-rendered
+        max_load: Load average above which no new work starts, None uses the number of cores
+        nice: Niceness added to this process and the ffmpeg processes it starts
+    """
+    if nice and hasattr(os, "nice"):
+        os.nice(nice)
+    if max_load is None:
+        max_load = float(os.cpu_count() or 1)
+    if not config.compiler_options.cpu_budget:
+        # leave half the cores to whatever else the host is doing
+        config = replace(
+            config,
+            compiler_options=replace(config.compiler_options, cpu_budget=max(1, (os.cpu_count() or 1) // 2)),
+        )
+
+    watcher = InputDirectoryWatcher(config.directories.input_videos, stable_seconds)
+    # the yearly run then finds the clips probed here in the index
+    video_index = VideoIndex(get_video_index_file_path(config.directories.scratch))
+    videos: Dict[str, VideoInfo] = {}
+    last_change = time.monotonic()
+    # bumped on every added, changed or removed clip
+    generation, warm_generation = 0, -1
+    print(f"watching {config.directories.input_videos} for new clips")
+    while True:
+        changes = watcher.poll()
+        for file_name in changes.removed:
+            videos.pop(file_name, None)
+        new_videos = probe_ready_videos(config, changes, video_index)
+        for video in new_videos:
+            videos[os.path.basename(video.file_path)] = video
+        if changes.ready or changes.removed:
+            generation += 1
+            last_change = time.monotonic()
+
+        if new_videos and config.timelapse_options.video_stabilization:
+            wait_for_idle_host(max_load, poll_interval)
+            print(f"analysing {len(new_videos)} new clips")
+
+            def analyse_new_videos() -> None:
+                compiler = create_warm_up_compiler(config, new_videos, max_load, poll_interval)
+                compiler._detect_video_stabilization(compiler.video_collection)
+
+            _run_warm_up(analyse_new_videos)
+
+        if videos and generation != warm_generation and time.monotonic() - last_change >= settle_seconds:
+            wait_for_idle_host(max_load, poll_interval)
+            print(f"pre-rendering {len(videos)} clips")
+            if _run_warm_up(
+                lambda: create_warm_up_compiler(config, list(videos.values()), max_load, poll_interval).compile()
+            ):
+                warm_generation = generation
+            else:
+                # try again after another quiet period
+                last_change = time.monotonic()
+
+        time.sleep(poll_interval)
+
+
+def probe_ready_videos(config: Configuration, changes: DirectoryChanges, video_index: VideoIndex) -> List[VideoInfo]:
+    """Probe the files that became ready and store them in the video index"""
+    new_videos = []
+    for file_name in changes.ready:
+        try:
+            video = get_video_info(
+                config.directories.input_videos, file_name, timeout=config.compiler_options.probe_timeout
+            )
+        except VideoProbeError as e:
+            print(e)
+            continue
+        new_videos.append((video, changes.identities[file_name], get_date_taken(file_name)))
+    if new_videos:
+        video_index.store(new_videos)
+    return [video for video, _, _ in new_videos]
+
+
+def _run_warm_up(function: Callable[[], object]) -> bool:
+    """Run a warm up step, a failing one is reported and tried again later instead of stopping the watcher"""
+    try:
+        function()
+    except Exception as e:
+        print(f"warm up failed, retrying after the next quiet period: {e!r}")
+        return False
+    return True
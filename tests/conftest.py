@@ -0,0 +1,16 @@
+import stat
+
+import pytest
+
+
+@pytest.fixture
+def write_fake_ffmpeg(tmp_path):
+    """Write a shell script standing in for ffmpeg and return its path"""
+
+    def write(script):
+        fake_ffmpeg = tmp_path / "ffmpeg"
+        fake_ffmpeg.write_text("#!/bin/sh\n" + script)
+        fake_ffmpeg.chmod(fake_ffmpeg.stat().st_mode | stat.S_IEXEC)
+        return str(fake_ffmpeg)
+
+    return write
@@ -0,0 +1,127 @@
+from datetime import date
+import os
+import threading
+from types import SimpleNamespace
+
+from kids_yearly_video_compiler import batch_compiler
+from kids_yearly_video_compiler.batch_compiler import BatchCompiler
+from kids_yearly_video_compiler.configuration import Configuration, EncodingProfile
+from kids_yearly_video_compiler.job_scheduler import FfmpegJob, JobScheduler
+from kids_yearly_video_compiler.video_collection import VideoCollection
+from kids_yearly_video_compiler.video_collection_compiler import VideoCollectionCompiler
+from kids_yearly_video_compiler.video_inspector import VideoInfo
+
+
+def _config(tmp_path, name, input_videos):
+    config = Configuration()
+    config.kid_info.name = name
+    config.directories.input_videos = str(tmp_path / input_videos)
+    config.directories.scratch = str(tmp_path / "scratch")
+    return config
+
+
+def test_batch_probes_each_folder_once_and_runs_shared_jobs_once(tmp_path, monkeypatch):
+    (tmp_path / "scratch").mkdir()
+    probed_directories = []
+
+    def fake_get_all_video_info(path, max_workers=0, timeout=None, video_index=None):
+        probed_directories.append(path)
+        return [VideoInfo(date_taken=date(2023, 1, 8), base_name="PXL_20230108", duration=10.0, width=1920, height=1080)]
+
+    def fake_compile(compiler):
+        # two stages; the first one is identical for every kid reading the same clips
+        for stage in ("stabilized-data", f"compiled-{compiler.config.kid_info.name}"):
+            cache_entry = compiler.scratch_cache.get_entry(f"PXL_20230108-{stage}", "mp4", [stage])
+            compiler._run_jobs([FfmpegJob([stage], 10.0, stage, cache_entry, threads=1)], stage, 1)
+
+    ran_jobs = []
+    lock = threading.Lock()
+
+    async def fake_run_job(compiler, job, position):
+        with lock:
+            ran_jobs.append(job.command[0])
+        with open(job.cache_entry.partial_file_path, "w") as f:
+            f.write(job.command[0])
+        compiler.scratch_cache.commit(job.cache_entry)
+
+    monkeypatch.setattr(batch_compiler, "get_all_video_info", fake_get_all_video_info)
+    monkeypatch.setattr(VideoCollectionCompiler, "compile", fake_compile)
+    monkeypatch.setattr(VideoCollectionCompiler, "_run_job", fake_run_job)
+
+    batch = BatchCompiler(
+        [_config(tmp_path, "alice", "clips"), _config(tmp_path, "bob", "clips"), _config(tmp_path, "carol", "other")]
+    )
+    batch.compile()
+
+    assert probed_directories == [str(tmp_path / "clips"), str(tmp_path / "other")]
+    assert batch.errors == {}
+    assert sorted(ran_jobs) == ["compiled-alice", "compiled-bob", "compiled-carol", "stabilized-data"]
+
+
+def test_batch_runs_jobs_of_each_width_as_many_at_once_as_fit_the_cpu_budget(tmp_path):
+    batch = BatchCompiler([_config(tmp_path, "alice", "clips"), _config(tmp_path, "bob", "clips")])
+    submissions = [
+        SimpleNamespace(compiler=SimpleNamespace(job_scheduler=job_scheduler))
+        for job_scheduler in (JobScheduler(8), JobScheduler(8, 6))
+    ]
+    jobs = [FfmpegJob([str(threads)], 10.0, str(threads), None, threads=threads) for threads in (1, 8, 1, 2)]
+
+    job_groups = batch._plan_job_groups(submissions, jobs)
+
+    assert [(job_scheduler.max_jobs, [job.threads for job in group]) for job_scheduler, group in job_groups] == [
+        (1, [8]),
+        (4, [2]),
+        (6, [1, 1]),
+    ]
+
+
+def test_batch_save_runs_the_final_encoding_jobs_on_each_compilers_scheduler(tmp_path, monkeypatch):
+    (tmp_path / "scratch").mkdir()
+    (tmp_path / "output").mkdir()
+    config = _config(tmp_path, "alice", "clips")
+    config.directories.output_video = str(tmp_path / "output")
+    config.final_encoding = EncodingProfile(codec="libx265", crf=26)
+    videos = [
+        VideoInfo(
+            base_name=f"clip-{index}",
+            file_path=str(tmp_path / f"clip-{index}.mp4"),
+            duration=2.0,
+            width=1920,
+            height=1080,
+            codec_name="h264",
+            pix_fmt="yuv420p",
+            frame_rate="30/1",
+        )
+        for index in range(2)
+    ]
+
+    def fake_compile(compiler):
+        compiler.compiled_video_collection = VideoCollection(videos)
+
+    ran_jobs = []
+
+    async def fake_run_job(compiler, job, position):
+        ran_jobs.append(job.description)
+        with open(job.cache_entry.partial_file_path, "w") as f:
+            f.write(job.description)
+        compiler.scratch_cache.commit(job.cache_entry)
+
+    def fake_run_ffmpeg_with_progress(compiler, command, duration=None, description="", position=0, partial_file_path=None):
+        with open(partial_file_path, "w") as f:
+            f.write(description)
+
+    monkeypatch.setattr(batch_compiler, "get_all_video_info", lambda *args, **kwargs: videos)
+    monkeypatch.setattr(VideoCollectionCompiler, "compile", fake_compile)
+    monkeypatch.setattr(VideoCollectionCompiler, "_run_job", fake_run_job)
+    monkeypatch.setattr(VideoCollectionCompiler, "run_ffmpeg_with_progress", fake_run_ffmpeg_with_progress)
+    batch = BatchCompiler([config])
+    batch.compile()
+
+    # used to wait forever for a batch loop that had already ended
+    save = threading.Thread(target=batch.save, daemon=True)
+    save.start()
+    save.join(timeout=10)
+
+    assert not save.is_alive()
+    assert ran_jobs
+    assert len(os.listdir(tmp_path / "output")) == 1
@@ -0,0 +1,81 @@
+import os
+from datetime import date
+
+from kids_yearly_video_compiler import benchmark
+from kids_yearly_video_compiler.benchmark import check_quality, compare_results
+from kids_yearly_video_compiler.video_collection_compiler import VideoCollectionCompiler
+from kids_yearly_video_compiler.video_inspector import VideoInfo
+from kids_yearly_video_compiler.video_quality import QualityMetrics
+
+
+def test_compare_results_flags_slowdowns_over_threshold():
+    baseline = {"results": {"sdr-1080p-landscape": {"save": 2.0, "video_filters": 10.0}}}
+    results = {"results": {"sdr-1080p-landscape": {"save": 2.2, "video_filters": 12.0, "end_to_end_fused": 5.0}}}
+
+    regressions = compare_results(baseline, results, threshold=0.15)
+
+    assert regressions == ["sdr-1080p-landscape/video_filters: 10.00s -> 12.00s (+20%)"]
+
+
+def test_check_quality_flags_approximations_below_the_floor():
+    results = {
+        "quality": {
+            "hdr-1080p-landscape/hdr_tonemap_lut": {"ssim": 0.995, "psnr": 44.0},
+            "hdr-2160p-landscape/hdr_tonemap_lut": {"ssim": 0.95, "psnr": 31.0},
+        }
+    }
+
+    assert check_quality(results, 0.98) == ["hdr-2160p-landscape/hdr_tonemap_lut: SSIM 0.9500 < 0.98 (PSNR 31.0dB)"]
+
+
+def test_hdr_tonemap_benchmark_runs_the_compiler_stages(tmp_path, monkeypatch):
+    videos = [
+        VideoInfo(
+            date_taken=date(2023, 1, 8 + 7 * index),
+            base_name=f"clip-{index}",
+            file_path=str(tmp_path / f"clip-{index}.mp4"),
+            duration=4.0,
+            width=1920,
+            height=1080,
+            codec_name="hevc",
+            pix_fmt="yuv420p10le",
+            frame_rate="30/1",
+            average_frame_rate="30/1",
+            hdr=True,
+            color_transfer="arib-std-b67",
+        )
+        for index in range(2)
+    ]
+    ran_jobs = []
+    compared_file_paths = []
+
+    async def fake_run_job(compiler, job, position):
+        ran_jobs.append(job.description)
+        with open(job.cache_entry.partial_file_path, "w") as f:
+            f.write("")
+        compiler.scratch_cache.commit(job.cache_entry)
+
+    def fake_run_ffmpeg_with_progress(compiler, command, duration=None, description="", position=0, partial_file_path=None):
+        # the stand-in for ffmpeg only generates the LUT
+        ran_jobs.append(description)
+        with open(partial_file_path, "w") as f:
+            f.write("")
+
+    def fake_measure_quality(reference, distorted):
+        compared_file_paths.extend([reference, distorted])
+        return QualityMetrics(ssim=0.99, psnr=40.0)
+
+    monkeypatch.setattr(benchmark, "generate_scenario_clips", lambda *args: videos)
+    monkeypatch.setattr(benchmark, "measure_quality", fake_measure_quality)
+    monkeypatch.setattr(VideoCollectionCompiler, "_run_job", fake_run_job)
+    monkeypatch.setattr(VideoCollectionCompiler, "run_ffmpeg_with_progress", fake_run_ffmpeg_with_progress)
+
+    timings, quality = benchmark.benchmark_hdr_tonemap(
+        str(tmp_path), benchmark.SCENARIOS[3], clips=2, duration=4.0, repeat=1
+    )
+
+    assert set(timings) == {"hdr_tonemap_exact", "hdr_tonemap_lut"}
+    assert quality == {"ssim": 0.99, "psnr": 40.0}
+    assert "generating arib-std-b67 tonemap LUT" in ran_jobs
+    # resetting the LUT run keeps the exact outputs it is compared against
+    assert len(compared_file_paths) == 4 and all(os.path.exists(path) for path in compared_file_paths)
@@ -0,0 +1,29 @@
+from kids_yearly_video_compiler.build_manifest import BuildManifest, ClipManifest
+
+
+def _manifest(clip_duration, clips):
+    return BuildManifest(parameters={"clip_duration": clip_duration}, clips=clips)
+
+
+def test_diff_reports_incremental_changes(tmp_path):
+    previous = _manifest(5.0, [ClipManifest("a", "/in/a.mp4", 10, 1), ClipManifest("b", "/in/b.mp4", 10, 1)])
+    manifest_file_path = str(tmp_path / "manifest.json")
+    previous.save(manifest_file_path)
+
+    manifest = _manifest(5.0, [ClipManifest("a", "/in/a.mp4", 10, 1), ClipManifest("b", "/in/b.mp4", 12, 2), ClipManifest("c", "/in/c.mp4", 10, 1)])
+    manifest_diff = manifest.diff(BuildManifest.load(manifest_file_path))
+
+    assert not manifest_diff.full_rebuild
+    assert manifest_diff.unchanged == ["a"]
+    assert manifest_diff.changed == ["b"]
+    assert manifest_diff.added == ["c"]
+
+
+def test_diff_reports_parameter_changes_as_full_rebuild():
+    previous = _manifest(5.0, [ClipManifest("a", "/in/a.mp4", 10, 1)])
+    manifest = _manifest(2.5, [ClipManifest("a", "/in/a.mp4", 10, 1), ClipManifest("b", "/in/b.mp4", 10, 1)])
+
+    manifest_diff = manifest.diff(previous)
+
+    assert manifest_diff.full_rebuild
+    assert manifest_diff.changed_parameters == {"clip_duration": (5.0, 2.5)}
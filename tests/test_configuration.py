@@ -1,6 +1,7 @@
+import os
 import pytest
 from datetime import date
-from kids_yearly_video_compiler.configuration import Configuration
+from kids_yearly_video_compiler.configuration import Configuration, OutputVariant
 
 def test_configuration_from_dict():
     config_dict = {
@@ -44,3 +45,60 @@ def test_configuration_from_dict():
     assert config.timelapse_options.speed_up_factor == 1 / 5.0
     assert config.timelapse_options.head_tail_ratio == (3, 2)
     assert config.compiler_options.list_weeks is False
+
+def test_scratch_max_size_in_bytes():
+    config = Configuration.from_dict({'compiler_options': {'scratch_max_size': '50G'}})
+    assert config.compiler_options.get_scratch_max_size_in_bytes() == 50 * 1024 ** 3
+    config.compiler_options.scratch_max_size = '512MB'
+    assert config.compiler_options.get_scratch_max_size_in_bytes() == 512 * 1024 ** 2
+    config.compiler_options.scratch_max_size = ''
+    assert config.compiler_options.get_scratch_max_size_in_bytes() == 0
+
+def test_encoding_profiles():
+    config = Configuration.from_dict({
+        'intermediate_encoding': {'crf': 0},
+        'output_encoding': {'preset': 'slow', 'options': {'tune': 'film'}},
+    })
+    assert config.intermediate_encoding.preset == 'ultrafast'
+    assert config.intermediate_encoding.crf == 0
+    assert config.output_encoding.get_output_options() == {
+        'vcodec': 'libx264', 'pix_fmt': 'yuv420p', 'preset': 'slow', 'crf': 23, 'tune': 'film',
+    }
+
+def test_preview_configuration():
+    config = Configuration.from_dict({
+        'directories': {'scratch': '/scratch'},
+        'timelapse_options': {'video_stabilization': True},
+        'compiler_options': {'render_mode': 'staged'},
+    })
+    preview_config = config.get_preview_configuration()
+    assert preview_config.directories.scratch == os.path.join('/scratch', 'preview')
+    assert (preview_config.timelapse_video.max_width, preview_config.timelapse_video.max_height) == (640, 360)
+    assert preview_config.timelapse_video.frame_rate == '15000/1001'
+    assert preview_config.timelapse_video.font_size == 12
+    assert preview_config.timelapse_options.video_stabilization is False
+    assert preview_config.output_encoding.preset == 'ultrafast'
+    assert preview_config.compiler_options.render_mode == 'fused'
+    assert preview_config.compiler_options.preview is True
+    # the full quality configuration is left alone
+    assert config.directories.scratch == '/scratch'
+    assert config.timelapse_options.video_stabilization is True
+
+def test_output_variants():
+    config = Configuration.from_dict({
+        'timelapse_video': {'instagram_style': True},
+        'output_variants': [
+            {'name': 'instagram', 'instagram_style': True},
+            {'name': 'tv-720p', 'max_width': 1280, 'max_height': 720},
+        ],
+    })
+    assert config.output_variants == [
+        OutputVariant('instagram', 1920, 1080, True),
+        OutputVariant('tv-720p', 1280, 720, False),
+    ]
+    variant_config = config.get_variant_configuration(config.output_variants[1])
+    assert (variant_config.timelapse_video.max_width, variant_config.timelapse_video.max_height) == (1280, 720)
+    assert variant_config.timelapse_video.instagram_style is False
+    assert variant_config.output_variants == []
+    preview_config = config.get_preview_configuration()
+    assert [(variant.max_width, variant.max_height) for variant in preview_config.output_variants] == [(640, 360), (426, 240)]
@@ -0,0 +1,84 @@
+import asyncio
+import os
+
+import pytest
+
+from kids_yearly_video_compiler.ffmpeg_process_manager import FfmpegProcessManager, FfmpegStalledError, run_cancellable
+from kids_yearly_video_compiler.ffmpeg_progress import FfmpegError
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="uses a shell script as ffmpeg")
+
+
+def test_concurrent_jobs_return_their_progress(write_fake_ffmpeg):
+    fake_ffmpeg = write_fake_ffmpeg("printf 'frame=10\\nout_time_us=1000000\\nprogress=end\\n'\n")
+    process_manager = FfmpegProcessManager()
+
+    async def run_all():
+        return await asyncio.gather(
+            *(process_manager.run([fake_ffmpeg, "-i", "in.mp4", f"out{i}.mp4"], 1.0, position=i) for i in range(3))
+        )
+
+    results = asyncio.run(run_all())
+
+    assert [progress.frame for progress in results] == [10, 10, 10]
+    assert all(progress.finished for progress in results)
+
+
+def test_run_cancellable_returns_the_final_progress(write_fake_ffmpeg):
+    fake_ffmpeg = write_fake_ffmpeg("printf 'frame=10\\nout_time_us=1000000\\nprogress=end\\n'\n")
+
+    progress = run_cancellable(FfmpegProcessManager().run([fake_ffmpeg, "-i", "in.mp4", "out.mp4"], 1.0))
+
+    assert progress.frame == 10
+    assert progress.finished
+
+
+def test_failed_job_removes_partial_output(tmp_path, write_fake_ffmpeg):
+    fake_ffmpeg = write_fake_ffmpeg("echo 'Invalid data found' >&2\nexit 1\n")
+    partial_file_path = tmp_path / "out.partial.mp4"
+    partial_file_path.write_text("half a video")
+
+    with pytest.raises(FfmpegError) as error:
+        asyncio.run(FfmpegProcessManager().run([fake_ffmpeg], partial_file_path=str(partial_file_path)))
+
+    assert error.value.return_code == 1
+    assert error.value.stderr_tail == ["Invalid data found"]
+    assert not partial_file_path.exists()
+
+
+def test_stalled_job_is_killed(tmp_path, write_fake_ffmpeg):
+    # keeps reporting progress without the output time moving forward
+    fake_ffmpeg = write_fake_ffmpeg(
+        "while true; do printf 'frame=1\\nout_time_us=1000\\nprogress=continue\\n'; sleep 0.1; done\n"
+    )
+    partial_file_path = tmp_path / "out.partial.mp4"
+    partial_file_path.write_text("stuck")
+
+    with pytest.raises(FfmpegStalledError):
+        asyncio.run(
+            FfmpegProcessManager(stall_timeout=0.5).run([fake_ffmpeg], partial_file_path=str(partial_file_path))
+        )
+
+    assert not partial_file_path.exists()
+
+
+def test_cancel_all_stops_running_jobs(tmp_path, write_fake_ffmpeg):
+    pid_file_path = tmp_path / "pid"
+    fake_ffmpeg = write_fake_ffmpeg(f"echo $$ > {pid_file_path}\nexec sleep 30\n")
+    partial_file_path = tmp_path / "out.partial.mp4"
+    partial_file_path.write_text("partial")
+    process_manager = FfmpegProcessManager()
+
+    async def run_and_cancel():
+        job = asyncio.ensure_future(process_manager.run([fake_ffmpeg], partial_file_path=str(partial_file_path)))
+        while not pid_file_path.exists() or not pid_file_path.read_text().strip():
+            await asyncio.sleep(0.05)
+        process_manager.cancel_all()
+        with pytest.raises(asyncio.CancelledError):
+            await job
+
+    asyncio.run(run_and_cancel())
+
+    assert not partial_file_path.exists()
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file_path.read_text()), 0)
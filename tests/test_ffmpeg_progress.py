@@ -0,0 +1,33 @@
+import pytest
+
+from kids_yearly_video_compiler.ffmpeg_progress import FfmpegProgressParser
+
+PROGRESS_BLOCK = """frame=120
+fps=59.94
+bitrate=1500.2kbits/s
+total_size=262144
+out_time_us=4004000
+out_time_ms=4004000
+out_time=00:00:04.004000
+speed=2.5x
+progress=continue
+"""
+
+
+def test_parser_returns_a_snapshot_per_block():
+    parser = FfmpegProgressParser()
+    snapshots = [parser.feed(line) for line in PROGRESS_BLOCK.splitlines()]
+
+    assert snapshots[:-1] == [None] * (len(snapshots) - 1)
+    progress = snapshots[-1]
+    assert progress.frame == 120
+    assert progress.fps == 59.94
+    assert progress.out_time == pytest.approx(4.004)
+    assert progress.speed == 2.5
+    assert not progress.finished
+
+    assert parser.feed("out_time=00:01:02.500000") is None
+    progress = parser.feed("progress=end")
+    assert progress.out_time == pytest.approx(62.5)
+    assert progress.speed == 0.0
+    assert progress.finished
@@ -0,0 +1,59 @@
+import ffmpeg
+
+from kids_yearly_video_compiler.filter_graph import (
+    Crop,
+    FilterGraph,
+    FrameFilter,
+    PixelFilter,
+    Scale,
+    Segment,
+    SetPts,
+    StreamState,
+)
+
+def _tonemap(stream):
+    return stream.filter("tonemap", tonemap="hable")
+
+
+def _drawtext(stream):
+    return stream.drawtext(text="Week 1")
+
+
+def _graph(segment_durations):
+    # 30fps 4K clips sped up 7.5 times, tonemapped, cropped to 9:16 and labelled
+    segments = [
+        Segment(
+            ffmpeg.input("clip.mp4", t=duration),
+            [Scale(1920), SetPts(1 / 7.5)],
+            StreamState(3840, 2160, frames=duration * 30, duration=duration, hdr=True),
+        )
+        for duration in segment_durations
+    ]
+    steps = [
+        PixelFilter("tonemap", _tonemap, tonemap=True),
+        Crop(1080 * 9 / 16, 1080, (1920 - 1080 * 9 / 16) / 2, 0),
+        FrameFilter("drawtext", _drawtext),
+    ]
+    return FilterGraph(segments, steps)
+
+
+def test_output_state_follows_the_steps_in_their_written_order():
+    state = _graph([10.0]).get_output_state()
+
+    # the crop is rounded down to whole chroma samples and the tonemap leaves SDR frames
+    assert (state.width, state.height) == (606, 1080)
+    assert state.frames == 300
+    assert abs(state.duration - 10.0 / 7.5) < 1e-9
+    assert not state.hdr
+
+
+def test_segments_are_concatenated_before_the_shared_steps():
+    graph = _graph([4.0, 2.0])
+
+    state = graph.get_output_state()
+    assert state.frames == 180
+    assert abs(state.duration - 6.0 / 7.5) < 1e-9
+    command = ffmpeg.compile(graph.apply().output("out.mp4"))
+    filter_complex = command[command.index("-filter_complex") + 1]
+    assert "concat=n=2" in filter_complex
+    assert filter_complex.index("concat=n=2") < filter_complex.index("tonemap") < filter_complex.index("crop")
@@ -0,0 +1,116 @@
+import asyncio
+import os
+import time
+
+from kids_yearly_video_compiler.job_queue import JobQueue, run_worker
+from kids_yearly_video_compiler.job_scheduler import FfmpegJob
+from kids_yearly_video_compiler.scratch_cache import ScratchCache
+
+
+def _jobs(count):
+    return [FfmpegJob(["ffmpeg", "-i", f"clip{index}.mp4"], 1.0, f"processing clip{index}") for index in range(count)]
+
+
+def test_workers_claim_distinct_jobs(tmp_path):
+    job_queue = JobQueue(str(tmp_path / "jobs.sqlite"))
+    job_queue.enqueue("batch", _jobs(2))
+
+    first = job_queue.claim("worker-1")
+    second = job_queue.claim("worker-2")
+
+    assert {first.description, second.description} == {"processing clip0", "processing clip1"}
+    assert job_queue.claim("worker-3") is None
+
+    job_queue.complete(first.id, "worker-1")
+    assert job_queue.get_states("batch")[first.id] == ("done", None)
+
+
+def test_expired_leases_are_retried_until_max_attempts(tmp_path):
+    job_queue = JobQueue(str(tmp_path / "jobs.sqlite"), max_attempts=2)
+    job_queue.enqueue("batch", _jobs(1))
+
+    first_attempt = job_queue.claim("worker-1", lease_seconds=0.01)
+    time.sleep(0.02)
+    second_attempt = job_queue.claim("worker-2", lease_seconds=0.01)
+    assert second_attempt.id == first_attempt.id
+    assert second_attempt.attempts == 2
+    # the first worker lost its lease and can't extend it any more
+    assert not job_queue.heartbeat(first_attempt.id, "worker-1")
+
+    time.sleep(0.02)
+    assert job_queue.claim("worker-3") is None
+    state, error = job_queue.get_states("batch")[first_attempt.id]
+    assert state == "failed"
+    assert "lease expired" in error
+
+
+def test_worker_commits_outputs_and_retries_failures(tmp_path):
+    cache = ScratchCache(str(tmp_path))
+    entry = cache.get_entry("clip0-compiled", "mp4", ["ffmpeg", "-i", "clip0.mp4"])
+    job_queue = JobQueue(str(tmp_path / "jobs.sqlite"))
+    job_queue.enqueue("batch", [FfmpegJob(["ffmpeg", "-i", "clip0.mp4", entry.partial_file_path], 1.0, "clip0", entry)])
+    attempts = []
+
+    class FakeProcessManager:
+        async def run(self, command, duration, description):
+            attempts.append(command)
+            if len(attempts) == 1:
+                raise RuntimeError("ffmpeg crashed")
+            open(command[-1], "w").write("video")
+
+    assert run_worker(job_queue, "worker-1", exit_when_idle=True, process_manager=FakeProcessManager()) == 1
+
+    assert len(attempts) == 2
+    assert open(entry.file_path).read() == "video"
+    assert list(job_queue.get_states("batch").values()) == [("done", None)]
+
+
+def test_worker_that_lost_its_lease_stops_and_leaves_the_output_alone(tmp_path):
+    cache = ScratchCache(str(tmp_path))
+    entry = cache.get_entry("clip0-compiled", "mp4", ["ffmpeg", "-i", "clip0.mp4"])
+    job_queue = JobQueue(str(tmp_path / "jobs.sqlite"))
+    job_queue.enqueue("batch", [FfmpegJob(["ffmpeg", "-i", "clip0.mp4", entry.partial_file_path], 1.0, "clip0", entry)])
+
+    class SlowProcessManager:
+        cancelled = False
+
+        async def run(self, command, duration, description):
+            # another worker takes the job over while this one is still encoding
+            job_queue.fail(1, "worker-1", "lease expired")
+            assert job_queue.claim("worker-2").id == 1
+            open(command[-1], "w").write("video of worker-2")
+            self.task = asyncio.current_task()
+            await asyncio.sleep(10)
+
+        def cancel_all(self):
+            self.cancelled = True
+            self.task.get_loop().call_soon_threadsafe(self.task.cancel)
+
+    process_manager = SlowProcessManager()
+    assert run_worker(job_queue, "worker-1", lease_seconds=0.15, exit_when_idle=True, process_manager=process_manager) == 0
+
+    assert process_manager.cancelled
+    assert open(entry.partial_file_path).read() == "video of worker-2"
+    assert list(job_queue.get_states("batch").values()) == [("running", "lease expired")]
+    # the stale worker can neither publish nor discard the job any more
+    assert not job_queue.complete(1, "worker-1")
+    assert job_queue.complete(1, "worker-2")
+
+
+def test_worker_discards_the_output_of_a_job_whose_batch_was_cancelled(tmp_path):
+    cache = ScratchCache(str(tmp_path))
+    entry = cache.get_entry("clip0-compiled", "mp4", ["ffmpeg", "-i", "clip0.mp4"])
+    job_queue = JobQueue(str(tmp_path / "jobs.sqlite"))
+    job_queue.enqueue("batch", [FfmpegJob(["ffmpeg", "-i", "clip0.mp4", entry.partial_file_path], 1.0, "clip0", entry)])
+
+    class CancelledProcessManager:
+        async def run(self, command, duration, description):
+            open(command[-1], "w").write("video")
+            # the coordinator gives up on the batch just before ffmpeg exits
+            job_queue.cancel("batch")
+
+    assert run_worker(job_queue, "worker-1", exit_when_idle=True, process_manager=CancelledProcessManager()) == 0
+
+    assert not os.path.exists(entry.partial_file_path)
+    assert not os.path.exists(entry.file_path)
+    assert list(job_queue.get_states("batch").values()) == [("cancelled", None)]
@@ -0,0 +1,45 @@
+import threading
+
+import pytest
+
+from kids_yearly_video_compiler.job_scheduler import FfmpegJob, JobScheduler, JobSchedulerError
+
+
+def test_plan_splits_cpu_budget():
+    assert JobScheduler(cpu_budget=16).plan(100) == (8, 2)
+    assert JobScheduler(cpu_budget=16).plan(3) == (3, 5)
+    assert JobScheduler(cpu_budget=16, max_jobs=4).plan(100) == (4, 4)
+    assert JobScheduler(cpu_budget=1).plan(10) == (1, 1)
+
+
+def test_run_uses_distinct_positions_and_collects_failures():
+    jobs = [FfmpegJob(["ffmpeg"], 1.0, f"job {i}") for i in range(6)]
+    active_positions = set()
+    lock = threading.Lock()
+    done = []
+
+    def run_job(job, position):
+        with lock:
+            assert position not in active_positions
+            active_positions.add(position)
+        try:
+            if job.description == "job 3":
+                raise RuntimeError("boom")
+        finally:
+            with lock:
+                active_positions.discard(position)
+
+    with pytest.raises(JobSchedulerError) as error:
+        JobScheduler(cpu_budget=4).run(jobs, run_job, done.append)
+
+    assert [job.description for job, _ in error.value.failures] == ["job 3"]
+    assert len(done) == 5
+
+
+def test_run_starts_longest_jobs_first():
+    jobs = [FfmpegJob(["ffmpeg"], 1.0, f"job {i}", estimated_seconds=seconds) for i, seconds in enumerate([1, 5, 3])]
+    started = []
+
+    JobScheduler(cpu_budget=1).run(jobs, lambda job, position: started.append(job.description))
+
+    assert started == ["job 1", "job 2", "job 0"]
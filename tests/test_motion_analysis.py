@@ -0,0 +1,57 @@
+import subprocess
+
+import pytest
+
+from kids_yearly_video_compiler import motion_analysis
+from kids_yearly_video_compiler.motion_analysis import write_motion_data_window
+
+MOTION_DATA = """VID.STAB 1
+#      accuracy = 15
+#     shakiness = 10
+Frame 1 (List 0 [])
+Frame 2 (List 1 [(LM 1 0 0 0 0 0 0)])
+Frame 3 (List 1 [(LM 2 0 0 0 0 0 0)])
+Frame 4 (List 1 [(LM 3 0 0 0 0 0 0)])
+"""
+
+
+def test_window_starts_at_first_frame(tmp_path):
+    motion_data = tmp_path / "clip.trf"
+    motion_data.write_text(MOTION_DATA)
+    window = tmp_path / "window.trf"
+
+    write_motion_data_window(str(motion_data), str(window), 2)
+
+    assert window.read_text().splitlines() == [
+        "VID.STAB 1",
+        "#      accuracy = 15",
+        "#     shakiness = 10",
+        "Frame 1 (List 1 [(LM 2 0 0 0 0 0 0)])",
+        "Frame 2 (List 1 [(LM 3 0 0 0 0 0 0)])",
+    ]
+
+
+def test_rejects_unknown_format(tmp_path):
+    motion_data = tmp_path / "clip.trf"
+    motion_data.write_bytes(b"TRF1\x00\x01")
+
+    with pytest.raises(ValueError):
+        write_motion_data_window(str(motion_data), str(tmp_path / "window.trf"), 2)
+
+
+@pytest.mark.parametrize(
+    "help_text, options",
+    [
+        ("vidstabdetect AVOptions:\n  fileformat <int> set output file format\n", {"fileformat": "ascii"}),
+        ("vidstabdetect AVOptions:\n  result <string> path to the file used to write the transforms\n", {}),
+    ],
+)
+def test_ascii_format_is_only_asked_for_when_the_build_knows_the_option(monkeypatch, help_text, options):
+    monkeypatch.setattr(
+        motion_analysis.subprocess, "run", lambda args, **kwargs: subprocess.CompletedProcess(args, 0, help_text, "")
+    )
+    motion_analysis.get_vidstabdetect_format_options.cache_clear()
+    try:
+        assert motion_analysis.get_vidstabdetect_format_options() == options
+    finally:
+        motion_analysis.get_vidstabdetect_format_options.cache_clear()
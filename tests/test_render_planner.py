@@ -0,0 +1,56 @@
+import pytest
+
+from kids_yearly_video_compiler.render_planner import (
+    DEFAULT_COEFFICIENTS,
+    CostModel,
+    PlannedJob,
+    PlannedStage,
+    RenderPlan,
+    get_makespan,
+)
+
+
+def test_cost_model_calibrates_from_recorded_timings(tmp_path):
+    timings_file_path = str(tmp_path / "render-timings.json")
+    cost_model = CostModel(timings_file_path)
+    stage_key = CostModel.get_stage_key("compiled", hdr=True)
+    units = CostModel.get_units(10.0, 1920, 1080)
+
+    assert cost_model.estimate(stage_key, units) == pytest.approx(DEFAULT_COEFFICIENTS[stage_key] * units)
+
+    # 4 threads for 5 seconds is 20 cpu seconds
+    cost_model.record(stage_key, units, 5.0, threads=4)
+    cost_model.save()
+
+    calibrated_cost_model = CostModel(timings_file_path)
+    assert calibrated_cost_model.estimate(stage_key, units, threads=2) == pytest.approx(10.0)
+    assert calibrated_cost_model.estimate(CostModel.get_stage_key("compiled", hdr=False), units) == pytest.approx(
+        DEFAULT_COEFFICIENTS["compiled/sdr"] * units
+    )
+
+
+def test_makespan_of_longest_first_schedule():
+    assert get_makespan([], 4) == 0.0
+    assert get_makespan([3, 3, 2, 2, 2], 2) == 7
+    assert get_makespan([10, 1, 1], 8) == 10
+
+
+def test_render_plan_critical_path_and_eta():
+    plan = RenderPlan(
+        [
+            PlannedStage(
+                "stabilized-data",
+                2,
+                [PlannedJob("a", 4.0), PlannedJob("b", 2.0), PlannedJob("c", 9.0, cached=True)],
+            ),
+            PlannedStage("compiled", 1, [PlannedJob("a", 3.0), PlannedJob("b", 6.0)]),
+            PlannedStage("save", 1, [PlannedJob("final video", 1.0)]),
+        ]
+    )
+
+    assert [(stage_name, job.base_name) for stage_name, job in plan.get_critical_path()] == [
+        ("stabilized-data", "a"),
+        ("compiled", "b"),
+        ("save", "final video"),
+    ]
+    assert plan.get_eta() == pytest.approx(4.0 + 9.0 + 1.0)
@@ -0,0 +1,74 @@
+import os
+
+from kids_yearly_video_compiler.scratch_cache import OUTPUT_FILE_PLACEHOLDER, ScratchCache
+
+
+def _command(input_file_path, speed="0.5"):
+    return ["ffmpeg", "-i", input_file_path, "-vf", f"setpts={speed}*PTS", OUTPUT_FILE_PLACEHOLDER]
+
+
+def test_key_tracks_parameters_and_input_identity(tmp_path):
+    source = tmp_path / "source.mp4"
+    source.write_bytes(b"a")
+    cache = ScratchCache(str(tmp_path / "scratch"))
+
+    key = cache.get_key(_command(str(source)))
+    assert key == cache.get_key(_command(str(source)))
+    assert key != cache.get_key(_command(str(source), speed="0.25"))
+
+    source.write_bytes(b"ab")
+    assert key != cache.get_key(_command(str(source)))
+
+
+def test_entries_are_committed_atomically(tmp_path):
+    cache = ScratchCache(str(tmp_path))
+    entry = cache.get_entry("clip-head-tail-algorithm", "mp4", _command("source.mp4"))
+    assert entry.file_name == f"clip-head-tail-algorithm.{entry.key}.mp4"
+    assert not cache.is_cached(entry)
+
+    open(entry.partial_file_path, "w").write("truncated")
+    cache.prepare(entry)
+    assert not os.path.exists(entry.partial_file_path)
+
+    open(entry.partial_file_path, "w").write("done")
+    cache.commit(entry)
+    assert cache.is_cached(entry)
+    assert not os.path.exists(entry.partial_file_path)
+
+
+def test_evict_removes_least_recently_used_unpinned_entries(tmp_path):
+    writer = ScratchCache(str(tmp_path))
+    entries = []
+    for index in range(3):
+        entry = writer.get_entry(f"clip{index}-compiled", "mp4", _command(f"clip{index}.mp4"))
+        open(entry.file_path, "w").write("x" * 10)
+        os.utime(entry.file_path, (index, index))
+        entries.append(entry)
+
+    cache = ScratchCache(str(tmp_path), max_size=15)
+    assert cache.is_cached(entries[0])
+    cache.evict()
+
+    assert os.path.exists(entries[0].file_path)
+    assert not os.path.exists(entries[1].file_path)
+    assert not os.path.exists(entries[2].file_path)
+
+
+def test_written_entries_use_their_own_partial_file(tmp_path):
+    cache = ScratchCache(str(tmp_path))
+    entry = cache.get_entry("hdr-tonemap-lut", "png", ["lut"])
+    # a partial file of another writer sharing the scratch directory
+    open(entry.partial_file_path, "w").write("other writer")
+    written = []
+
+    def write_file(file_path):
+        assert file_path != entry.partial_file_path and file_path.endswith(".png")
+        written.append(file_path)
+        open(file_path, "w").write("lut")
+
+    cache.write(entry, write_file)
+    cache.write(entry, write_file)
+
+    assert len(written) == 1
+    assert open(entry.file_path).read() == "lut"
+    assert open(entry.partial_file_path).read() == "other writer"
@@ -0,0 +1,98 @@
+from datetime import date
+
+from kids_yearly_video_compiler.tuner import (
+    TuneCandidate,
+    TuneResult,
+    get_candidates,
+    is_encoding_used,
+    plan_encodes,
+    sample_videos,
+    select_best_quality,
+    select_fastest,
+    update_encoding_profile,
+)
+from kids_yearly_video_compiler.configuration import Configuration
+from kids_yearly_video_compiler.video_collection import VideoCollection
+from kids_yearly_video_compiler.video_inspector import VideoInfo
+
+RESULTS = [
+    TuneResult(TuneCandidate("ultrafast", 23), seconds_per_second=0.1, ssim=0.95, psnr=36.0),
+    TuneResult(TuneCandidate("veryfast", 23), seconds_per_second=0.2, ssim=0.975, psnr=39.0),
+    TuneResult(TuneCandidate("medium", 20), seconds_per_second=0.5, ssim=0.985, psnr=42.0),
+    TuneResult(TuneCandidate("slow", 18), seconds_per_second=1.2, ssim=0.99, psnr=44.0),
+]
+
+
+def test_select_fastest_meeting_the_quality_floor():
+    assert select_fastest(RESULTS, 0.97).candidate == TuneCandidate("veryfast", 23)
+    assert select_fastest(RESULTS, 0.999) is None
+
+
+def test_select_best_quality_within_the_time_budget():
+    # 60 seconds of timelapse in 30 seconds fits everything up to 0.5s per second
+    assert select_best_quality(RESULTS, 30.0, 60.0).candidate == TuneCandidate("medium", 20)
+    assert select_best_quality(RESULTS, 1.0, 60.0) is None
+    # two encodes at once get through twice the video
+    assert select_best_quality(RESULTS, 36.0, 60.0, concurrent_jobs=2).candidate == TuneCandidate("slow", 18)
+
+
+def test_encodes_are_measured_with_the_threads_of_the_render():
+    config = Configuration()
+    config.compiler_options.cpu_budget = 8
+    videos = VideoCollection([VideoInfo(base_name=f"clip-{index}") for index in range(10)])
+    # the fused render encodes every clip with the output profile in its own job
+    assert plan_encodes(config, "output_encoding", videos) == (4, 2)
+    assert plan_encodes(config, "intermediate_encoding", videos) == (4, 2)
+    assert plan_encodes(config, "output_encoding", VideoCollection(videos.videos[:1])) == (1, 8)
+    assert not is_encoding_used(config, "intermediate_encoding")
+    config.compiler_options.render_mode = "staged"
+    assert is_encoding_used(config, "intermediate_encoding")
+
+
+def test_get_candidates_covers_every_combination():
+    candidates = get_candidates(["fast", "slow"], [20, 23], [0, 4])
+    assert len(candidates) == 8
+    assert candidates[0] == TuneCandidate("fast", 20, 0)
+
+
+def test_sample_videos_spreads_over_the_year():
+    videos = [VideoInfo(date_taken=date(2023, month, 1), base_name=f"clip-{month}") for month in range(1, 13)]
+    samples = sample_videos(VideoCollection(videos), 4)
+    assert [video.date_taken.month for video in samples] == [1, 4, 7, 10]
+    assert len(sample_videos(VideoCollection(videos[:2]), 4)) == 2
+
+
+def test_update_encoding_profile_keeps_comments_and_other_sections():
+    yaml_text = (
+        "intermediate_encoding:\n"
+        "  codec: libx264\n"
+        "  preset: ultrafast\n"
+        "  crf: 12  # 0 is lossless\n"
+        "output_encoding:\n"
+        "  codec: libx264\n"
+        "  preset: medium\n"
+        "  crf: 23\n"
+        "\n"
+        "compiler_options:\n"
+        "  cpu_budget: 0\n"
+    )
+    updated = update_encoding_profile(yaml_text, "output_encoding", {"preset": "veryfast", "crf": 20, "threads": 2})
+    assert updated == (
+        "intermediate_encoding:\n"
+        "  codec: libx264\n"
+        "  preset: ultrafast\n"
+        "  crf: 12  # 0 is lossless\n"
+        "output_encoding:\n"
+        "  codec: libx264\n"
+        "  preset: veryfast\n"
+        "  crf: 20\n"
+        "  threads: 2\n"
+        "\n"
+        "compiler_options:\n"
+        "  cpu_budget: 0\n"
+    )
+    updated = update_encoding_profile(updated, "intermediate_encoding", {"crf": 10})
+    assert "  crf: 10  # 0 is lossless\n" in updated
+    assert update_encoding_profile("kid_info:\n  name: Jane\n", "output_encoding", {"crf": 20}).endswith(
+        "output_encoding:\n  crf: 20\n"
+    )
@@ -0,0 +1,34 @@
+from datetime import date
+
+from kids_yearly_video_compiler.video_collection import VideoCollection
+from kids_yearly_video_compiler.video_inspector import VideoInfo
+
+
+def _video(base_name, date_taken, duration, width, height):
+    return VideoInfo(date_taken=date_taken, base_name=base_name, duration=duration, width=width, height=height)
+
+
+def test_collection_stats_and_sort_orders():
+    videos = [
+        _video("c", date(2023, 1, 1), 10.0, 1920, 1080),
+        _video("a", date(2023, 3, 1), 20.0, 1080, 1920),
+        _video("b", date(2023, 2, 1), 30.0, 1280, 720),
+    ]
+    video_collection = VideoCollection(videos)
+
+    assert video_collection.size() == 3
+    assert video_collection.total_duration == 60.0
+    assert video_collection.average_duration == 20.0
+    assert (video_collection.min_width, video_collection.max_width) == (1080, 1920)
+    assert (video_collection.min_height, video_collection.max_height) == (720, 1920)
+    assert [video.base_name for video in video_collection.sorted()] == ["a", "b", "c"]
+    assert [video.base_name for video in video_collection.sorted(reverse=True)] == ["c", "b", "a"]
+    assert [video.base_name for video in video_collection.sorted_by_date()] == ["c", "b", "a"]
+
+
+def test_empty_collection():
+    video_collection = VideoCollection([])
+
+    assert video_collection.size() == 0
+    assert video_collection.average_duration == 0.0
+    assert list(video_collection.sorted()) == []
@@ -0,0 +1,161 @@
+from dataclasses import replace
+import os
+from types import SimpleNamespace
+
+from kids_yearly_video_compiler import video_collection_compiler
+from kids_yearly_video_compiler.build_manifest import BuildManifest, ClipManifest
+from kids_yearly_video_compiler.configuration import Configuration
+from kids_yearly_video_compiler.job_scheduler import FfmpegJob
+from kids_yearly_video_compiler.render_planner import RenderPlan
+from kids_yearly_video_compiler.video_collection import VideoCollection
+from kids_yearly_video_compiler.video_collection_compiler import (
+    VideoCollectionCompiler,
+    get_metadata_differences,
+    split_timeline,
+)
+from kids_yearly_video_compiler.video_inspector import VideoInfo
+
+
+def test_split_timeline_balances_consecutive_clips():
+    assert split_timeline([1.0, 1.0, 1.0, 1.0], 2) == [range(0, 2), range(2, 4)]
+    assert split_timeline([10.0, 1.0, 1.0, 1.0, 1.0], 2) == [range(0, 1), range(1, 5)]
+
+
+def test_split_timeline_never_makes_empty_chunks():
+    assert split_timeline([1.0, 1.0], 4) == [range(0, 1), range(1, 2)]
+    assert split_timeline([1.0, 1.0, 100.0], 3) == [range(0, 1), range(1, 2), range(2, 3)]
+    assert split_timeline([5.0], 1) == [range(0, 1)]
+
+
+def test_variants_render_from_the_shared_intermediate(tmp_path):
+    config = Configuration.from_dict({
+        'directories': {'scratch': str(tmp_path)},
+        'output_variants': [
+            {'name': 'instagram', 'instagram_style': True},
+            {'name': 'tv-720p', 'max_width': 1280, 'max_height': 720},
+        ],
+    })
+    compiler = VideoCollectionCompiler(config, VideoCollection([]))
+    shared_video = VideoInfo(
+        base_name="PXL_20230412_1", file_path="shared.mp4", duration=2.0, width=1920, height=1080, frame_rate="30000/1001"
+    )
+    instagram, tv = [compiler._create_variant_compiler(variant) for variant in config.output_variants]
+    assert tv.scratch_cache is compiler.scratch_cache
+    assert tv._get_build_manifest_file_path().endswith("Jane-Doe-tv-720p-build-manifest.json")
+
+    instagram_command = " ".join(instagram._transform_variant(shared_video, "instagram.mp4").compile())
+    assert "crop=607.5:1080:656.25:0" in instagram_command
+    assert "scale" not in instagram_command and "zscale" not in instagram_command
+    tv_command = " ".join(tv._transform_variant(shared_video, "tv.mp4").compile())
+    assert "scale=1280:-1" in tv_command and "crop" not in tv_command
+
+
+def test_outputs_are_derived_from_the_filter_graph(tmp_path):
+    config = Configuration.from_dict({
+        'directories': {'scratch': str(tmp_path)},
+        'timelapse_video': {'length': '10s', 'instagram_style': True},
+        'output_encoding': {'codec': 'libx265'},
+    })
+    hdr_video = VideoInfo(
+        base_name="PXL_20230412_1", file_path="clip.mp4", duration=60.0, width=3840, height=2160, hdr=True,
+        codec_name="hevc", pix_fmt="yuv420p10le", frame_rate="30/1", color_transfer="arib-std-b67",
+    )
+    compiler = VideoCollectionCompiler(config, VideoCollection([hdr_video]))
+    derive_video = compiler._derive_graph_output(compiler._fused_graph, config.output_encoding)
+    video = derive_video(hdr_video, compiler._get_head_tail_arguments())
+    assert (video.width, video.height, video.hdr) == (606, 1080, False)
+    assert (video.codec_name, video.pix_fmt, video.frame_rate) == ("hevc", "yuv420p", "30000/1001")
+    assert video.color_transfer == "bt709"
+    # the whole minute sped up to fill the 10s timelapse
+    assert abs(video.duration - 10.0) < 1e-9
+
+
+def test_metadata_differences(tmp_path):
+    derived = VideoInfo(duration=10.0, width=1920, height=1080, codec_name="h264", pix_fmt="yuv420p", frame_rate="30000/1001")
+    assert get_metadata_differences(derived, replace(derived, duration=10.05, frame_rate="2997/100")) == [
+        "frame_rate 30000/1001 != 2997/100"
+    ]
+    assert get_metadata_differences(derived, replace(derived, duration=10.5, hdr=True)) == [
+        "hdr False != True", "duration 10.000 != 10.500"
+    ]
+
+    config = Configuration.from_dict({
+        'directories': {'scratch': str(tmp_path)}, 'compiler_options': {'verify_metadata_sample': 0.25},
+    })
+    compiler = VideoCollectionCompiler(config, VideoCollection([]))
+    videos = [replace(derived, base_name=f"clip-{index}") for index in range(8)]
+    probed = []
+    compiler._probe_output = lambda video: probed.append(video.base_name) or video
+    assert compiler._verify_derived_videos("compiled", videos) == videos
+    assert probed == ["clip-0", "clip-4"]
+    compiler._probe_output = lambda video: replace(video, width=1918)
+    assert [video.width for video in compiler._verify_derived_videos("compiled", videos)] == [1918] * 8
+
+
+def test_motion_data_is_detected_in_the_ascii_format(tmp_path, monkeypatch):
+    monkeypatch.setattr(video_collection_compiler, "get_vidstabdetect_format_options", lambda: {"fileformat": "ascii"})
+    config = Configuration.from_dict({'directories': {'scratch': str(tmp_path)}})
+    video = VideoInfo(base_name="PXL_20230412_1", file_path="clip.mp4", duration=2.0, width=1920, height=1080)
+    compiler = VideoCollectionCompiler(config, VideoCollection([video]))
+    jobs = []
+    compiler._run_jobs = lambda pending_jobs, description, total: jobs.extend(pending_jobs)
+
+    compiler._detect_video_stabilization(VideoCollection([video]))
+
+    assert "fileformat=ascii" in " ".join(jobs[0].command)
+
+
+def test_motion_data_windows_are_written_when_their_jobs_run(tmp_path):
+    config = Configuration.from_dict({'directories': {'scratch': str(tmp_path)}})
+    compiler = VideoCollectionCompiler(config, VideoCollection([]))
+    motion_data = tmp_path / "clip-stabilized-data.0123456789abcdef.trf"
+    motion_data.write_text("VID.STAB 1\nFrame 1 (List 0 [])\nFrame 2 (List 0 [])\nFrame 3 (List 0 [])\n")
+
+    window_file_path = compiler._get_stabilization_data_window_file_path(str(motion_data), 1)
+    compiler.render_plan = RenderPlan()
+    compiler._run_jobs([FfmpegJob(["ffmpeg"], 1.0, "clip")], "planning", 1)
+    assert not os.path.exists(window_file_path)
+
+    compiler.render_plan = None
+    compiler._get_stabilization_data_window_file_path(str(motion_data), 1)
+    compiler.batch = SimpleNamespace(run_jobs=lambda compiler, jobs: None)
+    compiler._run_jobs([FfmpegJob(["ffmpeg"], 1.0, "clip")], "stabilizing", 1)
+    assert open(window_file_path).read().splitlines()[1:] == ["Frame 1 (List 0 [])", "Frame 2 (List 0 [])"]
+
+
+def test_timeline_is_planned_in_chunks_of_the_final_encoding(tmp_path):
+    config = Configuration.from_dict({
+        'directories': {'scratch': str(tmp_path)},
+        'final_encoding': {'codec': 'libx265', 'crf': 26},
+        'compiler_options': {'cpu_budget': 4, 'parallel_jobs': 2},
+    })
+    compiler = VideoCollectionCompiler(config, VideoCollection([]))
+    compiler.render_plan = RenderPlan()
+    videos = [
+        VideoInfo(base_name=f"clip{index}", file_path=f"clip{index}.mp4", duration=1.0, width=1920, height=1080)
+        for index in range(4)
+    ]
+
+    chunks = compiler._encode_timeline_chunks(videos, config.final_encoding)
+
+    assert [(chunk.duration, chunk.codec_name) for chunk in chunks] == [(2.0, "hevc"), (2.0, "hevc")]
+    assert [stage.name for stage in compiler.render_plan.stages] == ["timeline-chunk"]
+    # planning writes no concat lists
+    assert os.listdir(tmp_path) == []
+
+
+def test_output_is_saved_again_when_the_final_encoding_changes(tmp_path):
+    config = Configuration.from_dict({'directories': {'scratch': str(tmp_path)}})
+    compiler = VideoCollectionCompiler(config, VideoCollection([]))
+    output_video_path = tmp_path / "2023-alice.mp4"
+    output_video_path.write_bytes(b"timelapse")
+    previous_build_manifest = BuildManifest(
+        parameters={"final_encoding": None},
+        clips=[ClipManifest("clip", "clip.mp4", segment_file_path="clip-compiled.mp4")],
+        output_video_path=str(output_video_path),
+    )
+
+    compiler.build_manifest = replace(previous_build_manifest)
+    assert compiler._is_output_up_to_date(previous_build_manifest)
+    compiler.build_manifest = replace(previous_build_manifest, parameters={"final_encoding": {"codec": "libx265"}})
+    assert not compiler._is_output_up_to_date(previous_build_manifest)
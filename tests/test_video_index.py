@@ -0,0 +1,41 @@
+import json
+import os
+import sqlite3
+import subprocess
+from datetime import date
+
+from kids_yearly_video_compiler import video_inspector
+from kids_yearly_video_compiler.video_index import VideoIndex
+from kids_yearly_video_compiler.video_inspector import probe_all_video_info
+
+
+def test_only_new_or_changed_files_are_probed_again(tmp_path, monkeypatch):
+    input_directory = tmp_path / "input"
+    input_directory.mkdir()
+    for name in ["PXL_20230201_a.mp4", "PXL_20230301_b.mp4", "undated.mp4"]:
+        (input_directory / name).write_bytes(b"")
+    probed = []
+
+    def fake_ffprobe(args, capture_output=True, timeout=None):
+        probed.append(os.path.basename(args[-1]))
+        stream = {"codec_type": "video", "duration": "12.5", "width": 1920, "height": 1080, "color_primaries": "bt2020"}
+        return subprocess.CompletedProcess(args, 0, json.dumps({"streams": [stream]}).encode(), b"")
+
+    monkeypatch.setattr(video_inspector.subprocess, "run", fake_ffprobe)
+    video_index = VideoIndex(str(tmp_path / "video-index.sqlite"))
+
+    first = probe_all_video_info(str(input_directory), video_index=video_index)
+    assert sorted(probed) == ["PXL_20230201_a.mp4", "PXL_20230301_b.mp4", "undated.mp4"]
+
+    probed.clear()
+    os.utime(input_directory / "PXL_20230301_b.mp4", ns=(0, 0))
+    os.remove(input_directory / "undated.mp4")
+    second = probe_all_video_info(str(input_directory), video_index=VideoIndex(str(tmp_path / "video-index.sqlite")))
+
+    assert probed == ["PXL_20230301_b.mp4"]
+    assert second.videos[0] == first.videos[0]
+    assert second.videos[0].file_path == os.path.join(str(input_directory), "PXL_20230201_a.mp4")
+    assert [video.date_taken for video in second.videos] == [date(2023, 2, 1), date(2023, 3, 1)]
+    assert all(video.hdr and video.duration == 12.5 for video in second.videos)
+    with sqlite3.connect(str(tmp_path / "video-index.sqlite")) as connection:
+        assert connection.execute("SELECT COUNT(*) FROM videos").fetchone() == (2,)
@@ -0,0 +1,62 @@
+from dataclasses import replace
+import json
+import pickle
+import subprocess
+from datetime import date
+
+from kids_yearly_video_compiler import video_inspector
+from kids_yearly_video_compiler.video_inspector import VideoInfo, probe_all_video_info
+
+
+def _fake_ffprobe(args, capture_output=True, timeout=None):
+    file_path = args[-1]
+    if "broken" in file_path:
+        return subprocess.CompletedProcess(args, 1, b"", b"invalid data")
+    if "slow" in file_path:
+        raise subprocess.TimeoutExpired(args, timeout)
+    if "garbled" in file_path:
+        return subprocess.CompletedProcess(args, 0, b"{not json", b"")
+    stream = {
+        "codec_type": "video",
+        "duration": "12.5",
+        "width": 1920,
+        "height": 1080,
+        "color_primaries": "bt709",
+    }
+    if "still" in file_path:
+        del stream["duration"]
+    return subprocess.CompletedProcess(args, 0, json.dumps({"streams": [stream]}).encode(), b"")
+
+
+def test_probe_all_video_info_orders_results_and_collects_errors(tmp_path, monkeypatch):
+    for name in [
+        "PXL_20230301_b.mp4",
+        "broken.mp4",
+        "PXL_20230201_a.mp4",
+        "slow.mp4",
+        "garbled.mp4",
+        "still.mp4",
+        ".hidden.mp4",
+    ]:
+        (tmp_path / name).write_bytes(b"")
+    monkeypatch.setattr(video_inspector.subprocess, "run", _fake_ffprobe)
+
+    results = probe_all_video_info(str(tmp_path), max_workers=4, timeout=1)
+
+    assert [video.base_name for video in results.videos] == ["PXL_20230201_a", "PXL_20230301_b"]
+    assert results.videos[0].date_taken == date(2023, 2, 1)
+    assert results.videos[0].duration == 12.5
+    assert sorted(error.video_file_name for error in results.errors) == [
+        "broken.mp4",
+        "garbled.mp4",
+        "slow.mp4",
+        "still.mp4",
+    ]
+
+
+def test_video_info_records_have_no_attribute_dict():
+    video = VideoInfo(base_name="PXL_20230108", duration=10.0)
+
+    assert not hasattr(video, "__dict__")
+    assert replace(video, duration=5.0) == VideoInfo(base_name="PXL_20230108", duration=5.0)
+    assert pickle.loads(pickle.dumps(video)) == video
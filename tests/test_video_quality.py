@@ -0,0 +1,12 @@
+from kids_yearly_video_compiler.video_quality import QualityMetrics, parse_quality_metrics
+
+FFMPEG_STDERR = """frame=  300 fps=120 q=-0.0 Lsize=N/A time=00:00:10.01 bitrate=N/A speed=4.01x
+[Parsed_ssim_4 @ 0x5581] SSIM Y:0.991234 (20.567) U:0.995 (23.0) V:0.994 (22.2) All:0.992345 (21.1)
+[Parsed_psnr_5 @ 0x5582] PSNR y:41.52 u:45.10 v:44.80 average:42.37 min:39.01 max:47.20
+"""
+
+
+def test_parse_quality_metrics():
+    assert parse_quality_metrics(FFMPEG_STDERR) == QualityMetrics(ssim=0.992345, psnr=42.37)
+    assert parse_quality_metrics(FFMPEG_STDERR.replace("average:42.37", "average:inf")).psnr == float("inf")
+    assert parse_quality_metrics("Invalid data found when processing input") is None
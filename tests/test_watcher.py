@@ -0,0 +1,74 @@
+import asyncio
+from datetime import date
+import os
+
+from kids_yearly_video_compiler import watcher
+from kids_yearly_video_compiler.configuration import Configuration
+from kids_yearly_video_compiler.video_index import VideoIndex
+from kids_yearly_video_compiler.video_inspector import VideoInfo
+from kids_yearly_video_compiler.watcher import DirectoryChanges, InputDirectoryWatcher
+
+
+def test_files_are_ready_once_they_stop_changing(tmp_path):
+    clip = tmp_path / "PXL_20230108_clip.mp4"
+    clip.write_bytes(b"half")
+    (tmp_path / ".PXL_20230115_copying.mp4").write_bytes(b"")
+    watcher = InputDirectoryWatcher(str(tmp_path), stable_seconds=30)
+
+    assert watcher.poll(now=0).ready == []
+    # still being copied
+    clip.write_bytes(b"half and more")
+    assert watcher.poll(now=20).ready == []
+    assert watcher.poll(now=40).ready == []
+    changes = watcher.poll(now=50)
+    assert changes.ready == ["PXL_20230108_clip.mp4"]
+    assert changes.identities == {"PXL_20230108_clip.mp4": (clip.stat().st_size, clip.stat().st_mtime_ns)}
+    assert watcher.poll(now=100).ready == []
+
+    # a replaced clip is processed again, a deleted one is reported
+    clip.write_bytes(b"re-exported")
+    os.utime(clip, ns=(1, 1))
+    watcher.poll(now=110)
+    assert watcher.poll(now=140).ready == ["PXL_20230108_clip.mp4"]
+    clip.unlink()
+    assert watcher.poll(now=150).removed == ["PXL_20230108_clip.mp4"]
+
+
+def test_a_failing_warm_up_is_reported_instead_of_stopping_the_watcher(capsys):
+    def broken_probe():
+        raise ValueError("malformed ffprobe output")
+
+    assert not watcher._run_warm_up(broken_probe)
+    assert "malformed ffprobe output" in capsys.readouterr().out
+    assert watcher._run_warm_up(lambda: None)
+
+
+def test_warm_up_jobs_wait_for_an_idle_host(tmp_path, monkeypatch):
+    config = Configuration()
+    config.directories.scratch = str(tmp_path)
+    load_averages = [8.0, 8.0, 1.0]
+    monkeypatch.setattr(os, "getloadavg", lambda: (load_averages.pop(0), 0.0, 0.0), raising=False)
+
+    compiler = watcher.create_warm_up_compiler(config, [], max_load=4.0, poll_interval=0)
+    asyncio.run(compiler.before_job())
+
+    assert load_averages == []
+
+
+def test_ready_clips_are_stored_in_the_video_index(tmp_path, monkeypatch):
+    config = Configuration()
+    config.directories.input_videos = str(tmp_path)
+    clip = tmp_path / "PXL_20230108_clip.mp4"
+    clip.write_bytes(b"clip")
+    stat = os.stat(clip)
+
+    def fake_get_video_info(directory, file_name, timeout=None):
+        return VideoInfo(base_name=file_name.split(".")[0], file_path=os.path.join(directory, file_name), duration=5.0)
+
+    monkeypatch.setattr(watcher, "get_video_info", fake_get_video_info)
+    video_index = VideoIndex(str(tmp_path / "video-index.sqlite"))
+    changes = DirectoryChanges(ready=[clip.name], identities={clip.name: (stat.st_size, stat.st_mtime_ns)})
+
+    assert [video.duration for video in watcher.probe_ready_videos(config, changes, video_index)] == [5.0]
+    indexed_video = video_index.lookup(str(tmp_path), {str(clip): (stat.st_size, stat.st_mtime_ns)})[str(clip)]
+    assert (indexed_video.duration, indexed_video.date_taken) == (5.0, date(2023, 1, 8))